@@ -0,0 +1,238 @@
+"""
+Translating between API Gateway proxy events and FastCGI requests and responses.
+
+API Gateway carries bodies in JSON strings. Binary bodies are base64-encoded and flagged with ``isBase64Encoded``,
+which needs ``*/*`` in the API's binary media types for requests.
+"""
+import base64
+import cgi
+import codecs
+import functools
+import urllib.parse
+
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from fcgi_client import ParamsTemplate
+from routes import Route
+
+__all__ = [
+    'ParamsBuilder', 'make_fcgi_params', 'make_fcgi_params_and_input_from_event', 'transform_header_name_for_php',
+    'query_string', 'keep_body_for', 'proxy_response', 'request_body', 'response_body', 'response_headers', 'is_text',
+    'find_header',
+]
+
+# Lambda's limit on the size of a response, which is lower than API Gateway's.
+MAX_PAYLOAD_SIZE = 6 * 1024 * 1024
+
+# Types that can be sent as a plain string, when they decode, besides text/*.
+TEXT_TYPES = frozenset([
+    'application/javascript', 'application/json', 'application/x-www-form-urlencoded', 'application/xml',
+    'image/svg+xml',
+])
+
+
+def keep_body_for(method: str):
+    """A callback for FCGIApp that drops bodies that are not sent: for HEAD and for 204 and 304 responses."""
+    def keep_body(status: bytes, headers) -> bool:
+        return method != 'HEAD' and not status.startswith((b'204', b'304'))
+    return keep_body
+
+
+# Clients choose the header names, so only the most recent are kept.
+@functools.lru_cache(maxsize=1024)
+def transform_header_name_for_php(k: str) -> str:
+    """
+
+    :param k: Header name
+    :return: Header name capitalized with dashes replaced by underscores.
+    """
+    key = k.upper().replace('-', '_')
+    if not (key == 'CONTENT_TYPE' or key == 'CONTENT_LENGTH'):
+        key = 'HTTP_' + key
+    return key
+
+
+def query_string(event: dict) -> str:
+    query_string_parameters = event.get('queryStringParameters', {})
+    if query_string_parameters:
+        return urllib.parse.urlencode(query_string_parameters)
+    return ''
+
+
+def make_fcgi_params(event: dict, route: Route) -> Dict[str, str]:
+    """The FastCGI params for an event, without ``CONTENT_LENGTH``."""
+    params: Dict[str, str] = {transform_header_name_for_php(k): v for k, v in (event['headers'] or {}).items()}
+    params['SCRIPT_NAME'] = route.script_name
+    params['SCRIPT_FILENAME'] = route.script_filename
+    if route.path_info:
+        params['PATH_INFO'] = route.path_info
+    params['REQUEST_METHOD'] = event['httpMethod']
+    params['QUERY_STRING'] = query_string(event)
+    return params
+
+
+def make_fcgi_params_and_input_from_event(event: dict, route: Route):
+    params = make_fcgi_params(event, route)
+
+    input = b''
+    if event['body'] is not None:
+        input = request_body(event)
+        params['CONTENT_LENGTH'] = str(len(input))
+
+    return params, input
+
+
+class ParamsBuilder(object):
+    """
+    Builds the encoded FCGI_PARAMS of events for FCGIApp.
+
+    The server variables that are the same for every request, and the names of the params that every request has,
+    are encoded once, see :class:`fcgi_client.ParamsTemplate`. Most headers have the same value in request after
+    request, such as ``Accept`` or ``User-Agent``, so the encoded pairs of the most recent short headers are kept.
+    The params are otherwise the same as those of :func:`make_fcgi_params_and_input_from_event`.
+
+    :param document_root: the ``DOCUMENT_ROOT`` of the scripts
+    :param server_software: the ``SERVER_SOFTWARE``
+    :param max_headers: how many encoded headers are kept
+    :param max_header_size: the longest header value that is kept, so that cookies and the like do not push out the
+        rest
+    """
+
+    names = ('SCRIPT_NAME', 'SCRIPT_FILENAME', 'PATH_INFO', 'REQUEST_METHOD', 'QUERY_STRING', 'CONTENT_LENGTH',
+             'SERVER_PROTOCOL')
+
+    def __init__(self, document_root: str, server_software: str = 'php-was-always-already-serverless',
+                 max_headers: int = 1024, max_header_size: int = 256):
+        self.template = ParamsTemplate({
+            'GATEWAY_INTERFACE': 'CGI/1.1',
+            'SERVER_SOFTWARE': server_software,
+            'DOCUMENT_ROOT': document_root,
+        }, self.names)
+        self.max_header_size = max_header_size
+        self._cached_header = functools.lru_cache(max_headers)(self._encode_header)
+
+    def _encode_header(self, name: str, value: str) -> bytes:
+        return self.template.encode_pair(transform_header_name_for_php(name), value)
+
+    def build(self, event: dict, route: Route, server: Optional[Dict[str, str]] = None) -> Tuple[bytes, bytes]:
+        """
+        The encoded params and the body of an event.
+
+        :param server: params that are sent instead of those of the event, such as ``REMOTE_ADDR``
+        """
+        server = server or {}
+        has_body = event['body'] is not None
+        # Headers whose names only differ in case, dashes and underscores
+        # are one param, with the last value, as in make_fcgi_params.
+        headers = {}  # type: Dict[str, bytes]
+        for name, value in (event['headers'] or {}).items():
+            key = transform_header_name_for_php(name)
+            if key in server or has_body and key == 'CONTENT_LENGTH':
+                continue
+            if len(value) <= self.max_header_size:
+                headers[key] = self._cached_header(name, value)
+            else:
+                headers[key] = self._encode_header(name, value)
+
+        pairs = [('SCRIPT_NAME', route.script_name), ('SCRIPT_FILENAME', route.script_filename)]
+        if route.path_info:
+            pairs.append(('PATH_INFO', route.path_info))
+        pairs.append(('REQUEST_METHOD', event['httpMethod']))
+        pairs.append(('QUERY_STRING', query_string(event)))
+
+        input = b''
+        if has_body:
+            input = request_body(event)
+            pairs.append(('CONTENT_LENGTH', str(len(input))))
+        pairs.append(('SERVER_PROTOCOL', 'HTTP/1.1'))
+
+        if server:
+            pairs = [pair for pair in pairs if pair[0] not in server]
+            pairs.extend(server.items())
+        return self.template.encode(pairs, headers.values()), input
+
+
+def proxy_response(status: bytes, headers: List[Tuple[bytes, bytes]],
+                   body: Union[bytes, memoryview]) -> Dict[str, Any]:
+    """The API Gateway proxy response for the output of ``parse_out``."""
+    body, is_base64 = response_body(body, find_header(headers, b'content-type'),
+                                    find_header(headers, b'content-encoding'))
+    single_headers, multi_value_headers = response_headers(headers)
+
+    return {
+        'statusCode': int(status.split(None, 1)[0]),
+        'headers': single_headers,
+        'multiValueHeaders': multi_value_headers,
+        'body': body,
+        'isBase64Encoded': is_base64,
+    }
+
+
+def is_text(content_type: str) -> bool:
+    content_type = content_type.partition(';')[0].strip().lower()
+    return content_type.startswith('text/') or content_type in TEXT_TYPES or content_type.endswith('+json') or \
+        content_type.endswith('+xml')
+
+
+def request_body(event: dict) -> bytes:
+    """The body of the request as it was sent."""
+    body = event.get('body')
+    if body is None:
+        return b''
+    if event.get('isBase64Encoded'):
+        return base64.b64decode(body)
+    headers = event.get('headers') or {}
+    content_type = next((v for k, v in headers.items() if k.lower() == 'content-type'), '')
+    return body.encode(_codec(content_type))
+
+
+def response_body(body: Union[bytes, memoryview], content_type: Optional[str],
+                  content_encoding: Optional[str] = None) -> Tuple[str, bool]:
+    """
+    The body of a response for API Gateway, and whether it is base64-encoded.
+
+    Text is sent as it is when it decodes with its charset, or UTF-8 if it has none. Anything else, including
+    compressed text, is base64-encoded.
+    """
+    if content_type is not None and is_text(content_type) and content_encoding in (None, 'identity'):
+        try:
+            return str(body, _codec(content_type)), False
+        except UnicodeDecodeError:
+            pass
+    return str(base64.b64encode(body), 'ascii'), True
+
+
+def find_header(headers: List[Tuple[bytes, bytes]], name: bytes) -> Optional[str]:
+    """The value of the first header called ``name`` in the lowercased headers from ``parse_out``."""
+    for key, value in headers:
+        if key == name:
+            return str(value, 'latin-1')
+    return None
+
+
+def _codec(content_type: str) -> str:
+    charset = cgi.parse_header(content_type)[1].get('charset', 'utf-8')
+    try:
+        return codecs.lookup(charset).name
+    except LookupError:
+        return 'utf-8'
+
+
+def response_headers(headers: List[Tuple[bytes, bytes]]) -> Tuple[Dict[str, str], Dict[str, List[str]]]:
+    """
+    The ``headers`` and ``multiValueHeaders`` of a response for API Gateway.
+
+    A header that is sent once goes in ``headers``. A repeated one, such as ``Set-Cookie``, goes in
+    ``multiValueHeaders`` with all its values in order.
+    """
+    single = {}  # type: Dict[str, str]
+    multi = {}  # type: Dict[str, List[str]]
+    for key, value in headers:
+        key, value = str(key, 'latin-1'), str(value, 'latin-1')
+        if key in multi:
+            multi[key].append(value)
+        elif key in single:
+            multi[key] = [single.pop(key), value]
+        else:
+            single[key] = value
+    return single, multi
@@ -1,107 +1,216 @@
-import subprocess
 import atexit
+import json
 import os
 import logging
 import sys
-import urllib.parse
-import cgi
-from typing import Dict, List, Tuple, Any
+import time
+from typing import Dict, Any, List, Optional, Tuple, Union
 
+from apigateway import MAX_PAYLOAD_SIZE, ParamsBuilder, keep_body_for, proxy_response, query_string
+from compression import Compressor
 from fcgi_client import *
-
-logger = logging.getLogger()
-handler = logging.StreamHandler(sys.stdout)
-formatter = logging.Formatter('%(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-logger.propagate = False
-logger.setLevel(logging.DEBUG)
-logger.addHandler(handler)
-
-php_fpm = subprocess.Popen([os.environ['LAMBDA_TASK_ROOT'] + '/php-fpm/sbin/php-fpm',
-                            '--force-stderr',
-                            '-c', os.environ['LAMBDA_TASK_ROOT'] + '/php-fpm/etc/php.ini',
-                            '-d', 'extension_dir=' + os.environ['LAMBDA_TASK_ROOT'] + '/php-fpm/ext',
-                            '--prefix', os.environ['LAMBDA_TASK_ROOT'] + '/php-fpm',
-                            '--fpm-config', os.environ['LAMBDA_TASK_ROOT'] + '/php-fpm/etc/php-fpm.conf'
-                            ])
-
-
-def shutdown_php_fpm():
-    php_fpm.terminate()
-
-
-atexit.register(shutdown_php_fpm)
-app = FCGIApp(connect='/tmp/fpm.sock')
+from fcgi_client import BodyLimit
+from logs import LogPipeline, RateLimitFilter, log_php_stderr
+from php_fpm import PhpFpm, PhpFpmError, PhpFpmSupervisor, make_fpm_config, pool_size
+from response_cache import ResponseCache
+from routes import RouteIndex
+from static import StaticFiles
+from timings import Timings
+
+# Records are written as JSON lines by a thread, and flushed before each
+# invocation returns.
+log_pipeline = LogPipeline(sys.stdout, logging.getLevelName(os.environ.get('LOG_LEVEL', 'INFO')),
+                           RateLimitFilter(exempt=['metrics']))
+log_pipeline.start()
+atexit.register(log_pipeline.stop)
+logger = logging.getLogger(__name__)
+metrics_logger = logging.getLogger('metrics')
+# The metrics are written whatever LOG_LEVEL is.
+metrics_logger.setLevel(logging.INFO)
+
+# Set METRICS_NAMESPACE to write the time of each phase of every request as
+# CloudWatch metrics, and SERVER_TIMING to send it in a Server-Timing header.
+metrics_namespace = os.environ.get('METRICS_NAMESPACE')
+metrics_dimensions = {'FunctionName': os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')}
+server_timing = bool(os.environ.get('SERVER_TIMING'))
+
+task_root = os.environ['LAMBDA_TASK_ROOT']
+# SAM Local runs the function on the working copy, where scripts come and go.
+local = 'AWS_SAM_LOCAL' in os.environ
+routes = RouteIndex(task_root + '/php/public', rebuild_on_miss=local)
+static_files = StaticFiles(task_root + '/php/public', revalidate=local)
+params_builder = ParamsBuilder(task_root + '/php/public')
+# Set RESPONSE_CACHE_BYTES to keep PHP responses that allow it in memory.
+response_cache_bytes = int(os.environ.get('RESPONSE_CACHE_BYTES', '0'))
+response_cache = ResponseCache(response_cache_bytes) if response_cache_bytes > 0 else None
+# Set COMPRESSION_LEVEL (1 to 9) to compress PHP responses of at least
+# COMPRESSION_MIN_SIZE bytes for clients that accept it. BROTLI_QUALITY (0 to
+# 11) applies when the brotli package is installed.
+compression_level = int(os.environ.get('COMPRESSION_LEVEL', '0'))
+compressor = Compressor(compression_level, int(os.environ.get('COMPRESSION_MIN_SIZE', '1024')),
+                        int(os.environ.get('BROTLI_QUALITY', '5'))) if compression_level > 0 else None
+# A body that is compressed may be this much larger than Lambda's limit, as
+# long as the encoded response is not, which is checked once it is encoded.
+MAX_COMPRESSED_BODY_SIZE = 8 * MAX_PAYLOAD_SIZE
+
+# Larger functions get more memory and CPUs, and so more PHP-FPM children.
+children = pool_size()
+# PHP-FPM ignores FCGI_ABORT_REQUEST, so a child whose request timed out is
+# only freed by request_terminate_timeout. Lambda does not tell the function
+# its timeout before the first invocation, so set PHP_REQUEST_TIMEOUT to it,
+# as terraform/lambda.tf does. Otherwise children are killed after 30
+# seconds, since API Gateway gives up on a response after 29.
+php_request_timeout = int(os.environ.get('PHP_REQUEST_TIMEOUT', '30'))
+with open('/tmp/php-fpm.conf', 'w') as f:
+    f.write(make_fpm_config('/tmp/fpm.sock', children, php_request_timeout))
+php_fpm = PhpFpm(task_root, '/tmp/fpm.sock', fpm_config='/tmp/php-fpm.conf', revalidate=local)
+supervisor = PhpFpmSupervisor(php_fpm)
+atexit.register(supervisor.stop)
+supervisor.start()
+app = FCGIApp(connect='/tmp/fpm.sock', keep_alive=True, pool_size=children)
+# Bodies larger than SPOOL_THRESHOLD bytes are kept in a file in /tmp rather
+# than in memory.
+spool_threshold = int(os.environ.get('SPOOL_THRESHOLD', str(1024 * 1024)))
+# PHP is given until DEADLINE_MARGIN_MS before the invocation times out. The
+# margin leaves time to abort the request and answer 504, rather than have
+# Lambda stop the container with PHP-FPM in it.
+deadline_margin = int(os.environ.get('DEADLINE_MARGIN_MS', '500')) / 1000
 
 
 def main(event: dict, context) -> Dict[str, Any]:
-    # logger.info(event)
-
-    out, err = app(*make_fcgi_params_and_input_from_event(event))
-    if len(err) > 0:
-        logger.error(str(err, 'ascii'))
-
-    status, headers, body = parse_out(out)
-    status = str(status, 'ascii')
-
-    return {
-        'statusCode': int(status.split(None, 2)[0]),
-        'headers': {str(k, 'ascii'): str(v, 'ascii') for k, v in headers},
-        'multiValueHeaders': {},
-        'body': str(body, charset_from_response(headers))
-    }
-
-
-def transform_header_name_for_php(k: str) -> str:
+    log_pipeline.set_request_id(getattr(context, 'aws_request_id', None))
+    deadline = None
+    if context is not None:
+        deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - deadline_margin
+    try:
+        if not (metrics_namespace or server_timing):
+            return respond(event, deadline=deadline)
+
+        timings = Timings()
+        response = respond(event, timings, deadline)
+        if server_timing:
+            response['headers']['Server-Timing'] = timings.server_timing()
+        if metrics_namespace:
+            metrics_logger.info('timings', extra=timings.metrics(metrics_namespace, metrics_dimensions))
+        return response
+    finally:
+        log_pipeline.set_request_id(None)
+        log_pipeline.flush()
+
+
+def respond(event: dict, timings: Optional[Timings] = None, deadline: Optional[float] = None) -> Dict[str, Any]:
+    route = routes.resolve(event['path'])
+    response = static_files.serve(route, event['httpMethod'], event['headers'] or {})
+    if timings is not None:
+        timings.mark('route')
+    if response is not None:
+        return check_size(event, response)
+
+    cached = None
+    if response_cache is not None:
+        cache_key = (event['httpMethod'], event['path'], query_string(event), event['headers'] or {})
+        cached = response_cache.lookup(*cache_key)
+        logger.info('response cache %s, %d hits, %d misses', 'hit' if cached else 'miss', response_cache.hits,
+                    response_cache.misses)
+        if timings is not None:
+            timings.mark('cache')
+
+    if cached is not None:
+        status, headers, body = cached
+        response = proxy_response(status, *compress(event, status, headers, body, timings))
+    else:
+        try:
+            # While PHP-FPM is restarted, for no longer than the deadline.
+            supervisor.ensure_running(10.0 if deadline is None else max(deadline - time.monotonic(), 0.0))
+        except PhpFpmError as e:
+            logger.error('%s %s: %s', event['httpMethod'], event['path'], e)
+            return service_unavailable()
+        params, input = params_builder.build(event, route)
+        if timings is not None:
+            timings.mark('translate')
+        try:
+            status, headers, spool, err = app.spool(params, input, on_headers=keep_body_for(event['httpMethod']),
+                                                    timings=timings, threshold=spool_threshold,
+                                                    max_size=max_body_size(event), dir='/tmp', deadline=deadline)
+        except ResponseTooLarge as e:
+            logger.error('%s %s: %s', event['httpMethod'], event['path'], e)
+            return bad_gateway()
+        except RequestTimeout as e:
+            logger.error('%s %s: %s', event['httpMethod'], event['path'], e)
+            return gateway_timeout()
+        except (OSError, ProtocolError) as e:
+            # Such as no socket, or a connection that PHP-FPM closed.
+            logger.error('%s %s: PHP-FPM failed: %s', event['httpMethod'], event['path'], e)
+            return bad_gateway()
+        with spool:
+            if err:
+                log_php_stderr(logger, err, path=event['path'])
+            body = spool.getbuffer()
+            if response_cache is not None:
+                response_cache.store(*cache_key, status, headers, body)
+            response = proxy_response(status, *compress(event, status, headers, body, timings))
+            # A spooled body is a view of a mapped file, which is closed with
+            # the spool.
+            body.release()
+
+    if timings is not None:
+        timings.mark('encode')
+    return check_size(event, response)
+
+
+def check_size(event: dict, response: Dict[str, Any]) -> Dict[str, Any]:
+    """The response, or 502 if it is larger than Lambda returns."""
+    # The limit is on the JSON that Lambda sends, in which text bodies are
+    # escaped to ASCII, so that it is as long in bytes as in characters.
+    if len(json.dumps(response)) > MAX_PAYLOAD_SIZE:
+        logger.error('%s %s: encoded response is larger than %d bytes', event['httpMethod'], event['path'],
+                     MAX_PAYLOAD_SIZE)
+        return bad_gateway()
+    return response
+
+
+def max_body_size(event: dict) -> Union[int, BodyLimit]:
     """
+    The largest body accepted from PHP for ``event``.
 
-    :param k: Header name
-    :return: Header name capitalized with dashes replaced by underscores.
+    Only a body that will be compressed may be larger than Lambda's limit. Whether it will depends on the response's
+    headers, so the limit is then a function of them.
     """
-    key = k.upper().replace('-', '_')
-    if not (key == 'CONTENT_TYPE' or key == 'CONTENT_LENGTH'):
-        key = 'HTTP_' + key
-    return key
+    if compressor is None or compressor.negotiate(accept_encoding(event)) is None:
+        return MAX_PAYLOAD_SIZE
 
+    def limit(status: bytes, headers: List[Tuple[bytes, bytes]]) -> int:
+        return MAX_COMPRESSED_BODY_SIZE if compressor.may_compress(status, headers) else MAX_PAYLOAD_SIZE
+    return limit
 
-def charset_from_response(headers: List[Tuple[bytes, bytes]]):
-    charsets = [cgi.parse_header(str(header[1], 'ascii')) for header in headers if header[0] == b'content-type']
-    if charsets:
-        return charsets[0][1]['charset']
-    return 'iso-8859-1'
 
+def accept_encoding(event: dict) -> Optional[str]:
+    return next((v for k, v in (event['headers'] or {}).items() if k.lower() == 'accept-encoding'), None)
 
-def charset_from_event(event: dict) -> str:
-    charsets = [cgi.parse_header(event['headers'].get('Content-Type', 'text/html;charset=iso-8859-1'))]
-    if charsets:
-        return charsets[0][1]['charset']
-    return 'iso-8859-1'
 
+def compress(event: dict, status: bytes, headers: List[Tuple[bytes, bytes]], body: Union[bytes, memoryview],
+             timings: Optional[Timings] = None) -> Tuple[List[Tuple[bytes, bytes]], Union[bytes, memoryview]]:
+    """The headers and body of PHP's response, compressed if the client accepts it and compression is on."""
+    if compressor is None:
+        return headers, body
+    head = event['httpMethod'] == 'HEAD'
+    headers, compressed, encoding = compressor.compress(status, headers, body, accept_encoding(event), head)
+    if encoding is not None and not head:
+        logger.debug('compressed %s from %d to %d bytes with %s', event['path'], len(body), len(compressed), encoding)
+        if timings is not None:
+            timings.mark('compress')
+            timings.sizes['body'] = len(body)
+            timings.sizes['compressed-body'] = len(compressed)
+    return headers, compressed
 
-def query_string(event: dict) -> str:
-    query_string_parameters = event.get('queryStringParameters', {})
-    if query_string_parameters:
-        return urllib.parse.urlencode(query_string_parameters)
-    return ''
 
+def bad_gateway() -> Dict[str, Any]:
+    return proxy_response(b'502 Bad Gateway', [(b'content-type', b'text/plain')], b'Bad Gateway\n')
 
-def make_fcgi_params_and_input_from_event(event: dict):
-    if event['path'] == '/ping' or event['path'] == '/status':
-        script_filename = event['path']
-    elif os.path.isfile(os.environ['LAMBDA_TASK_ROOT'] + '/php/public' + event['path']):
-        script_filename = os.environ['LAMBDA_TASK_ROOT'] + '/php/public' + event['path']
-    else:
-        script_filename = os.environ['LAMBDA_TASK_ROOT'] + '/php/public/index.php' + event['path']
 
-    params: Dict[str, str] = {transform_header_name_for_php(k): v for k, v in event['headers'].items()}
-    params['SCRIPT_NAME'] = event['path']
-    params['SCRIPT_FILENAME'] = script_filename
-    params['REQUEST_METHOD'] = event['httpMethod']
-    params['QUERY_STRING'] = query_string(event)
+def service_unavailable() -> Dict[str, Any]:
+    return proxy_response(b'503 Service Unavailable', [(b'content-type', b'text/plain')], b'Service Unavailable\n')
 
-    input = b''
-    if event['body'] is not None:
-        input = bytes(event['body'], charset_from_event(event))
-        params['CONTENT_LENGTH'] = str(len(input))
 
-    return params, input
+def gateway_timeout() -> Dict[str, Any]:
+    return proxy_response(b'504 Gateway Timeout', [(b'content-type', b'text/plain')], b'Gateway Timeout\n')
@@ -0,0 +1,236 @@
+"""
+Time the FastCGI codec, the event translation and a round trip through FCGIApp, at payload sizes from 16 bytes to
+4 MiB.
+
+Results are written to ``benchmarks/results/<commit>.json``. ``--compare`` prints the ratio of each time to the same
+benchmark in earlier results, so a regression between two commits shows up as a ratio above 1.
+
+Run with ``python -m benchmarks.codec [--compare RESULTS] [--filter TEXT] [--output RESULTS]``.
+"""
+import argparse
+import base64
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+from functools import partial
+
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+from apigateway import ParamsBuilder, make_fcgi_params_and_input_from_event
+from fcgi_client import (FCGIApp, FCGIBeginRequest, FCGIEndRequest, FCGIParams, FCGIStdout, decode_name_value_pairs,
+                         decode_record, encode_name_value_pairs, parse_out, stream_records, FCGI_KEEP_CONN,
+                         FCGI_REQUEST_COMPLETE, FCGI_RESPONDER)
+from fcgi_test_server import FCGITestServer
+from routes import Route
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+# A record's content is at most 65535 bytes, so benchmarks of single
+# records stop at the third size.
+SIZES = (16, 1024, 60 * 1024, 1024 * 1024, 4 * 1024 * 1024)
+MAX_RECORD_SIZE = 65535
+REPEAT = 5
+
+HEADERS = {
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'Accept-Language': 'en-US,en;q=0.5',
+    'CloudFront-Forwarded-Proto': 'https',
+    'CloudFront-Viewer-Country': 'US',
+    'Content-Type': 'application/json; charset=utf-8',
+    'Host': 'example.execute-api.us-east-1.amazonaws.com',
+    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:60.0) Gecko/20100101 Firefox/60.0',
+    'Via': '2.0 0123456789abcdef0123456789abcdef.cloudfront.net (CloudFront)',
+    'X-Amzn-Trace-Id': 'Root=1-5b0b6f4c-0123456789abcdef01234567',
+    'X-Forwarded-For': '203.0.113.1, 198.51.100.1',
+    'X-Forwarded-Port': '443',
+    'X-Forwarded-Proto': 'https',
+}
+# A browser request through CloudFront, with cookies and client hints.
+MANY_HEADERS = dict(HEADERS, **{
+    'Cache-Control': 'max-age=0',
+    'CloudFront-Is-Desktop-Viewer': 'true',
+    'CloudFront-Is-Mobile-Viewer': 'false',
+    'CloudFront-Is-SmartTV-Viewer': 'false',
+    'CloudFront-Is-Tablet-Viewer': 'false',
+    'Cookie': 'session=0123456789abcdef; XSRF-TOKEN=fedcba9876543210; _ga=GA1.2.123456789.1234567890',
+    'DNT': '1',
+    'Origin': 'https://example.com',
+    'Referer': 'https://example.com/items?page=1',
+    'Sec-CH-UA': '"Chromium";v="118", "Google Chrome";v="118"',
+    'Sec-CH-UA-Mobile': '?0',
+    'Sec-CH-UA-Platform': '"Linux"',
+    'Sec-Fetch-Dest': 'empty',
+    'Sec-Fetch-Mode': 'cors',
+    'Sec-Fetch-Site': 'same-origin',
+    'Upgrade-Insecure-Requests': '1',
+    'X-Amz-Cf-Id': 'abcdefghijklmnopqrstuvwxyz0123456789ABCDEFGHIJKLMNO==',
+    'X-Requested-With': 'XMLHttpRequest',
+    'X-Csrf-Token': 'fedcba9876543210',
+    'Content-Length': '16',
+})
+ROUTE = Route('/var/task/php/public/index.php', '/index.php', '/api/items')
+
+RESPONSE_HEADERS = (b'Status: 200 OK\r\nContent-type: application/json\r\nCache-Control: no-cache, private\r\n'
+                    b'Set-Cookie: session=abc; path=/; httponly\r\n\r\n')
+
+Benchmark = Tuple[str, int, Callable[[], object]]
+
+
+def label(size: int) -> str:
+    if size >= 1024 * 1024:
+        return '%d MiB' % (size // (1024 * 1024))
+    if size >= 1024:
+        return '%d KiB' % (size // 1024)
+    return '%d B' % size
+
+
+def make_event(size: int, base64_encoded: bool = False, headers: Optional[Dict[str, str]] = None) -> dict:
+    body = 'x' * size
+    return {
+        'httpMethod': 'POST',
+        'path': '/api/items',
+        'headers': headers or HEADERS,
+        'queryStringParameters': {'page': '2', 'sort': 'name'},
+        'body': base64.b64encode(body.encode()).decode() if base64_encoded else body,
+        'isBase64Encoded': base64_encoded,
+    }
+
+
+def make_params(size: int) -> dict:
+    """The params of a request with the usual headers and a cookie of ``size`` bytes."""
+    params, _ = make_fcgi_params_and_input_from_event(make_event(0), ROUTE)
+    params['HTTP_COOKIE'] = 'x' * size
+    return params
+
+
+def encode_stream(body: bytes) -> list:
+    return [record.encode_buffers() for record in stream_records(FCGIStdout, 1, body)]
+
+
+def encode_event(event: dict) -> bytes:
+    params, _ = make_fcgi_params_and_input_from_event(event, ROUTE)
+    return encode_name_value_pairs(list(params.items()))
+
+
+def codec_benchmarks() -> Iterator[Benchmark]:
+    for size in SIZES:
+        pairs = list(make_params(size).items())
+        encoded = encode_name_value_pairs(pairs)
+        yield 'encode_name_value_pairs', size, partial(encode_name_value_pairs, pairs)
+        yield 'decode_name_value_pairs', size, partial(decode_name_value_pairs, encoded)
+
+    yield 'FCGIBeginRequest.encode', 0, FCGIBeginRequest(1, FCGI_RESPONDER, FCGI_KEEP_CONN).encode
+    yield 'FCGIEndRequest.encode', 0, FCGIEndRequest(1, 0, FCGI_REQUEST_COMPLETE).encode
+    for size in SIZES:
+        if size > MAX_RECORD_SIZE:
+            continue
+        for record_class in (FCGIParams, FCGIStdout):
+            record = record_class(1, b'x' * size)
+            yield '%s.encode' % record_class.__name__, size, record.encode
+        encoded = FCGIStdout(1, b'x' * size).encode()
+        # decode_record consumes its buffer, so the copy is part of the time.
+        yield 'decode_record', size, lambda encoded=encoded: decode_record(bytearray(encoded))
+
+    for size in SIZES:
+        body = b'x' * size
+        yield 'stream_records', size, partial(encode_stream, body)
+        yield 'parse_out', size, partial(parse_out, RESPONSE_HEADERS + body)
+
+
+def event_benchmarks() -> Iterator[Benchmark]:
+    for size in SIZES:
+        yield 'make_fcgi_params_and_input_from_event', size, \
+            partial(make_fcgi_params_and_input_from_event, make_event(size), ROUTE)
+        yield 'make_fcgi_params_and_input_from_event[base64]', size, \
+            partial(make_fcgi_params_and_input_from_event, make_event(size, base64_encoded=True), ROUTE)
+
+    # What FCGIApp sends, from the dict of make_fcgi_params_and_input_from_event
+    # and from ParamsBuilder.
+    event = make_event(16, headers=MANY_HEADERS)
+    name = 'params[%d headers]' % len(MANY_HEADERS)
+    yield '%s make_fcgi_params_and_input_from_event' % name, 0, partial(encode_event, event)
+    yield '%s ParamsBuilder.build' % name, 0, partial(ParamsBuilder('/var/task/php/public').build, event, ROUTE)
+
+
+def round_trip_benchmarks(server: FCGITestServer) -> Iterator[Benchmark]:
+    app = FCGIApp(connect=server.address, keep_alive=True)
+    params = make_params(0)
+    for size in SIZES:
+        yield 'FCGIApp[request body]', size, partial(app, dict(params, CONTENT_LENGTH=str(size)), b'x' * size)
+    for size in SIZES:
+        yield 'FCGIApp[response body]', size, partial(app, dict(params, RESPONSE_SIZE=str(size)))
+
+
+def respond(params: Dict[str, str], stdin: bytes) -> Tuple[bytes, bytes]:
+    return RESPONSE_HEADERS + b'x' * int(params.get('RESPONSE_SIZE', '0')), b''
+
+
+def measure(function: Callable[[], object]) -> float:
+    """The best time of one call, in seconds."""
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=REPEAT, number=number)) / number
+
+
+def commit() -> str:
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL)
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD', '--'], stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return revision.decode().strip() + ('-dirty' if dirty else '')
+
+
+def run(text: Optional[str] = None, compare: Optional[Dict[str, float]] = None) -> Dict[str, float]:
+    results = {}  # type: Dict[str, float]
+    with FCGITestServer(respond) as server:
+        benchmarks = [codec_benchmarks(), event_benchmarks(), round_trip_benchmarks(server)]
+        for name, size, function in (benchmark for group in benchmarks for benchmark in group):
+            key = '%s %s' % (name, label(size)) if size else name
+            if text is not None and text not in key:
+                continue
+            results[key] = seconds = measure(function)
+            line = '%-56s %12.2f us' % (key, seconds * 1e6)
+            if compare and key in compare:
+                line += '  %6.2fx' % (seconds / compare[key])
+            print(line)
+            sys.stdout.flush()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the FastCGI codec, event translation and FCGIApp.')
+    parser.add_argument('--compare', help='earlier results to compare with')
+    parser.add_argument('--filter', dest='text', help='only run benchmarks whose name contains this text')
+    parser.add_argument('--output', help='where to write the results (default: results/<commit>.json)')
+    args = parser.parse_args(argv)
+
+    compare = None
+    if args.compare:
+        with open(args.compare) as f:
+            compare = json.load(f)['results']
+
+    revision = commit()
+    results = run(args.text, compare)
+
+    output = args.output or os.path.join(RESULTS, '%s.json' % revision)
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({
+            'commit': revision,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': results,
+        }, f, indent=2, sort_keys=True)
+        f.write('\n')
+    print('Results written to %s' % output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Measure PHP-FPM cold starts with and without the OPcache file cache built by ``php-fpm/build-opcache.sh``.
+
+Each run starts PHP-FPM like app.py does, waits until it is ready and times the first request to a script, which is
+the one that has to be compiled unless the file cache has it.
+
+Run with ``python -m benchmarks.opcache_cold_start TASK_ROOT [SCRIPT]`` where TASK_ROOT contains the built ``php-fpm``
+directory, including ``php-fpm/opcache``, and the ``php`` directory. The script defaults to ``public/phpinfo.php``.
+"""
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from fcgi_client import FCGIApp
+from php_fpm import PhpFpm
+
+REPEAT = 10
+
+
+def cold_start(task_root: str, script: str, file_cache: bool) -> tuple:
+    with tempfile.TemporaryDirectory() as directory:
+        fpm = PhpFpm(task_root, '/tmp/fpm.sock', file_cache=os.path.join(directory, 'opcache') if file_cache else None)
+        started = time.perf_counter()
+        fpm.start()
+        try:
+            fpm.wait_until_ready()
+            ready = time.perf_counter()
+            app = FCGIApp(connect='/tmp/fpm.sock')
+            filename = os.path.join(task_root, 'php', script)
+            app({'SCRIPT_FILENAME': filename, 'SCRIPT_NAME': '/' + script, 'REQUEST_METHOD': 'GET'})
+            done = time.perf_counter()
+        finally:
+            fpm.terminate()
+            fpm.process.wait()
+    return ready - started, done - ready
+
+
+def main():
+    task_root = os.path.abspath(sys.argv[1])
+    script = sys.argv[2] if len(sys.argv) > 2 else 'public/phpinfo.php'
+    if not os.path.isdir(os.path.join(task_root, 'php-fpm', 'opcache')):
+        sys.exit('%s has no php-fpm/opcache, run php-fpm/build-opcache.sh first' % task_root)
+
+    print('%-12s %14s %14s' % ('file cache', 'ready', 'first request'))
+    for file_cache in (False, True):
+        results = [cold_start(task_root, script, file_cache) for _ in range(REPEAT)]
+        print('%-12s %11.1f ms %11.1f ms' % (
+            'yes' if file_cache else 'no',
+            statistics.median(ready for ready, _ in results) * 1000,
+            statistics.median(first for _, first in results) * 1000))
+
+
+if __name__ == '__main__':
+    main()
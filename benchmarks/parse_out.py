@@ -0,0 +1,52 @@
+"""
+Time parse_out against the previous implementation, which copied every header line and the whole body.
+
+Run with ``python -m benchmarks.parse_out``.
+"""
+import timeit
+
+from fcgi_client import parse_out
+
+HEADERS = (b'Status: 200 OK\r\nContent-type: text/html; charset=UTF-8\r\nCache-Control: no-cache, private\r\n'
+           b'Set-Cookie: session=abc; path=/; httponly\r\nSet-Cookie: XSRF-TOKEN=def; path=/\r\n\r\n')
+BODY_SIZES = (1024, 100 * 1024, 1024 * 1024, 5 * 1024 * 1024)
+
+
+def previous_parse_out(result: bytes) -> tuple:
+    status = b'200 OK'
+    headers = []
+    pos = 0
+    while True:
+        eol = result.find(b'\n', pos)
+        if eol < 0:
+            break
+        line = result[pos:eol - 1]
+        pos = eol + 1
+        line = line.strip()
+        if not line:
+            break
+        header, value = line.split(b':', 1)
+        header = header.strip().lower()
+        value = value.strip()
+        if header == b'status':
+            status = value
+            if status.find(b' ') < 0:
+                status += b' FCGIApp'
+        else:
+            headers.append((header, value))
+    body = result[pos:]
+    return status, headers, body
+
+
+def main():
+    print('%-10s %16s %16s' % ('body', 'previous', 'parse_out'))
+    for size in BODY_SIZES:
+        out = HEADERS + b'x' * size
+        number = max(10, 20000 // (size // 1024))
+        previous = min(timeit.repeat(lambda: previous_parse_out(out), number=number, repeat=5)) / number
+        current = min(timeit.repeat(lambda: parse_out(out), number=number, repeat=5)) / number
+        print('%-10s %13.2f us %13.2f us' % ('%d KiB' % (size // 1024), previous * 1e6, current * 1e6))
+
+
+if __name__ == '__main__':
+    main()
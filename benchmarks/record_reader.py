@@ -0,0 +1,93 @@
+"""
+Count receive system calls per response for FCGIRecordReader and for the previous exact-size reads.
+
+The previous reader did one ``recv`` for the record header and one for the content and padding. It is reproduced
+here with the loops it would have needed to survive short reads.
+
+Run with ``python -m benchmarks.record_reader``.
+"""
+import socket
+import threading
+import time
+
+from fcgi_client import FCGIRecordReader, FCGIStdout, FCGIEndRequest, headers_struct, record_classes
+
+# PHP-FPM writes its output buffer as one FCGI_STDOUT record when it fills up.
+RECORD_SIZES = (8192, 65528)
+RESPONSE_SIZES = (100 * 1024, 300 * 1024, 800 * 1024)
+REPEAT = 20
+
+
+class CountingSocket(object):
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.calls = 0
+
+    def recv(self, size):
+        self.calls += 1
+        return self.sock.recv(size)
+
+    def recv_into(self, buffer):
+        self.calls += 1
+        return self.sock.recv_into(buffer)
+
+
+def exact_size_read(sock) -> object:
+    def recv_exactly(size):
+        chunks = []
+        while size:
+            chunk = sock.recv(size)
+            if not chunk:
+                raise ConnectionAbortedError()
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    header = recv_exactly(headers_struct.size)
+    version, record_type, request_id, content_length, padding_length = headers_struct.unpack(header)
+    content = recv_exactly(content_length + padding_length)
+    return record_classes[record_type].parse(request_id, content[:content_length])
+
+
+def make_response(response_size: int, record_size: int) -> bytes:
+    chunks = [FCGIStdout(1, b'x' * min(record_size, response_size - offset)).encode()
+              for offset in range(0, response_size, record_size)]
+    chunks.append(FCGIStdout(1, b'').encode())
+    chunks.append(FCGIEndRequest(1, 0, 0).encode())
+    return b''.join(chunks)
+
+
+def measure(read_record, response: bytes) -> tuple:
+    calls = 0
+    elapsed = 0.0
+    for _ in range(REPEAT):
+        client, server = socket.socketpair()
+        writer = threading.Thread(target=server.sendall, args=(response,))
+        writer.start()
+        counting = CountingSocket(client)
+        read = read_record(counting)
+        started = time.perf_counter()
+        while not isinstance(read(), FCGIEndRequest):
+            pass
+        elapsed += time.perf_counter() - started
+        calls += counting.calls
+        writer.join()
+        client.close()
+        server.close()
+    return calls / REPEAT, elapsed / REPEAT
+
+
+def main():
+    print('%-10s %-8s %22s %22s' % ('response', 'record', 'exact-size reads', 'FCGIRecordReader'))
+    for record_size in RECORD_SIZES:
+        for response_size in RESPONSE_SIZES:
+            response = make_response(response_size, record_size)
+            old_calls, old_time = measure(lambda sock: lambda: exact_size_read(sock), response)
+            new_calls, new_time = measure(lambda sock: FCGIRecordReader(sock).read_record, response)
+            print('%-10s %-8s %6.1f calls %7.3f ms %6.1f calls %7.3f ms' % (
+                '%d KiB' % (response_size // 1024), '%d B' % record_size,
+                old_calls, old_time * 1000, new_calls, new_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Measure the peak memory of a client that reads a large response with FCGIApp.__call__ and with FCGIApp.spool.
+
+Each response is read in a new process, so that the peak RSS of one does not hide the next. The stand-in server runs
+in this process. This needs Linux, for ``/proc/self/status``.
+
+Run with ``python -m benchmarks.spool_rss``.
+"""
+import subprocess
+import sys
+
+from fcgi_client import FCGIApp
+from fcgi_test_server import FCGITestServer
+
+RESPONSE_SIZES = (1, 8, 32, 64)
+HEADERS = b'Content-type: application/octet-stream\r\n\r\n'
+
+
+def respond(params, stdin):
+    return HEADERS + b'x' * (int(params['RESPONSE_SIZE']) * 1024 * 1024), b''
+
+
+def client(address: str, mode: str, size: str):
+    app = FCGIApp(connect=address)
+    params = {'SCRIPT_FILENAME': '/export.php', 'RESPONSE_SIZE': size}
+    if mode == 'spool':
+        _, _, body, _ = app.spool(params)
+        body.close()
+    else:
+        app(params)
+    # ru_maxrss carries over the parent's peak across fork and exec, the
+    # high-water mark of this process' own memory does not.
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                print(int(line.split()[1]) // 1024)
+
+
+def peak_rss(address: str, mode: str, size: int) -> int:
+    output = subprocess.check_output([sys.executable, '-m', 'benchmarks.spool_rss', address, mode, str(size)])
+    return int(output)
+
+
+def main():
+    print('%-10s %18s %18s' % ('response', '__call__', 'spool'))
+    with FCGITestServer(respond) as server:
+        for size in RESPONSE_SIZES:
+            print('%-10s %14d MiB %14d MiB' % ('%d MiB' % size, peak_rss(server.address, 'call', size),
+                                               peak_rss(server.address, 'spool', size)))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4:
+        client(*sys.argv[1:])
+    else:
+        main()
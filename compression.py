@@ -0,0 +1,183 @@
+"""
+Compressing PHP's responses for clients that accept it.
+
+The encoding is chosen from the request's ``Accept-Encoding``: brotli when the ``brotli`` package is installed, then
+gzip and deflate. Bodies that are small, of a type that is compressed already, or marked ``no-transform`` are sent as
+they are. A compressed body has a ``Content-Encoding``, so proxy_response sends it base64-encoded. The response to a
+HEAD request has no body, but it gets the headers that the response to a GET request would.
+"""
+import functools
+import zlib
+
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+__all__ = ['Compressor', 'Compressed', 'negotiate', 'is_compressible']
+
+Headers = List[Tuple[bytes, bytes]]
+
+# Types whose contents are compressed already, besides image/*, audio/* and
+# video/*.
+COMPRESSED_TYPES = frozenset([
+    'application/gzip', 'application/octet-stream', 'application/pdf', 'application/vnd.rar',
+    'application/x-7z-compressed', 'application/x-bzip2', 'application/x-gzip', 'application/x-rar-compressed',
+    'application/x-xz', 'application/zip', 'application/zstd', 'font/woff', 'font/woff2',
+])
+# Images that are text or not compressed.
+UNCOMPRESSED_IMAGES = frozenset(['image/bmp', 'image/svg+xml', 'image/x-icon', 'image/vnd.microsoft.icon'])
+
+# Statuses whose body is not the whole representation, or empty.
+_SKIPPED_STATUSES = (b'204', b'206', b'304')
+
+
+class Compressed(NamedTuple):
+    """A response after the compression stage. ``encoding`` is None when the body was left as it is."""
+    headers: Headers
+    body: Union[bytes, memoryview]
+    encoding: Optional[str]
+
+
+class Compressor(object):
+    """
+    :param level: the gzip and deflate compression level, from 1 (fastest) to 9 (smallest)
+    :param min_size: the smallest body that is compressed, in bytes
+    :param brotli_quality: the brotli quality, from 0 (fastest) to 11 (smallest)
+    """
+
+    def __init__(self, level: int = 6, min_size: int = 1024, brotli_quality: int = 5):
+        self.level = level
+        self.min_size = min_size
+        self.brotli_quality = brotli_quality
+        # In order of preference, when the client likes several as much.
+        self.encodings = (('br',) if brotli is not None else ()) + ('gzip', 'deflate')
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def compress(self, status: bytes, headers: Headers, body: Union[bytes, memoryview],
+                 accept_encoding: Optional[str], head: bool = False) -> Compressed:
+        """
+        Compress the output of ``parse_out`` with the best encoding that ``accept_encoding`` allows.
+
+        :param headers: the lowercased response headers, which are not changed
+        :param head: whether the response is to a HEAD request and has no body. Its size is then the
+            ``Content-Length``, and a response without one is taken to be large enough to be compressed.
+        :return: the headers, with ``Content-Encoding`` and ``Vary`` when the body may be compressed, and the body
+        """
+        size = _content_length(headers) if head else len(body)
+        if (size is not None and size < self.min_size) or not self.may_compress(status, headers):
+            return Compressed(headers, body, None)
+
+        # The response depends on Accept-Encoding even when it is not
+        # compressed for this client.
+        headers = _add_vary(headers)
+        encoding = self.negotiate(accept_encoding)
+        if encoding is None:
+            return Compressed(headers, body, None)
+
+        if head:
+            compressed = body
+        elif encoding == 'br':
+            compressed = brotli.compress(body, quality=self.brotli_quality)
+        else:
+            # gzip has a gzip header, and HTTP's deflate is the zlib format.
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31 if encoding == 'gzip' else 15)
+            compressed = compressor.compress(body) + compressor.flush()
+        if not head:
+            self.bytes_in += len(body)
+            self.bytes_out += len(compressed)
+
+        encoded = [(b'content-encoding', encoding.encode('ascii'))]
+        for name, value in headers:
+            if name == b'content-length':
+                continue
+            if name == b'etag' and not value.startswith(b'W/'):
+                # The compressed body is not the same bytes, so a strong
+                # validator is no longer true of it.
+                value = b'W/' + value
+            encoded.append((name, value))
+        return Compressed(encoded, compressed, encoding)
+
+    def negotiate(self, accept_encoding: Optional[str]) -> Optional[str]:
+        """The encoding that a request with ``accept_encoding`` gets, or None."""
+        return negotiate(accept_encoding, self.encodings)
+
+    @staticmethod
+    def may_compress(status: bytes, headers: Headers) -> bool:
+        """Whether a response with this status and these headers is compressed, if it is not too small."""
+        return not status.startswith(_SKIPPED_STATUSES) and is_compressible(headers)
+
+
+def is_compressible(headers: Headers) -> bool:
+    """Whether a response with these lowercased headers may be compressed."""
+    content_type = None
+    for name, value in headers:
+        if name == b'content-encoding' and value.strip().lower() != b'identity':
+            return False
+        if name == b'cache-control' and b'no-transform' in value.lower():
+            return False
+        if name == b'content-type' and content_type is None:
+            content_type = str(value, 'latin-1').partition(';')[0].strip().lower()
+    if not content_type or content_type in COMPRESSED_TYPES:
+        return False
+    if content_type.startswith('image/'):
+        return content_type in UNCOMPRESSED_IMAGES
+    return not content_type.startswith(('audio/', 'video/'))
+
+
+# Clients send few different Accept-Encoding values.
+@functools.lru_cache(maxsize=256)
+def negotiate(accept_encoding: Optional[str], encodings: Tuple[str, ...]) -> Optional[str]:
+    """
+    The encoding in ``encodings`` with the highest q-value in ``accept_encoding``, or None for the identity.
+
+    Encodings with the same q-value are chosen in the order of ``encodings``. ``*`` stands for the encodings that
+    are not named, and ``q=0`` refuses an encoding.
+    """
+    if not accept_encoding:
+        return None
+    weights = {}  # type: Dict[str, float]
+    for item in accept_encoding.split(','):
+        coding, _, parameters = item.partition(';')
+        coding = coding.strip().lower()
+        q = 1.0
+        for parameter in parameters.split(';'):
+            key, _, value = parameter.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding == 'x-gzip':
+            coding = 'gzip'
+        if coding:
+            weights[coding] = q
+
+    best, best_q = None, 0.0
+    for encoding in encodings:
+        q = weights.get(encoding, weights.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def _content_length(headers: Headers) -> Optional[int]:
+    for name, value in headers:
+        if name == b'content-length':
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
+
+
+def _add_vary(headers: Headers) -> Headers:
+    for name, value in headers:
+        if name == b'vary':
+            names = [v.strip().lower() for v in value.split(b',')]
+            if b'accept-encoding' in names or b'*' in names:
+                return headers
+    return headers + [(b'vary', b'Accept-Encoding')]
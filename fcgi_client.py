@@ -1,18 +1,36 @@
+import asyncio
+import functools
+import heapq
+import itertools
+import mmap
+import os
+import re
+import select
 import socket
+import tempfile
+import threading
+import time
 from asyncio import Protocol
+from collections import deque
 
+import struct
 from struct import Struct
 
-from typing import Optional, Tuple, List, Union, Dict, Type
+from typing import Optional, Tuple, List, Union, Dict, Type, Callable, Iterator, Iterable, BinaryIO, NamedTuple
 
-from retrying import retry
+from retrying import Retrying
+
+from timings import Timings
 
 __all__ = [
-    'FCGIApp', 'parse_out',
+    'FCGIApp', 'FCGIResponse', 'FCGIConnectionPool', 'FCGIRecordReader', 'parse_out',
     'FCGIRecord', 'FCGIBytestreamRecord', 'FCGIUnknownManagementRecord', 'FCGIGetValues', 'FCGIGetValuesResult',
     'FCGIUnknownType', 'FCGIBeginRequest', 'FCGIAbortRequest', 'FCGIParams', 'FCGIStdin', 'FCGIStdout', 'FCGIStderr',
     'FCGIData', 'FCGIEndRequest', 'encode_name_value_pairs', 'ProtocolError', 'decode_record', 'decode_name_value_pairs',
-    'FastCgiClientProtocol',
+    'stream_records', 'encode_request', 'sendmsg_all', 'FastCgiClientProtocol', 'FastCgiClient',
+    'RequestIdAllocator', 'CGIHeaderParser', 'ParamsTemplate', 'FCGIRecordBuffer', 'FCGIClientConnection',
+    'FCGIStdoutEvent', 'FCGIStderrEvent', 'FCGIEndRequestEvent', 'FCGIValuesEvent', 'OutputSpool',
+    'ResponseTooLarge', 'RequestTimeout',
 ]
 
 # Constants from the spec.
@@ -43,99 +61,646 @@ FCGI_CANT_MPX_CONN = 1
 FCGI_OVERLOADED = 2
 FCGI_UNKNOWN_ROLE = 3
 
+# The content length field of a record is 16 bits wide.
+FCGI_MAX_CONTENT_LENGTH = 65535
+
 FCGI_MAX_CONNS = 'FCGI_MAX_CONNS'
 FCGI_MAX_REQS = 'FCGI_MAX_REQS'
 FCGI_MPXS_CONNS = 'FCGI_MPXS_CONNS'
 
+# A request body: bytes, a binary file object or an iterable of bytes.
+Body = Union[bytes, bytearray, memoryview, BinaryIO, Iterable[bytes]]
+
+# Request params: a dict, or the content of the FCGI_PARAMS stream, as
+# encoded by ParamsTemplate.
+Params = Union[dict, bytes]
+
+# The methods of requests that may be repeated when the application may have
+# run them already.
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+
+def _is_not_listening(exception: BaseException) -> bool:
+    # A Unix socket with a timeout reports a full listen backlog as EAGAIN
+    # instead of waiting.
+    return isinstance(exception, (FileNotFoundError, ConnectionRefusedError, BlockingIOError))
+
 
 class FCGIApp(object):
-    def __init__(self, connect=None, host=None, port=None):
+    def __init__(self, connect=None, host=None, port=None, keep_alive: bool = False,
+                 pool_size: Optional[int] = 1, idle_timeout: float = 60.0, abort_timeout: float = 0.1):
+        """
+        :param connect: path of a Unix socket or a ``(host, port)`` tuple
+        :param keep_alive: set FCGI_KEEP_CONN and reuse connections between requests
+        :param pool_size: the maximum number of connections open at once in keep-alive mode. This must not be
+            larger than ``pm.max_children``, because an FPM child stays attached to a kept-alive connection.
+            ``None`` asks the application for FCGI_MAX_CONNS before the first request.
+        :param idle_timeout: seconds after which an idle connection is closed instead of being reused
+        :param abort_timeout: seconds to wait for the application to end a request that timed out, after it was sent
+            FCGI_ABORT_REQUEST. A connection whose request ended is kept in the pool.
+        """
         if host is not None:
             assert port is not None
             connect = (host, port)
 
         self._connect = connect
+        self._keep_alive = keep_alive
+        self._idle_timeout = idle_timeout
+        self._abort_timeout = abort_timeout
+        self._pool = None  # type: Optional[FCGIConnectionPool]
+        self._pool_lock = threading.Lock()
+        # The connection states of requests that ended, whose receive
+        # buffers are reused, one per request in progress at most.
+        self._connections = deque()  # type: deque
+        if keep_alive and pool_size is not None:
+            self._pool = FCGIConnectionPool(self._get_connection, size=pool_size, idle_timeout=idle_timeout)
+
+    def __call__(self, params: Params, input: Body = b'', data: Body = b'',
+                 on_headers: Optional['HeadersCallback'] = None, timings: Optional[Timings] = None,
+                 deadline: Optional[float] = None) -> Tuple[bytes, bytes]:
+        """
+        Perform a request and return its FCGI_STDOUT and FCGI_STDERR output.
+
+        ``params`` can be a dict or already encoded, see :class:`ParamsTemplate`. ``input`` and ``data`` can be bytes,
+        a binary file object or an iterable of bytes. File objects and iterables are read while the request is sent,
+        so ``CONTENT_LENGTH`` has to be passed in ``params``.
+
+        :param on_headers: called with the status and headers as soon as they have arrived, see
+            :class:`CGIHeaderParser`. If it returns False, the body is read but left out of the output.
+        :param timings: marks the ``connect``, ``send`` and ``php`` phases, and ``first-byte``, the time from the end of
+            ``send`` to the first FCGI_STDOUT record
+        :param deadline: the ``time.monotonic()`` by which the request has to be answered. Connecting, sending and
+            receiving time out at the deadline.
+        :raise RequestTimeout: when the deadline has passed. If the request was sent, the application is sent
+            FCGI_ABORT_REQUEST first.
+        """
+        out = []
+        parser, err = self._read_output(params, input, data, on_headers, timings, deadline,
+                                        lambda body: out.append(bytes(body)))
+        out.insert(0, parser.head)
+        return b''.join(out), err
+
+    def spool(self, params: Params, input: Body = b'', data: Body = b'', on_headers: Optional['HeadersCallback'] = None,
+              timings: Optional[Timings] = None, threshold: int = 1024 * 1024,
+              max_size: Union[int, 'BodyLimit', None] = None, dir: Optional[str] = None,
+              deadline: Optional[float] = None) -> Tuple[bytes, List[Tuple[bytes, bytes]], 'OutputSpool', bytes]:
+        """
+        Perform a request like :meth:`__call__`, but keep a large body in a temporary file instead of in memory.
+
+        The headers are parsed as they arrive, so the body is never copied to be split from them.
+
+        :param threshold: the size from which the body is written to a file, see :class:`OutputSpool`
+        :param max_size: the largest body accepted, or a function that returns it from the status and headers, for a
+            limit that depends on the response
+        :param dir: the directory of the temporary file
+        :return: the status, headers and body, as ``parse_out`` returns them, and the FCGI_STDERR output. The body
+            is an :class:`OutputSpool`, which has to be closed.
+        :raise ResponseTooLarge: as soon as the body is larger than ``max_size``. The connection is closed, so that
+            the application stops.
+        """
+        if callable(max_size):
+            body = OutputSpool(threshold, None, dir)
+            on_headers = _limit_body(body, max_size, on_headers)
+        else:
+            body = OutputSpool(threshold, max_size, dir)
+        try:
+            parser, err = self._read_output(params, input, data, on_headers, timings, deadline, body.write)
+        except BaseException:
+            body.close()
+            raise
+        return parser.status, parser.headers, body, err
+
+    def _read_output(self, params: Params, input: Body, data: Body, on_headers: Optional['HeadersCallback'],
+                     timings: Optional[Timings], deadline: Optional[float],
+                     write: Callable[[memoryview], None]) -> Tuple['CGIHeaderParser', bytes]:
+        """Perform a request, pass the body to ``write`` and return the parsed headers and the FCGI_STDERR output."""
+        parser = CGIHeaderParser(on_headers)
+        err = []
+        records = self._exchange(params, input, data, timings, deadline)
+        try:
+            for record_type, content in records:
+                if record_type == FCGI_STDOUT:
+                    if timings is not None and 'first-byte' not in timings.phases:
+                        timings.lap('first-byte')
+                    body = parser.feed(content)
+                    if body:
+                        write(body)
+                else:
+                    err.append(bytes(content))
+        finally:
+            records.close()
+        if timings is not None:
+            timings.mark('php')
 
-        # sock = self._get_connection()
-        # print self._fcgi_get_values(sock, ['FCGI_MAX_CONNS', 'FCGI_MAX_REQS', 'FCGI_MPXS_CONNS'])
-        # sock.close()
+        parser.close()
+        return parser, b''.join(err)
 
-    def __call__(self, params: dict, input: bytes = b'', data: bytes = b'') -> Tuple[bytes, bytes]:
-        # For sanity's sake, we don't care about FCGI_MPXS_CONN
-        # (connection multiplexing). For every request, we obtain a new
-        # transport socket, perform the request, then discard the socket.
-        # This is, I believe, how mod_fastcgi does things...
+    def stream(self, params: Params, input: Body = b'', data: Body = b'') -> 'FCGIResponse':
+        """
+        Perform a request and return as soon as the response headers have arrived.
+
+        The body is read from the application while the returned response is iterated.
+        """
+        return FCGIResponse(self._exchange(params, input, data))
 
+    def get_values(self, keys: Iterable[str] = (FCGI_MAX_CONNS, FCGI_MAX_REQS, FCGI_MPXS_CONNS)) -> Dict[str, str]:
+        """Ask the application for the values of management variables over a new connection."""
         sock = self._get_connection()
+        try:
+            connection = FCGIClientConnection(FCGI_MAX_RECORD_SIZE)
+            sendmsg_all(sock, [connection.get_values(keys)])
+            while True:
+                event = connection.next_event()
+                if event is None:
+                    _receive(sock, connection)
+                elif isinstance(event, FCGIValuesEvent):
+                    return event.values
+        finally:
+            sock.close()
+
+    def close(self):
+        """Close all idle pooled connections."""
+        if self._pool is not None:
+            self._pool.close()
+
+    def _get_pool(self) -> 'FCGIConnectionPool':
+        with self._pool_lock:
+            if self._pool is None:
+                # Connections are not multiplexed, so only FCGI_MAX_CONNS
+                # matters.
+                pool_size, _, _ = _capabilities(self.get_values())
+                self._pool = FCGIConnectionPool(self._get_connection, size=pool_size,
+                                                idle_timeout=self._idle_timeout)
+            return self._pool
+
+    def _exchange(self, params: Params, input: Body, data: Body, timings: Optional[Timings] = None,
+                  deadline: Optional[float] = None) -> Iterator[Tuple[int, memoryview]]:
+        """
+        Perform a request and yield ``(record_type, content)`` for each FCGI_STDOUT and FCGI_STDERR record.
 
-        request_id = 1 # random.randrange(0xFF)
+        The content is a view of the receive buffer that is only valid until the next record is read.
+        """
+        if not self._keep_alive:
+            # For every request, we obtain a new transport socket, perform
+            # the request, then discard the socket. This is, I believe, how
+            # mod_fastcgi does things...
+            sock = self._get_connection(_remaining(deadline))
+            if timings is not None:
+                timings.mark('connect')
+            try:
+                yield from self._request(sock, 0, params, input, data, timings, deadline)
+            finally:
+                # Done with this transport socket, close it. (FCGI_KEEP_CONN
+                # was not set in the FCGI_BEGIN_REQUEST record. So the
+                # application is expected to do the same.)
+                sock.close()
+            return
+
+        pool = self._get_pool()
+        sock, reused = pool.acquire(_remaining(deadline))
+        if timings is not None:
+            timings.mark('connect')
+        try:
+            try:
+                yield from self._request(sock, FCGI_KEEP_CONN, params, input, data, timings, deadline)
+            except _StaleConnection as e:
+                # The application closed a pooled connection before answering.
+                # The request is repeated once on a fresh connection if the
+                # application could not have read it, or if running it twice
+                # does no harm. Not when the body was a stream that has
+                # already been consumed.
+                if not reused or not (_is_buffer(input) and _is_buffer(data)) or \
+                        (e.sent and not _is_idempotent(params)):
+                    raise
+                pool.discard(sock)
+                sock = None
+                sock = pool.connect(_remaining(deadline))
+                if timings is not None:
+                    timings.mark('connect')
+                yield from self._request(sock, FCGI_KEEP_CONN, params, input, data, timings, deadline)
+        except RequestTimeout as e:
+            # A request that the application ended after it was aborted
+            # leaves the connection ready for the next one.
+            if sock is not None:
+                if e.aborted:
+                    pool.release(sock)
+                else:
+                    pool.discard(sock)
+            raise
+        except BaseException:
+            if sock is not None:
+                pool.discard(sock)
+            raise
+
+        pool.release(sock)
+
+    def _request(self, sock: socket.socket, flags: int, params: Params, input: Body, data: Body,
+                 timings: Optional[Timings] = None,
+                 deadline: Optional[float] = None) -> Iterator[Tuple[int, memoryview]]:
+        # A connection carries one request at a time, so there is no need
+        # for more than one request id. FastCgiClient multiplexes
+        # connections when the application supports it.
+        request_id = 1
+        try:
+            connection = self._connections.pop()
+        except IndexError:
+            connection = FCGIClientConnection()
+        try:
+            yield from self._exchange_records(sock, connection, request_id, flags, params, input, data, timings,
+                                              deadline)
+        finally:
+            connection.reset()
+            self._connections.append(connection)
+
+    def _exchange_records(self, sock: socket.socket, connection: 'FCGIClientConnection', request_id: int, flags: int,
+                          params: Params, input: Body, data: Body, timings: Optional[Timings],
+                          deadline: Optional[float]) -> Iterator[Tuple[int, memoryview]]:
+        # This also clears the timeout of a pooled connection when there is
+        # no deadline.
+        sock.settimeout(_remaining(deadline))
+        try:
+            self._send_request(sock, connection, request_id, flags, params, input, data)
+        except (BrokenPipeError, ConnectionResetError) as e:
+            raise _StaleConnection(*e.args)
+        except socket.timeout:
+            # Part of a record may have been sent, so the connection cannot
+            # carry FCGI_ABORT_REQUEST.
+            raise RequestTimeout('FastCGI request was not sent before the deadline')
+        if timings is not None:
+            timings.mark('send')
 
-        # Begin the request
-        begin_rec = FCGIBeginRequest(request_id, FCGI_RESPONDER, 0)
-        sock.sendall(begin_rec.encode())
+        # Main loop. Process FCGI_STDOUT, FCGI_STDERR, FCGI_END_REQUEST
+        # records from the application.
+        first = True
+        while True:
+            event = connection.next_event()
+            if event is None:
+                try:
+                    if deadline is not None:
+                        sock.settimeout(_remaining(deadline))
+                    _receive(sock, connection)
+                except (ConnectionResetError, ConnectionAbortedError) as e:
+                    if first:
+                        # The whole request was sent, so the application may
+                        # have run it before it went away.
+                        raise _StaleConnection(*e.args, sent=True)
+                    raise
+                except socket.timeout:
+                    aborted = self._abort(sock, connection, request_id)
+                    raise RequestTimeout('FastCGI application did not answer before the deadline', aborted)
+                continue
+            first = False
+            if isinstance(event, FCGIStdoutEvent):
+                yield FCGI_STDOUT, event.content
+            elif isinstance(event, FCGIStderrEvent):
+                yield FCGI_STDERR, event.content
+            elif isinstance(event, FCGIEndRequestEvent):
+                # PHP-FPM only ever ends requests with FCGI_REQUEST_COMPLETE
+                # on a connection that carries one request at a time.
+                break
 
-        # TODO: Handle longer values correctly. Currently the limit is 65535 bytes.
-        params_rec = FCGIParams(request_id, encode_name_value_pairs(list(params.items())))
-        sock.sendall(params_rec.encode())
+    def _abort(self, sock: socket.socket, connection: 'FCGIClientConnection', request_id: int) -> bool:
+        """Send FCGI_ABORT_REQUEST and return whether the application ended the request within the abort timeout."""
+        end = time.monotonic() + self._abort_timeout
+        try:
+            sock.settimeout(self._abort_timeout)
+            sendmsg_all(sock, [connection.abort_request(request_id)])
+            while True:
+                # The rest of the output is dropped.
+                event = connection.next_event()
+                if event is None:
+                    sock.settimeout(_remaining(end))
+                    _receive(sock, connection)
+                elif isinstance(event, FCGIEndRequestEvent):
+                    return True
+        except OSError:
+            return False
 
-        params_rec = FCGIParams(request_id, b'')
-        sock.sendall(params_rec.encode())
+    @staticmethod
+    def _send_request(sock: socket.socket, connection: 'FCGIClientConnection', request_id: int, flags: int,
+                      params: Params, input: Body, data: Body):
+        # The whole request goes out in one sendmsg() call when the body is
+        # a buffer. A streamed body reuses its read buffer, so it is sent
+        # record by record, and only read as fast as the application
+        # accepts it.
+        buffers = connection.send_request(request_id, params, flags)
+        buffered = _is_buffer(input) and _is_buffer(data)
+        for record in connection.send_body(request_id, input, data):
+            buffers.extend(record.encode_buffers())
+            if not buffered:
+                sendmsg_all(sock, buffers)
+                buffers = []
+
+        sendmsg_all(sock, buffers)
+
+    def _get_connection(self, timeout: Optional[float] = None):
+        # The application is expected to be up before the first request (see
+        # php_fpm.PhpFpm.wait_until_ready), so only ride out a short restart,
+        # and no longer than the timeout.
+        stop_max_delay = 1000 if timeout is None else min(1000, int(timeout * 1000))
+        retrying = Retrying(retry_on_exception=_is_not_listening, wait_fixed=10, stop_max_delay=stop_max_delay)
+        try:
+            return retrying.call(self._open_connection, timeout)
+        except BlockingIOError:
+            raise RequestTimeout('FastCGI application did not accept the connection before the deadline')
 
-        # TODO: Handle longer values correctly. Currently the limit is 65535 bytes.
-        stdin_rec = FCGIStdin(request_id, input)
-        sock.sendall(stdin_rec.encode())
+    def _open_connection(self, timeout: Optional[float]) -> socket.socket:
+        if self._connect is not None:
+            # The simple case. Create a socket and connect to the
+            # application.
+            if isinstance(self._connect, str):
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    sock.settimeout(timeout)
+                    sock.connect(self._connect)
+                except BaseException:
+                    sock.close()
+                    raise
+            elif hasattr(socket, 'create_connection'):
+                sock = socket.create_connection(self._connect, timeout)
+            else:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.settimeout(timeout)
+                sock.connect(self._connect)
+            return sock
 
-        stdin_rec = FCGIStdin(request_id, b'')
-        sock.sendall(stdin_rec.encode())
+        # To be done when I have more time...
+        raise NotImplementedError('Launching and managing FastCGI programs not yet implemented')
 
-        # TODO: Handle longer values correctly. Currently the limit is 65535 bytes.
-        data_rec = FCGIData(request_id, data)
-        sock.sendall(data_rec.encode())
 
-        # Main loop. Process FCGI_STDOUT, FCGI_STDERR, FCGI_END_REQUEST
-        # records from the application.
-        err = b''
-        out = b''
-        while True:
-            record = self._read_packet(sock)
-            if isinstance(record, FCGIStdout):
-                out += record.content
-            elif isinstance(record, FCGIStderr):
-                err += record.content
-            elif isinstance(record, FCGIEndRequest):
-                if record.protocol_status != FCGI_REQUEST_COMPLETE:
-                    # something went wrong. PHP-FPM never gives this protocol status!
-                    pass
-                # TODO: Process appStatus/protocolStatus fields?
-                break
+class _StaleConnection(ConnectionResetError):
+    """
+    Raised when a connection was closed by the application before any response was read.
+
+    :param sent: whether the request had been sent, so that the application may have run it
+    """
+
+    def __init__(self, *args, sent: bool = False):
+        super().__init__(*args)
+        self.sent = sent
+
+
+def _is_idempotent(params: Params) -> bool:
+    """Whether the request may be run again, by its ``REQUEST_METHOD``."""
+    if not isinstance(params, dict):
+        params = dict(decode_name_value_pairs(params))
+    return params.get('REQUEST_METHOD') in IDEMPOTENT_METHODS
+
+
+class RequestTimeout(socket.timeout):
+    """
+    Raised when a request is not answered before its deadline.
+
+    :param aborted: whether the application ended the request after FCGI_ABORT_REQUEST
+    """
+
+    def __init__(self, message: str, aborted: bool = False):
+        super().__init__(message)
+        self.aborted = aborted
+
+
+def _remaining(deadline: Optional[float]) -> Optional[float]:
+    """The seconds left until ``deadline``, a ``time.monotonic()``, or None if there is no deadline."""
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise RequestTimeout('FastCGI request deadline has passed')
+    return remaining
+
+
+class FCGIConnectionPool(object):
+    """
+    A pool of idle connections to a FastCGI application.
+
+    Connections are handed out most recently used first. An idle connection is closed instead of being reused
+    if it has been idle for longer than ``idle_timeout`` seconds, or if it became readable while idle, which
+    means the application closed it (or sent something unsolicited).
+
+    """
+
+    def __init__(self, connect: Callable[[Optional[float]], socket.socket], size: int = 1,
+                 idle_timeout: float = 60.0):
+        assert size > 0
+        self._connect = connect
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self._idle = deque()  # type: deque
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def acquire(self, timeout: Optional[float] = None) -> Tuple[socket.socket, bool]:
+        """
+        Take a connection out of the pool, connecting if there is no usable idle connection.
 
-        # Done with this transport socket, close it. (FCGI_KEEP_CONN was not
-        # set in the FCGI_BEGIN_REQUEST record we sent above. So the
-        # application is expected to do the same.)
+        Blocks while ``size`` connections are in use.
+
+        :param timeout: seconds to wait for a connection, passed on to ``connect``
+        :return: the socket and whether it was reused
+        """
+        self._acquire_slot(timeout)
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    sock, released_at = self._idle.pop()
+                if time.monotonic() - released_at > self.idle_timeout or self._is_stale(sock):
+                    sock.close()
+                    continue
+                return sock, True
+
+            return self._connect(timeout), False
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def connect(self, timeout: Optional[float] = None) -> socket.socket:
+        """Open a new connection, taking up a slot. Return it with :meth:`release` or :meth:`discard`."""
+        self._acquire_slot(timeout)
+        try:
+            return self._connect(timeout)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _acquire_slot(self, timeout: Optional[float]):
+        if not self._slots.acquire(timeout=timeout):
+            raise RequestTimeout('no FastCGI connection was free before the deadline')
+
+    def release(self, sock: socket.socket):
+        """Return a connection that finished its request cleanly to the pool."""
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            self._idle.append((sock, now))
+            while self._idle and now - self._idle[0][1] > self.idle_timeout:
+                expired.append(self._idle.popleft()[0])
+        for idle_sock in expired:
+            idle_sock.close()
+        self._slots.release()
+
+    def discard(self, sock: socket.socket):
+        """Close a connection that is in an unknown state."""
         sock.close()
+        self._slots.release()
 
-        return out, err
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, deque()
+        for sock, _ in idle:
+            sock.close()
 
     @staticmethod
-    def _read_packet(sock: socket.socket):
+    def _is_stale(sock: socket.socket) -> bool:
+        # An idle connection has nothing to read: either the application
+        # closed it, or it sent something that was not asked for. poll,
+        # unlike select.select, takes fds above FD_SETSIZE.
+        poller = select.poll()
+        try:
+            poller.register(sock, select.POLLIN)
+        except (OSError, ValueError):
+            return True
+        return bool(poller.poll(0))
+
+
+# The largest record: the header, 65535 bytes of content and 255 bytes of
+# padding.
+FCGI_MAX_RECORD_SIZE = 8 + 65535 + 255
+
+
+class FCGIRecordBuffer(object):
+    """
+    Splits received bytes into FastCGI records, without doing any I/O.
+
+    Bytes are either copied in with :meth:`receive_data`, or received in place into the free space from
+    :meth:`get_buffer` and committed with :meth:`buffer_updated`, as with ``recv_into``. Records are read at an
+    offset. Unread bytes are only moved to the front when the free space at the end is too small for the record being
+    read, and the buffer only grows when more than its size is copied in at once.
+
+    :param size: the initial size of the buffer, at least one record
+    """
+
+    def __init__(self, size: int = 262144):
+        assert size >= FCGI_MAX_RECORD_SIZE
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        # The number of unread bytes that the next record needs.
+        self._needed = headers_struct.size
+
+    def clear(self):
+        """Drop the bytes that were not read, keeping the buffer."""
+        self._start = self._end = 0
+        self._needed = headers_struct.size
+
+    def __len__(self) -> int:
+        """The number of bytes received and not read yet."""
+        return self._end - self._start
+
+    def next_record(self) -> Optional[Tuple[int, int, memoryview]]:
+        """
+        Read the next record without decoding its content.
+
+        :return: a tuple of record type, request id and the record content, or None if the record has not been
+            received completely. The content is a view of the buffer and is only valid until more bytes are received.
+        :raise ProtocolError: if the record header is invalid
         """
-        Create a new FCGI message from the bytes in the given buffer.
+        available = self._end - self._start
+        if available < headers_struct.size:
+            self._needed = headers_struct.size
+            return None
+        version, record_type, request_id, content_length, padding_length = \
+            headers_struct.unpack_from(self._buffer, self._start)
+        if version != 1:
+            raise ProtocolError('unexpected protocol version: %d' % version)
+
+        size = headers_struct.size + content_length + padding_length
+        if available < size:
+            self._needed = size
+            return None
+        start = self._start + headers_struct.size
+        self._start += size
+        return record_type, request_id, self._view[start:start + content_length]
+
+    def get_buffer(self) -> memoryview:
+        """The free space at the end of the buffer, which has room for the rest of the record being read."""
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif len(self._buffer) - self._start < self._needed:
+            self._move(len(self._buffer))
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes: int):
+        """Commit ``nbytes`` received into the buffer from :meth:`get_buffer`."""
+        self._end += nbytes
+
+    def receive_data(self, data: Union[bytes, bytearray, memoryview]):
+        """Copy received bytes into the buffer."""
+        length = len(data)
+        if self._start == self._end:
+            self._start = self._end = 0
+        if len(self._buffer) - self._end < length:
+            self._move(max(len(self._buffer), 2 * (self._end - self._start + length)))
+        self._view[self._end:self._end + length] = data
+        self._end += length
+
+    def _move(self, size: int):
+        # Views of records that were read may still be around, so a larger
+        # buffer is a new one instead of a resized one.
+        length = self._end - self._start
+        if size > len(self._buffer):
+            buffer = bytearray(size)
+            buffer[:length] = self._view[self._start:self._end]
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+        else:
+            self._view[:length] = self._view[self._start:self._end]
+        self._start, self._end = 0, length
 
-        If successful, the record's data is removed from the byte array.
 
-        :param socket.socket sock: the byte array containing the data
-        :return: an instance of FCGIRecord, or ``None`` if there was not enough data
+class FCGIRecordReader(object):
+    """
+    Reads FastCGI records from a blocking socket.
 
+    The records are split by a :class:`FCGIRecordBuffer`, which is filled with ``recv_into``, asking the kernel for
+    as many bytes as fit in the free space. Usually that is several records per system call; short reads are handled
+    by reading again.
+
+    """
+
+    def __init__(self, sock: socket.socket, buffer_size: int = 262144):
+        self.sock = sock
+        self.records = FCGIRecordBuffer(buffer_size)
+
+    def read_raw(self) -> Tuple[int, int, memoryview]:
         """
-        header = sock.recv(headers_struct.size)
-        version, record_type, request_id, content_length, padding_length = headers_struct.unpack_from(header)
+        Read the next record without decoding its content.
 
-        if content_length > 65535:
-            raise ProtocolError('Content length %d is more than 64 kilobytes' % content_length)
+        :return: a tuple of record type, request id and the record content. The content is a view of the receive
+            buffer and is only valid until the next read.
+        :raise ConnectionAbortedError: if the connection was closed
+        :raise ProtocolError: if the record header is invalid
 
-        if version != 1:
-            raise ProtocolError('unexpected protocol version: %d' % header[0])
+        """
+        record = self.records.next_record()
+        while record is None:
+            _receive(self.sock, self.records)
+            record = self.records.next_record()
+        return record
+
+    def read_record(self) -> 'FCGIRecord':
+        """
+        Read and decode the next record.
 
+        :return: an instance of FCGIRecord
+        :raise ConnectionAbortedError: if the connection was closed
+        :raise ProtocolError: if the record is invalid
+
+        """
+        record_type, request_id, content = self.read_raw()
         try:
             record_class = record_classes[record_type]
         except KeyError:
@@ -144,51 +709,159 @@ class FCGIApp(object):
             else:
                 return FCGIUnknownManagementRecord(record_type)
 
-        content = sock.recv(content_length + padding_length)
+        return record_class.parse(request_id, content)
 
-        return record_class.parse(request_id, content[:content_length])
 
-    @retry(wait_exponential_multiplier=1000, wait_exponential_max=10000)
-    def _get_connection(self):
-        if self._connect is not None:
-            # The simple case. Create a socket and connect to the
-            # application.
-            if isinstance(self._connect, str):
-                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-                sock.connect(self._connect)
-            elif hasattr(socket, 'create_connection'):
-                sock = socket.create_connection(self._connect)
-            else:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.connect(self._connect)
-            return sock
+def _receive(sock: socket.socket, records: Union[FCGIRecordBuffer, 'FCGIClientConnection']):
+    """Receive from a blocking socket into the free space of ``records``."""
+    received = sock.recv_into(records.get_buffer())
+    if not received:
+        raise ConnectionAbortedError('FastCGI application closed the connection')
+    records.buffer_updated(received)
 
-        # To be done when I have more time...
-        raise NotImplementedError('Launching and managing FastCGI programs not yet implemented')
 
+class FCGIStdoutEvent(NamedTuple):
+    """FCGI_STDOUT output of a request. The content is only valid until more bytes are received."""
+    request_id: int
+    content: memoryview
+
+
+class FCGIStderrEvent(NamedTuple):
+    """FCGI_STDERR output of a request. The content is only valid until more bytes are received."""
+    request_id: int
+    content: memoryview
+
+
+class FCGIEndRequestEvent(NamedTuple):
+    """The end of a request, after which its id is free."""
+    request_id: int
+    app_status: int
+    protocol_status: int
+
+
+class FCGIValuesEvent(NamedTuple):
+    """The answer to :meth:`FCGIClientConnection.get_values`."""
+    values: Dict[str, str]
+
+
+FCGIEvent = Union[FCGIStdoutEvent, FCGIStderrEvent, FCGIEndRequestEvent, FCGIValuesEvent]
+
+
+class FCGIClientConnection(object):
+    """
+    The client side of a FastCGI connection, without doing any I/O.
+
+    The methods that start, continue and abort requests return the bytes to send. Received bytes go into a
+    :class:`FCGIRecordBuffer` through the same methods, and :meth:`next_event` turns the records into events of the
+    requests that are in progress. Records of requests that ended or were never started are dropped.
+
+    :param buffer_size: the initial size of the receive buffer
+    """
+
+    def __init__(self, buffer_size: int = 262144):
+        self.records = FCGIRecordBuffer(buffer_size)
+        self.requests = set()  # type: set
+        self.get_buffer = self.records.get_buffer
+        self.buffer_updated = self.records.buffer_updated
+        self.receive_data = self.records.receive_data
+
+    def reset(self):
+        """Forget the requests and the received bytes, so that the connection state serves a new connection."""
+        self.records.clear()
+        self.requests.clear()
+
+    def send_request(self, request_id: int, params: Params, flags: int = FCGI_KEEP_CONN,
+                     role: int = FCGI_RESPONDER) -> List[Union[bytes, memoryview]]:
+        """
+        Start a request.
+
+        :return: the FCGI_BEGIN_REQUEST record and the FCGI_PARAMS stream, as buffers for :func:`sendmsg_all`
+        :raise ProtocolError: if the request id is in use
+        """
+        if request_id in self.requests:
+            raise ProtocolError('request id %d is in use' % request_id)
+        self.requests.add(request_id)
+        return encode_request(request_id, flags, params, role)
+
+    @staticmethod
+    def send_body(request_id: int, input: Body = b'', data: Body = b'') -> Iterator['FCGIBytestreamRecord']:
+        """The FCGI_STDIN and FCGI_DATA streams of a request, see :func:`stream_records`."""
+        return itertools.chain(stream_records(FCGIStdin, request_id, input),
+                               stream_records(FCGIData, request_id, data))
+
+    @staticmethod
+    def abort_request(request_id: int) -> bytes:
+        """Ask the application to abort a request. The request goes on until it ends."""
+        return FCGIAbortRequest(request_id).encode()
+
+    @staticmethod
+    def get_values(keys: Iterable[str]) -> bytes:
+        """Ask the application for the values of management variables; see :class:`FCGIValuesEvent`."""
+        return FCGIGetValues(list(keys)).encode()
+
+    def next_event(self) -> Optional[FCGIEvent]:
+        """
+        The next event, or None if more bytes have to be received first.
+
+        :raise ProtocolError: if a record is invalid
+        """
+        while True:
+            record = self.records.next_record()
+            if record is None:
+                return None
+            record_type, request_id, content = record
+            if not request_id:
+                if record_type == FCGI_GET_VALUES_RESULT:
+                    return FCGIValuesEvent(dict(decode_name_value_pairs(content)))
+                # FCGI_UNKNOWN_TYPE, or a management record of a newer
+                # version of the protocol.
+                continue
+            if record_type not in record_classes:
+                raise ProtocolError('unknown record type: %d' % record_type)
+            if request_id not in self.requests:
+                continue
+
+            if record_type == FCGI_STDOUT:
+                return FCGIStdoutEvent(request_id, content)
+            elif record_type == FCGI_STDERR:
+                return FCGIStderrEvent(request_id, content)
+            elif record_type == FCGI_END_REQUEST:
+                self.requests.discard(request_id)
+                try:
+                    app_status, protocol_status = FCGIEndRequest.struct.unpack(content)
+                except struct.error:
+                    raise ProtocolError('invalid FCGI_END_REQUEST record')
+                return FCGIEndRequestEvent(request_id, app_status, protocol_status)
+
+
+def parse_out(result: Union[bytes, bytearray, memoryview]) -> Tuple[bytes, List[Tuple[bytes, bytes]], memoryview]:
+    """
+    Split CGI output into the status, the headers and the body.
+
+    Lines may end with LF or CRLF. Only the header block is copied, the body is returned as a view of ``result``.
+    Header names are lowercased and repeated headers are all kept, in order. Output without an empty line is all
+    headers.
+
+    :return: a tuple of the status line, the headers and the body
+    """
+    view = memoryview(result)
+    if view[:1] == b'\n':
+        end, body_start = 0, 1
+    elif view[:2] == b'\r\n':
+        end, body_start = 0, 2
+    else:
+        match = _empty_line.search(view)
+        if match is None:
+            end = body_start = len(view)
+        else:
+            end, body_start = match.start(), match.end()
 
-def parse_out(result: bytes) -> Tuple[bytes, List[Tuple[bytes, bytes]], bytes]:
-    # Parse response headers from FCGI_STDOUT
     status = b'200 OK'
     headers = []
-    pos = 0
-    while True:
-        eol = result.find(b'\n', pos)
-        if eol < 0:
-            break
-        line = result[pos:eol - 1]
-        pos = eol + 1
-
-        # strip in case of CR. NB: This will also strip other
-        # whitespace...
-        line = line.strip()
-
-        # Empty line signifies end of headers
-        if not line:
-            break
-
-        # TODO: Better error handling
-        header, value = line.split(b':', 1)
+    for line in bytes(view[:end]).split(b'\n'):
+        header, colon, value = line.partition(b':')
+        if not colon:
+            continue
         header = header.strip().lower()
         value = value.strip()
 
@@ -201,15 +874,251 @@ def parse_out(result: bytes) -> Tuple[bytes, List[Tuple[bytes, bytes]], bytes]:
         else:
             headers.append((header, value))
 
-    body = result[pos:]
+    return status, headers, view[body_start:]
+
+
+# The end of the last header line and the empty line after it.
+_empty_line = re.compile(br'\n\r?\n')
+
+
+class FCGIResponse(object):
+    """
+    A response whose body is read from the application while it is iterated.
+
+    The status and headers are parsed when the response is created. Iterating yields the body in chunks as
+    FCGI_STDOUT records arrive, and FCGI_STDERR content is collected on the way. Iterate to the end or call
+    :meth:`close` so that the connection is closed or returned to the pool.
+
+    """
+
+    def __init__(self, records: Iterator[Tuple[int, memoryview]]):
+        self._records = records
+        self._stderr = []  # type: List[bytes]
+        self._body = b''
+
+        parser = CGIHeaderParser()
+        try:
+            for record_type, content in records:
+                if record_type == FCGI_STDERR:
+                    self._stderr.append(bytes(content))
+                    continue
+                body = parser.feed(content)
+                if parser.complete:
+                    self._body = bytes(body)
+                    break
+            else:
+                parser.close()
+        except BaseException:
+            # Invalid headers leave the request unfinished, so its
+            # connection is closed now rather than when it is collected.
+            self.close()
+            raise
+        self.status, self.headers = parser.status, parser.headers
+
+    @property
+    def stderr(self) -> bytes:
+        """FCGI_STDERR content received so far."""
+        return b''.join(self._stderr)
+
+    def __iter__(self) -> Iterator[bytes]:
+        if self._body:
+            yield self._body
+            self._body = b''
+        for record_type, content in self._records:
+            if record_type == FCGI_STDOUT:
+                if content:
+                    yield bytes(content)
+            else:
+                self._stderr.append(bytes(content))
+
+    def read(self) -> bytes:
+        """Read the rest of the body."""
+        return b''.join(self)
+
+    def close(self):
+        """Stop reading the response. An unfinished pooled connection is closed instead of being reused."""
+        self._records.close()
+
+
+HeadersCallback = Callable[[bytes, List[Tuple[bytes, bytes]]], Optional[bool]]
+BodyLimit = Callable[[bytes, List[Tuple[bytes, bytes]]], Optional[int]]
 
-    # Set WSGI status, headers, and return result.
-    return status, headers, body
 
+def _limit_body(spool: 'OutputSpool', max_size: BodyLimit,
+                on_headers: Optional[HeadersCallback]) -> HeadersCallback:
+    """A headers callback that sets the spool's ``max_size`` from the headers, before any of the body is written."""
+    def limit(status: bytes, headers: List[Tuple[bytes, bytes]]) -> Optional[bool]:
+        spool.max_size = max_size(status, headers)
+        return on_headers(status, headers) if on_headers is not None else None
+    return limit
+
+
+class ResponseTooLarge(Exception):
+    """Raised when a response body is larger than allowed."""
+
+
+class OutputSpool(object):
+    """
+    Collects output in memory, and in a temporary file once it is larger than ``threshold`` bytes.
+
+    A spooled file is mapped into memory to be read, so that the output is read from the page cache instead of being
+    copied into the process. The temporary file is deleted as soon as it is closed.
+
+    :param threshold: the size from which output is written to a file
+    :param max_size: the largest output accepted, or None
+    :param dir: the directory of the temporary file, by default the system's
+    """
+
+    def __init__(self, threshold: int = 1024 * 1024, max_size: Optional[int] = None, dir: Optional[str] = None):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.dir = dir
+        self.size = 0
+        self._chunks = []  # type: List[bytes]
+        self._file = None  # type: Optional[BinaryIO]
+        self._map = None  # type: Optional[mmap.mmap]
+
+    @property
+    def spooled(self) -> bool:
+        """Whether the output went to a file."""
+        return self._file is not None
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __enter__(self) -> 'OutputSpool':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, data: Union[bytes, memoryview]):
+        """:raise ResponseTooLarge: if the output would be larger than ``max_size``"""
+        size = self.size + len(data)
+        if self.max_size is not None and size > self.max_size:
+            raise ResponseTooLarge('response is larger than %d bytes' % self.max_size)
+        if self._file is None and size > self.threshold:
+            self._file = tempfile.TemporaryFile(dir=self.dir)
+            self._file.writelines(self._chunks)
+            self._chunks = []
+        if self._file is not None:
+            self._file.write(data)
+        else:
+            self._chunks.append(bytes(data))
+        self.size = size
+
+    def getbuffer(self) -> memoryview:
+        """The output. A view of a spooled file is only valid until the spool is closed."""
+        if self._file is None:
+            if len(self._chunks) != 1:
+                self._chunks = [b''.join(self._chunks)]
+            return memoryview(self._chunks[0])
+        if self._map is None:
+            self._file.flush()
+            if not self.size:
+                return memoryview(b'')
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._map)
+
+    def close(self):
+        self._chunks = []
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # A view of the output is still around. The map is closed
+                # when it is collected.
+                pass
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class CGIHeaderParser(object):
+    """
+    Parses the CGI headers at the start of FCGI_STDOUT while the records arrive.
+
+    :meth:`feed` buffers content until the empty line after the headers, then parses them and returns the part of
+    the content that belongs to the body. From then on content is returned as it is. :meth:`close` at the end of the
+    output parses whatever is buffered, as ``parse_out`` does.
+
+    :param on_headers: called with the status and headers once they are parsed. If it returns False, the body is
+        dropped: :meth:`feed` returns nothing more. It may raise to reject the response.
+    :param max_size: the largest header block accepted
+    """
+
+    def __init__(self, on_headers: Optional[HeadersCallback] = None, max_size: int = 65536):
+        self.on_headers = on_headers
+        self.max_size = max_size
+        self.complete = False
+        self.keep_body = True
+        #: The raw header block, including the empty line.
+        self.head = b''
+        self.status = None  # type: Optional[bytes]
+        self.headers = None  # type: Optional[List[Tuple[bytes, bytes]]]
+        self._buffer = bytearray()
+
+    def feed(self, data: Union[bytes, memoryview]) -> memoryview:
+        """
+        Parse FCGI_STDOUT content.
+
+        :return: the body content in ``data``, as a view of it
+        :raise ProtocolError: if the headers are larger than ``max_size``
+        """
+        if self.complete:
+            return memoryview(data) if self.keep_body else _empty_view
+        start = max(0, len(self._buffer) - 2)
+        self._buffer.extend(data)
+        end = _find_end_of_headers(self._buffer, start)
+        if end < 0:
+            if len(self._buffer) > self.max_size:
+                raise ProtocolError('response headers are larger than %d bytes' % self.max_size)
+            return _empty_view
+        body_start = end - (len(self._buffer) - len(data))
+        self._finish(end)
+        return memoryview(data)[body_start:] if self.keep_body else _empty_view
+
+    def close(self):
+        """Parse the headers of output that ended without an empty line."""
+        if not self.complete:
+            self._finish(len(self._buffer))
+
+    def _finish(self, end: int):
+        self.head = bytes(self._buffer[:end])
+        self._buffer = None
+        self.complete = True
+        self.status, self.headers, _ = parse_out(self.head)
+        if self.on_headers is not None:
+            self.keep_body = self.on_headers(self.status, self.headers) is not False
+
+
+def _find_end_of_headers(head: bytearray, start: int) -> int:
+    """Return the offset just past the empty line that ends the headers, or -1."""
+    if head[:1] == b'\n':
+        return 1
+    if head[:2] == b'\r\n':
+        return 2
+    match = _empty_line.search(head, start)
+    return -1 if match is None else match.end()
+
+
+_empty_view = memoryview(b'')
 
 headers_struct = Struct('>BBHHBx')
 length4_struct = Struct('>I')
 
+# Shared by all records that need padding to a multiple of 8 bytes.
+_padding = memoryview(bytes(7))
+
+# The most buffers a single sendmsg() call accepts.
+try:
+    _iov_max = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):  # pragma: no cover
+    _iov_max = 16
+if _iov_max <= 0:  # pragma: no cover
+    _iov_max = 16
+
 
 class FCGIRecord(object):
     __slots__ = ('request_id',)
@@ -231,6 +1140,10 @@ class FCGIRecord(object):
     def encode(self):  # pragma: no cover
         raise NotImplementedError
 
+    def encode_buffers(self) -> List[Union[bytes, memoryview]]:
+        """Return the encoded record as a list of buffers for vectored writes."""
+        return [self.encode()]
+
     def __bytes__(self):
         return self.encode()
 
@@ -247,7 +1160,17 @@ class FCGIBytestreamRecord(FCGIRecord):
         return cls(request_id, bytes(content))
 
     def encode(self):
-        return self.encode_header(self.content) + self.content + (b'\x00' * (-len(self.content) & 7))
+        return b''.join(self.encode_buffers())
+
+    def encode_buffers(self):
+        # The content is passed on as is, so that views of a request body are
+        # never copied.
+        padding_length = -len(self.content) & 7
+        if padding_length:
+            return [self.encode_header(self.content), self.content, _padding[:padding_length]]
+        elif self.content:
+            return [self.encode_header(self.content), self.content]
+        return [self.encode_header(self.content)]
 
 
 class FCGIUnknownManagementRecord(FCGIRecord):
@@ -396,11 +1319,11 @@ record_classes: Dict[int, Type[FCGIRecord]] = {cls.record_type: cls for cls in g
                   and cls.record_type}
 
 
-def decode_name_value_pairs(buffer: bytearray) -> List[Tuple[str, str]]:
+def decode_name_value_pairs(buffer: Union[bytes, bytearray, memoryview]) -> List[Tuple[str, str]]:
     """
     Decode a name-value pair list from a buffer.
 
-    :param bytearray buffer: a buffer containing a FastCGI name-value pair list
+    :param buffer: a buffer containing a FastCGI name-value pair list
     :raise ProtocolError: if the buffer contains incomplete data
     :return: a list of (name, value) tuples where both elements are unicode strings
     :rtype: list
@@ -428,8 +1351,8 @@ def decode_name_value_pairs(buffer: bytearray) -> List[Tuple[str, str]]:
             raise ProtocolError('not enough data to decode value length in name-value pair')
 
         if len(buffer) - index >= name_length + value_length:
-            name = buffer[index:index + name_length].decode('ascii')
-            value = buffer[index + name_length:index + name_length + value_length].decode('utf-8')
+            name = str(buffer[index:index + name_length], 'ascii')
+            value = str(buffer[index + name_length:index + name_length + value_length], 'utf-8')
             pairs.append((name, value))
             index += name_length + value_length
         else:
@@ -466,6 +1389,147 @@ def encode_name_value_pairs(pairs: List[Tuple[Union[str, bytes], Union[str, byte
     return bytes(content)
 
 
+# The one-byte length prefixes of names and values shorter than 128 bytes.
+_short_lengths = [bytes([length]) for length in range(128)]
+
+
+def _encode_length(length: int) -> bytes:
+    return _short_lengths[length] if length < 128 else length4_struct.pack(length | 0x80000000)
+
+
+class ParamsTemplate(object):
+    """
+    Encodes name-value pairs for FCGI_PARAMS, with what is the same in every request encoded once.
+
+    The ``constants`` are encoded once and start every encoded request. The length prefix and bytes of the ``names``
+    are kept, and those of other names are kept in an LRU cache of ``max_names`` entries, so that each request only
+    encodes its values. The pairs are assembled with one join.
+
+    Values are encoded as UTF-8, which is what :func:`decode_name_value_pairs` expects.
+
+    :param constants: the params that every request has
+    :param names: the names that most requests have
+    :param max_names: how many other names are kept
+    """
+
+    def __init__(self, constants: Optional[Dict[str, str]] = None, names: Iterable[str] = (), max_names: int = 1024):
+        self.constants = encode_name_value_pairs(list((constants or {}).items()))
+        self._names = {name: self._encode_name(name) for name in names}
+        self._cached_name = functools.lru_cache(max_names)(self._encode_name)
+
+    @staticmethod
+    def _encode_name(name: str) -> Tuple[bytes, bytes]:
+        encoded = name.encode('ascii')
+        return _encode_length(len(encoded)), encoded
+
+    def encode_pair(self, name: str, value: str) -> bytes:
+        name_length, name = self._names.get(name) or self._cached_name(name)
+        value = value.encode('utf-8')
+        return b''.join((name_length, _encode_length(len(value)), name, value))
+
+    def encode(self, pairs: Iterable[Tuple[str, str]], encoded: Iterable[bytes] = ()) -> bytes:
+        """Encode ``pairs`` after the constants and the ``encoded`` pairs, from :meth:`encode_pair`."""
+        parts = [self.constants]
+        parts += encoded
+        names = self._names
+        for name, value in pairs:
+            name_length, name = names.get(name) or self._cached_name(name)
+            value = value.encode('utf-8')
+            length = len(value)
+            parts += (name_length, _short_lengths[length] if length < 128 else _encode_length(length), name, value)
+        return b''.join(parts)
+
+
+def stream_records(record_class: Type[FCGIBytestreamRecord], request_id: int,
+                   content: Body) -> Iterator[FCGIBytestreamRecord]:
+    """
+    Split a stream into records followed by the empty record that ends the stream.
+
+    Buffers are sliced with memoryviews. File objects are read into one reused buffer, so each record has to be
+    written before the next one is taken.
+
+    :param record_class: FCGIParams, FCGIStdin or FCGIData
+    :param request_id: the request id of the records
+    :param content: bytes, a binary file object or an iterable of bytes
+    :return: an iterator of records with at most FCGI_MAX_CONTENT_LENGTH bytes of content each
+
+    """
+    for chunk in _iter_chunks(content):
+        yield record_class(request_id, chunk)
+
+    yield record_class(request_id, b'')
+
+
+def encode_request(request_id: int, flags: int, params: Params,
+                   role: int = FCGI_RESPONDER) -> List[Union[bytes, memoryview]]:
+    """
+    Encode the FCGI_BEGIN_REQUEST record and the FCGI_PARAMS stream of a request.
+
+    :param params: a dict, or the encoded name-value pairs
+    :return: a list of buffers, ready for :func:`sendmsg_all`
+
+    """
+    if isinstance(params, dict):
+        params = encode_name_value_pairs(list(params.items()))
+    buffers = [FCGIBeginRequest(request_id, role, flags).encode()]  # type: List[Union[bytes, memoryview]]
+    for record in stream_records(FCGIParams, request_id, params):
+        buffers.extend(record.encode_buffers())
+    return buffers
+
+
+def sendmsg_all(sock: socket.socket, buffers: List[Union[bytes, memoryview]]):
+    """
+    Send a list of buffers with as few system calls as possible.
+
+    Uses scatter-gather ``sendmsg`` and continues after partial writes. Sockets without ``sendmsg`` get the joined
+    buffers through ``sendall``.
+
+    """
+    if not hasattr(sock, 'sendmsg'):  # pragma: no cover
+        sock.sendall(b''.join(buffers))
+        return
+
+    buffers = [buffer for buffer in buffers if len(buffer)]
+    index = 0
+    while index < len(buffers):
+        sent = sock.sendmsg(buffers[index:index + _iov_max])
+        while sent:
+            length = len(buffers[index])
+            if sent < length:
+                buffers[index] = memoryview(buffers[index])[sent:]
+                break
+            sent -= length
+            index += 1
+
+
+def _iter_chunks(content: Body) -> Iterator[memoryview]:
+    if _is_buffer(content):
+        view = memoryview(content).cast('B')
+        for offset in range(0, len(view), FCGI_MAX_CONTENT_LENGTH):
+            yield view[offset:offset + FCGI_MAX_CONTENT_LENGTH]
+    elif hasattr(content, 'readinto'):
+        buffer = bytearray(FCGI_MAX_CONTENT_LENGTH)
+        view = memoryview(buffer)
+        while True:
+            length = content.readinto(buffer)
+            if not length:
+                break
+            yield view[:length]
+    elif hasattr(content, 'read'):
+        while True:
+            chunk = content.read(FCGI_MAX_CONTENT_LENGTH)
+            if not chunk:
+                break
+            yield from _iter_chunks(chunk)
+    else:
+        for chunk in content:
+            yield from _iter_chunks(chunk)
+
+
+def _is_buffer(content) -> bool:
+    return isinstance(content, (bytes, bytearray, memoryview))
+
+
 def decode_record(buffer: bytearray) -> Optional[FCGIRecord]:
     """
     Create a new FCGI message from the bytes in the given buffer.
@@ -473,29 +1537,52 @@ def decode_record(buffer: bytearray) -> Optional[FCGIRecord]:
     :param bytearray buffer: the byte array containing the data
     :return: an instance of this class, or ``None`` if there was not enough data
     """
-    if len(buffer) >= headers_struct.size:
+    record, size = _decode_record_at(buffer, 0)
+    if record is not None:
+        del buffer[:size]
+    return record
+
+
+def decode_buffer_generator(buffer: bytearray) -> Iterator[FCGIRecord]:
+    """
+    Decode the complete records at the start of a buffer.
+
+    The records are read at an offset, and removed from the buffer all at once when the generator is exhausted or
+    closed, so that the rest of the buffer is only moved once.
+    """
+    offset = 0
+    try:
+        while True:
+            record, size = _decode_record_at(buffer, offset)
+            if record is None:
+                return
+            offset += size
+            yield record
+    finally:
+        del buffer[:offset]
+
+
+def _decode_record_at(buffer: bytearray, offset: int) -> Tuple[Optional[FCGIRecord], int]:
+    if len(buffer) - offset >= headers_struct.size:
         version, record_type, request_id, content_length, padding_length = \
-            headers_struct.unpack_from(buffer)
+            headers_struct.unpack_from(buffer, offset)
         if version != 1:
-            raise ProtocolError('unexpected protocol version: %d' % buffer[0])
-        elif len(buffer) >= headers_struct.size + content_length + padding_length:
-            content = buffer[headers_struct.size:headers_struct.size + content_length]
-            del buffer[:headers_struct.size + content_length + padding_length]
+            raise ProtocolError('unexpected protocol version: %d' % version)
+        size = headers_struct.size + content_length + padding_length
+        if len(buffer) - offset >= size:
+            start = offset + headers_struct.size
+            content = bytes(buffer[start:start + content_length])
             try:
                 record_class = record_classes[record_type]
             except KeyError:
                 if request_id:
                     raise ProtocolError('unknown record type: %d' % record_type)
                 else:
-                    return FCGIUnknownManagementRecord(record_type)
-
-            return record_class.parse(request_id, content)
+                    return FCGIUnknownManagementRecord(record_type), size
 
-    return None
+            return record_class.parse(request_id, content), size
 
-
-def decode_buffer_generator(buffer: bytearray):
-    yield decode_record(buffer)
+    return None, 0
 
 
 class ProtocolError(Exception):
@@ -505,62 +1592,446 @@ class ProtocolError(Exception):
         super(ProtocolError, self).__init__('FastCGI protocol violation: %s' % message)
 
 
+class RequestIdAllocator(object):
+    """Hands out the lowest free request id of a connection."""
+
+    def __init__(self):
+        self._next = 1
+        self._free = []  # type: List[int]
+
+    def allocate(self) -> int:
+        if self._free:
+            return heapq.heappop(self._free)
+        if self._next > 0xffff:
+            raise ProtocolError('no free request id')
+        request_id = self._next
+        self._next += 1
+        return request_id
+
+    def release(self, request_id: int):
+        heapq.heappush(self._free, request_id)
+
+
+class _PendingRequest(object):
+    __slots__ = ('future', 'parser', 'stdout', 'stderr', 'received', 'stdin_closed')
+
+    def __init__(self, future: asyncio.Future, on_headers: Optional[HeadersCallback] = None):
+        self.future = future
+        self.parser = CGIHeaderParser(on_headers)
+        self.stdout = []  # type: List[bytes]
+        self.stderr = []  # type: List[bytes]
+        self.received = False
+        self.stdin_closed = False
+
+
 class FastCgiClientProtocol(Protocol):
-    def __init__(self, request_id: int, params: dict, input: bytes, data: bytes, loop):
-        self.request_id = request_id
-        self.params = params
-        self.input = input
-        self.data = data
-        self.loop = loop
-        self.buffer = bytearray()
-        self.stdout = b''
-        self.stderr = b''
+    """
+    A connection to a FastCGI application.
 
-    def connection_made(self, transport):
-        # Begin the request
-        begin_rec = FCGIBeginRequest(self.request_id, FCGI_RESPONDER, FCGI_KEEP_CONN)
-        transport.write(begin_rec.encode())
+    :meth:`send_request` starts a request and returns a future for its ``(stdout, stderr)`` output. Records are
+    demultiplexed by request id, so several requests can be in flight when the application multiplexes connections.
+    Request bodies are written while the transport accepts them. When the connection is lost, the futures of
+    unfinished requests fail with :exc:`ConnectionError`. The protocol itself is handled by a
+    :class:`FCGIClientConnection`.
+
+    """
 
-        # TODO: Handle longer values correctly. Currently the limit is 65535 bytes.
-        params_rec = FCGIParams(self.request_id, encode_name_value_pairs(list(self.params.items())))
-        transport.write(params_rec.encode())
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.connection = FCGIClientConnection()
+        self.transport = None
+        self.closed = self.loop.create_future()
+        # Called when a request ends or the connection is lost.
+        self.on_request_end = None  # type: Optional[Callable[[], None]]
+        self.request_ids = RequestIdAllocator()
+        self._requests = {}  # type: Dict[int, _PendingRequest]
+        self._values = None  # type: Optional[asyncio.Future]
+        self._bodies = deque()  # type: deque
+        self._paused = False
+
+    @property
+    def is_closing(self) -> bool:
+        return self.closed.done() or self.transport is None or self.transport.is_closing()
+
+    @property
+    def active_requests(self) -> int:
+        """The number of requests that have not ended, including aborted ones."""
+        return len(self._requests)
+
+    @property
+    def aborted_requests(self) -> int:
+        """The number of requests whose output is no longer awaited, but that the application has not ended."""
+        return sum(1 for request in self._requests.values() if request.future.done())
+
+    def send_request(self, request_id: int, params: Params, input: Body = b'', data: Body = b'',
+                     on_headers: Optional[HeadersCallback] = None) -> asyncio.Future:
+        """
+        Start a request on this connection.
+
+        :param request_id: an id from :attr:`request_ids`. It is released when the request ends.
+        :param on_headers: called with the status and headers as soon as they have arrived, see
+            :class:`CGIHeaderParser`. If it raises, the future fails and the rest of the output is ignored.
+        :return: a future for the request's FCGI_STDOUT and FCGI_STDERR output
+        """
+        assert request_id not in self._requests
+        if self.is_closing:
+            self.request_ids.release(request_id)
+            raise ConnectionResetError('FastCGI connection is closed')
+
+        request = _PendingRequest(self.loop.create_future(), on_headers)
+        self._requests[request_id] = request
+        self.transport.writelines(self.connection.send_request(request_id, params))
+
+        records = self.connection.send_body(request_id, input, data)
+        # A streamed body is read into one reused buffer, which the
+        # transport must not hold on to.
+        self._bodies.append((request_id, records, not (_is_buffer(input) and _is_buffer(data))))
+        self._write_pending()
+        return request.future
+
+    def abort_request(self, request_id: int):
+        """
+        Abort a request without closing the connection.
 
-        params_rec = FCGIParams(self.request_id, b'')
-        transport.write(params_rec.encode())
+        The request's future is cancelled. Its id stays in use until the application ends the request.
+        """
+        request = self._requests.get(request_id)
+        if request is None:
+            return
+        request.future.cancel()
+        for index, (body_request_id, _, _) in enumerate(self._bodies):
+            if body_request_id == request_id:
+                # The application is waiting for the rest of the body, and
+                # it may only look at the abort after reading it. PHP-FPM
+                # ignores the abort, so the body is ended early, or it would
+                # wait for it forever.
+                records = [FCGIAbortRequest(request_id)]
+                if not request.stdin_closed:
+                    records.insert(0, FCGIStdin(request_id, b''))
+                self._bodies[index] = (request_id, iter(records), False)
+                break
+        else:
+            self.transport.write(self.connection.abort_request(request_id))
 
-        # TODO: Handle longer values correctly. Currently the limit is 65535 bytes.
-        stdin_rec = FCGIStdin(self.request_id, self.input)
-        transport.write(stdin_rec.encode())
+    def get_values(self, keys: List[str]) -> asyncio.Future:
+        """
+        Ask the application for the values of management variables.
 
-        stdin_rec = FCGIStdin(self.request_id, b'')
-        transport.write(stdin_rec.encode())
+        :return: a future for a dict of the values the application knows
+        """
+        if self._values is None or self._values.done():
+            self._values = self.loop.create_future()
+            self.transport.write(self.connection.get_values(keys))
+        return self._values
 
-        # TODO: Handle longer values correctly. Currently the limit is 65535 bytes.
-        data_rec = FCGIData(self.request_id, self.data)
-        transport.write(data_rec.encode())
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
 
-        data_rec = FCGIData(self.request_id, b'')
-        transport.write(data_rec.encode())
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        self._write_pending()
+
+    def _write_pending(self):
+        # Stop pulling from request bodies while the transport's buffer is
+        # above its high-water mark.
+        while not self._paused and self._bodies:
+            request_id, records, copy = self._bodies[0]
+            record = next(records, None)
+            if record is None:
+                self._bodies.popleft()
+                continue
+            if type(record) is FCGIStdin and not record.content:
+                request = self._requests.get(request_id)
+                if request is not None:
+                    request.stdin_closed = True
+            if copy:
+                self.transport.write(record.encode())
+            else:
+                self.transport.writelines(record.encode_buffers())
 
     def connection_lost(self, exc):
-        print('The server closed the connection')
-        print('Stop the event loop')
-        self.loop.stop()
+        self._bodies.clear()
+        requests, self._requests = self._requests, {}
+        for request in requests.values():
+            if request.future.done():
+                continue
+            if request.received:
+                error = ConnectionResetError('FastCGI application closed the connection')
+            else:
+                # Records that were written may have reached the application,
+                # which may then have run the request.
+                error = _StaleConnection('FastCGI application closed the connection', sent=True)
+            if exc is not None:
+                error.__cause__ = exc
+            request.future.set_exception(error)
+        if self._values is not None and not self._values.done():
+            self._values.set_exception(ConnectionResetError('FastCGI application closed the connection'))
+        if not self.closed.done():
+            self.closed.set_result(None)
+        if self.on_request_end is not None:
+            self.on_request_end()
 
     def data_received(self, data):
-        self.buffer.extend(data)
-        record = decode_record(self.buffer)
-        while record is not None:
-            if isinstance(record, FCGIStdout):
-                self.stdout += record.content
-            elif isinstance(record, FCGIStderr):
-                self.stderr += record.content
-            elif isinstance(record, FCGIEndRequest):
-                if record.protocol_status != FCGI_REQUEST_COMPLETE:
-                    # something went wrong. PHP-FPM never gives this protocol status!
-                    pass
-                self.loop.stop()
-            record = decode_record(self.buffer)
+        self.connection.receive_data(data)
+        event = self.connection.next_event()
+        while event is not None:
+            if isinstance(event, FCGIValuesEvent):
+                if self._values is not None and not self._values.done():
+                    self._values.set_result(event.values)
+            else:
+                self._handle_request_event(event)
+            event = self.connection.next_event()
+
+    def _handle_request_event(self, event: FCGIEvent):
+        request = self._requests.get(event.request_id)
+        if request is None:
+            return
+
+        # Contents are views of the receive buffer, so they are copied.
+        request.received = True
+        if isinstance(event, FCGIStdoutEvent):
+            if request.future.done():
+                return
+            try:
+                body = request.parser.feed(event.content)
+            except Exception as e:
+                request.future.set_exception(e)
+                return
+            if body:
+                request.stdout.append(bytes(body))
+        elif isinstance(event, FCGIStderrEvent):
+            request.stderr.append(bytes(event.content))
+        elif isinstance(event, FCGIEndRequestEvent):
+            del self._requests[event.request_id]
+            self.request_ids.release(event.request_id)
+            if self.on_request_end is not None:
+                self.on_request_end()
+            if request.future.done():
+                return
+            if event.protocol_status == FCGI_REQUEST_COMPLETE:
+                try:
+                    request.parser.close()
+                except Exception as e:
+                    request.future.set_exception(e)
+                    return
+                request.stdout.insert(0, request.parser.head)
+                request.future.set_result((b''.join(request.stdout), b''.join(request.stderr)))
+            elif event.protocol_status == FCGI_CANT_MPX_CONN:
+                request.future.set_exception(ProtocolError('application cannot multiplex connections'))
+            elif event.protocol_status == FCGI_OVERLOADED:
+                request.future.set_exception(ProtocolError('application is overloaded'))
+            else:
+                request.future.set_exception(ProtocolError('request rejected with protocol status %d' %
+                                                           event.protocol_status))
 
     def eof_received(self):
         pass
+
+
+class FastCgiClient(object):
+    """
+    An asyncio client for a FastCGI application.
+
+    Connections are kept alive and reused. Before the first request the client asks the application for
+    FCGI_MAX_CONNS, FCGI_MAX_REQS and FCGI_MPXS_CONNS, unless ``max_connections`` is given. At most FCGI_MAX_CONNS
+    connections are opened and at most FCGI_MAX_REQS requests run at once; further requests wait. If the
+    application multiplexes connections, requests share connections, each with its own request id.
+
+    :param connect: path of a Unix socket or a ``(host, port)`` tuple
+    :param max_connections: the maximum number of connections open at once. This must not be larger than
+        ``pm.max_children``, because an FPM child stays attached to a kept-alive connection.
+    :param max_requests: the maximum number of requests at once, by default one per connection
+    :param multiplex: whether to send several requests over one connection at once
+    :param timeout: the default timeout of a request in seconds, including the wait for a connection
+    :param idle_timeout: seconds after which an idle connection is closed instead of being reused
+
+    """
+
+    def __init__(self, connect=None, host=None, port=None, max_connections: Optional[int] = None,
+                 max_requests: Optional[int] = None, multiplex: bool = False, timeout: Optional[float] = None,
+                 idle_timeout: float = 60.0, loop: Optional[asyncio.AbstractEventLoop] = None):
+        if host is not None:
+            assert port is not None
+            connect = (host, port)
+
+        assert connect is not None
+        self._connect = connect
+        self.max_connections = max_connections
+        self.max_requests = max_requests
+        self.multiplex = multiplex
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.loop = loop
+        self._connections = []  # type: List[FastCgiClientProtocol]
+        self._released_at = {}  # type: Dict[FastCgiClientProtocol, float]
+        self._slots = None  # type: Optional[asyncio.Semaphore]
+        self._connecting = None  # type: Optional[asyncio.Lock]
+        self._request_ended = None  # type: Optional[asyncio.Event]
+        self._probe = None  # type: Optional[asyncio.Future]
+
+    async def request(self, params: Params, input: Body = b'', data: Body = b'', timeout: Optional[float] = None,
+                      on_headers: Optional[HeadersCallback] = None) -> Tuple[bytes, bytes]:
+        """
+        Perform a request and return its FCGI_STDOUT and FCGI_STDERR output.
+
+        ``on_headers`` is called with the status and headers as soon as they have arrived, see
+        :class:`CGIHeaderParser`. If it raises, the request is aborted as on a timeout.
+
+        :raise asyncio.TimeoutError: if the request took longer than ``timeout`` seconds. The request is aborted on a
+            multiplexed connection. Otherwise the connection is closed, since the application may still be writing
+            to it.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        return await asyncio.wait_for(self._request(params, input, data, on_headers), timeout)
+
+    async def get_values(self, keys: List[str] = (FCGI_MAX_CONNS, FCGI_MAX_REQS,
+                                                  FCGI_MPXS_CONNS)) -> Dict[str, str]:
+        """Ask the application for the values of management variables over a new connection."""
+        protocol = await self._open_connection()
+        try:
+            return await protocol.get_values(list(keys))
+        finally:
+            protocol.close()
+
+    async def close(self):
+        """Close all idle connections."""
+        idle = [protocol for protocol in self._connections if not protocol.active_requests]
+        for protocol in idle:
+            self._connections.remove(protocol)
+            self._released_at.pop(protocol, None)
+            protocol.close()
+        for protocol in idle:
+            await protocol.closed
+
+    async def _configure(self):
+        if self.max_connections is None:
+            if self._probe is None:
+                self._probe = asyncio.ensure_future(self.get_values(), loop=self.loop)
+            values = await asyncio.shield(self._probe)
+            if self.max_connections is None:
+                self.max_connections, self.max_requests, self.multiplex = _capabilities(values)
+        if self.max_requests is None:
+            self.max_requests = self.max_connections
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_requests)
+
+    async def _request(self, params: Params, input: Body, data: Body,
+                       on_headers: Optional[HeadersCallback]) -> Tuple[bytes, bytes]:
+        await self._configure()
+        async with self._slots:
+            protocol, reused = await self._acquire()
+            request_id = protocol.request_ids.allocate()
+            try:
+                try:
+                    return await protocol.send_request(request_id, params, input, data, on_headers)
+                except _StaleConnection as e:
+                    # The application closed a pooled connection before
+                    # answering, maybe after running the request, so it is
+                    # only repeated once on a fresh connection if running it
+                    # twice does no harm.
+                    if not reused or not (_is_buffer(input) and _is_buffer(data)) or \
+                            (e.sent and not _is_idempotent(params)):
+                        raise
+                    protocol, _ = await self._acquire(reuse=False)
+                    request_id = protocol.request_ids.allocate()
+                    return await protocol.send_request(request_id, params, input, data, on_headers)
+            except BaseException:
+                if self.multiplex and not protocol.is_closing:
+                    protocol.abort_request(request_id)
+                else:
+                    protocol.close()
+                raise
+            finally:
+                # A connection that was closed is not reused, and may be out
+                # of the pool already.
+                if not protocol.is_closing:
+                    self._released_at[protocol] = self._time()
+
+    async def _acquire(self, reuse: bool = True) -> Tuple[FastCgiClientProtocol, bool]:
+        if self._connecting is None:
+            self._connecting = asyncio.Lock()
+            self._request_ended = asyncio.Event()
+        while True:
+            now = self._time()
+            for protocol in list(self._connections):
+                if protocol.is_closing or (not protocol.active_requests and
+                                           now - self._released_at.get(protocol, now) > self.idle_timeout):
+                    self._remove(protocol)
+
+            if reuse:
+                protocol = self._least_busy()
+                if protocol is not None:
+                    return protocol, True
+
+            async with self._connecting:
+                # Another request may have opened a connection in the meantime.
+                protocol = self._least_busy() if reuse else None
+                if protocol is not None:
+                    return protocol, True
+
+                if len(self._connections) >= self.max_connections:
+                    # A connection that only carries aborted requests, which
+                    # the application has not ended yet, is given up.
+                    aborted = [protocol for protocol in self._connections
+                               if protocol.active_requests == protocol.aborted_requests]
+                    if aborted:
+                        self._remove(aborted[0])
+
+                if len(self._connections) < self.max_connections:
+                    protocol = await self._open_connection()
+                    protocol.on_request_end = self._request_ended.set
+                    self._connections.append(protocol)
+                    return protocol, False
+
+                # Every connection is busy with requests that are awaited.
+                self._request_ended.clear()
+            await self._request_ended.wait()
+
+    def _remove(self, protocol: FastCgiClientProtocol):
+        self._connections.remove(protocol)
+        self._released_at.pop(protocol, None)
+        protocol.close()
+
+    def _least_busy(self) -> Optional[FastCgiClientProtocol]:
+        per_connection = -(-self.max_requests // self.max_connections) if self.multiplex else 1
+        candidates = [protocol for protocol in self._connections
+                      if protocol.active_requests < per_connection and not protocol.is_closing]
+        if not candidates:
+            return None
+        # Prefer the most recently used of the least busy connections.
+        return min(reversed(candidates), key=lambda protocol: protocol.active_requests)
+
+    async def _open_connection(self) -> FastCgiClientProtocol:
+        loop = self.loop or asyncio.get_event_loop()
+        if isinstance(self._connect, str):
+            _, protocol = await loop.create_unix_connection(lambda: FastCgiClientProtocol(loop), self._connect)
+        else:
+            _, protocol = await loop.create_connection(lambda: FastCgiClientProtocol(loop), *self._connect)
+        return protocol
+
+    def _time(self) -> float:
+        return (self.loop or asyncio.get_event_loop()).time()
+
+
+def _capabilities(values: Dict[str, str]) -> Tuple[int, int, bool]:
+    """Return the connection limit, request limit and multiplexing support from FCGI_GET_VALUES_RESULT values."""
+    def positive(key: str, default: int) -> int:
+        try:
+            return max(1, int(values.get(key, default)))
+        except ValueError:
+            return default
+
+    max_connections = positive(FCGI_MAX_CONNS, 1)
+    max_requests = positive(FCGI_MAX_REQS, max_connections)
+    multiplex = values.get(FCGI_MPXS_CONNS, '0').strip() == '1'
+    if not multiplex:
+        max_requests = min(max_requests, max_connections)
+    return max_connections, max_requests, multiplex
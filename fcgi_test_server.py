@@ -0,0 +1,179 @@
+"""
+A FastCGI responder that stands in for PHP-FPM in tests and benchmarks.
+
+The application is a callable that takes the request params and body and returns the FCGI_STDOUT and FCGI_STDERR
+output. It raises ConnectionAbortedError to close the connection without answering, as a PHP-FPM child that dies
+does. Each request is run in its own thread, so a server that allows multiplexing answers requests on one
+connection in any order.
+"""
+import os
+import socket
+import tempfile
+import threading
+
+from typing import Callable, Dict, Optional, Tuple, Union
+
+from fcgi_client import *
+from fcgi_client import (FCGI_KEEP_CONN, FCGI_MAX_CONNS, FCGI_MAX_REQS, FCGI_MPXS_CONNS, FCGI_REQUEST_COMPLETE,
+                         FCGI_CANT_MPX_CONN)
+
+__all__ = ['FCGITestServer']
+
+Application = Callable[[Dict[str, str], bytes], Tuple[bytes, bytes]]
+
+
+class FCGITestServer(object):
+    """
+    :param app: the application
+    :param unix: listen on a Unix socket in a temporary directory instead of a TCP port on localhost
+    :param path: listen on this Unix socket instead
+    :param max_conns: the FCGI_MAX_CONNS value
+    :param max_reqs: the FCGI_MAX_REQS value
+    :param mpxs_conns: whether the server accepts several requests on one connection at once
+    :param end_aborted: end a request at once when it is aborted, and drop its output, as the FastCGI spec asks.
+        PHP-FPM ignores FCGI_ABORT_REQUEST, which is the default.
+    """
+
+    def __init__(self, app: Application, unix: bool = True, max_conns: int = 1, max_reqs: int = 1,
+                 mpxs_conns: bool = False, path: Optional[str] = None, end_aborted: bool = False):
+        self.app = app
+        self.values = {FCGI_MAX_CONNS: str(max_conns), FCGI_MAX_REQS: str(max_reqs),
+                       FCGI_MPXS_CONNS: '1' if mpxs_conns else '0'}
+        self.mpxs_conns = mpxs_conns
+        self.end_aborted = end_aborted
+        self.connections = 0
+        self.requests = 0
+        self.aborted = []
+        self._lock = threading.Lock()
+        self._threads = []
+        self._directory = None
+
+        if path is not None or unix:
+            if path is None:
+                self._directory = tempfile.TemporaryDirectory()
+                path = os.path.join(self._directory.name, 'fcgi.sock')
+            self.address = path  # type: Union[str, Tuple[str, int]]
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.bind(self.address)
+        else:
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._sock.bind(('127.0.0.1', 0))
+            self.address = self._sock.getsockname()
+        self._sock.listen(16)
+
+    def __enter__(self) -> 'FCGITestServer':
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self._spawn(self._serve)
+
+    def stop(self):
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        for thread in list(self._threads):
+            thread.join(5)
+        if self._directory is not None:
+            self._directory.cleanup()
+
+    def _spawn(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        self._threads.append(thread)
+        thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            with self._lock:
+                self.connections += 1
+            self._spawn(_Connection(self, conn).run)
+
+
+class _Connection(object):
+    def __init__(self, server: FCGITestServer, sock: socket.socket):
+        self.server = server
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.keep_conn = True
+
+    def run(self):
+        reader = FCGIRecordReader(self.sock)
+        try:
+            while True:
+                record = reader.read_record()
+                self.handle(record)
+        except (OSError, ProtocolError):
+            pass
+        finally:
+            self.sock.close()
+
+    def handle(self, record: FCGIRecord):
+        if isinstance(record, FCGIGetValues):
+            values = [(key, self.server.values[key]) for key in record.keys if key in self.server.values]
+            self.send(FCGIGetValuesResult(values))
+        elif isinstance(record, FCGIBeginRequest):
+            if self.requests and not self.server.mpxs_conns:
+                self.send(FCGIEndRequest(record.request_id, 0, FCGI_CANT_MPX_CONN))
+                return
+            self.keep_conn = bool(record.flags & FCGI_KEEP_CONN)
+            self.requests[record.request_id] = ([], [])
+        elif isinstance(record, FCGIAbortRequest):
+            with self.server._lock:
+                self.server.aborted.append(record.request_id)
+            if self.server.end_aborted:
+                with self.lock:
+                    if self.requests.pop(record.request_id, None) is not None:
+                        self.sock.sendall(FCGIEndRequest(record.request_id, 0, FCGI_REQUEST_COMPLETE).encode())
+        elif isinstance(record, FCGIParams) and record.request_id in self.requests:
+            self.requests[record.request_id][0].append(record.content)
+        elif isinstance(record, FCGIStdin) and record.request_id in self.requests:
+            request = self.requests[record.request_id]
+            stdin = request[1]
+            if record.content:
+                stdin.append(record.content)
+            else:
+                params = dict(decode_name_value_pairs(b''.join(request[0])))
+                self.server._spawn(self.respond, record.request_id, request, params, b''.join(stdin))
+
+    def respond(self, request_id: int, request: Tuple[list, list], params: Dict[str, str], stdin: bytes):
+        with self.server._lock:
+            self.server.requests += 1
+        try:
+            out, err = self.server.app(params, stdin)
+        except ConnectionAbortedError:
+            # The child went away while it ran the request.
+            self.sock.shutdown(socket.SHUT_RDWR)
+            return
+        records = list(stream_records(FCGIStdout, request_id, out))
+        if err:
+            records[-1:-1] = stream_records(FCGIStderr, request_id, err)
+        records.append(FCGIEndRequest(request_id, 0, FCGI_REQUEST_COMPLETE))
+        buffers = []
+        for record in records:
+            buffers.extend(record.encode_buffers())
+        try:
+            with self.lock:
+                # An aborted request has been ended, and its id may have been
+                # taken by a new request.
+                if self.requests.get(request_id) is not request:
+                    return
+                del self.requests[request_id]
+                sendmsg_all(self.sock, buffers)
+                if not self.keep_conn and not self.requests:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def send(self, record: FCGIRecord):
+        with self.lock:
+            self.sock.sendall(record.encode())
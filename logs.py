@@ -0,0 +1,197 @@
+"""
+Logging off the request path.
+
+Records are put on a queue by the request thread and formatted and written as JSON lines by a listener thread. In
+Lambda the process is frozen as soon as the handler returns, so :meth:`LogPipeline.flush` has to be called before
+that. PHP's FCGI_STDERR output is split into one record per line, and repeated lines are rate limited before they are
+queued, while their message and arguments are still apart.
+"""
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+from collections import OrderedDict
+
+from typing import Iterable, Optional, TextIO
+
+__all__ = ['LogPipeline', 'JsonFormatter', 'RateLimitFilter', 'RequestIdFilter', 'log_php_stderr']
+
+# PHP's prefixes for error_log lines, by level.
+PHP_LEVELS = (
+    ('PHP Fatal error', logging.CRITICAL),
+    ('PHP Parse error', logging.CRITICAL),
+    ('PHP Warning', logging.WARNING),
+    ('PHP Notice', logging.INFO),
+    ('PHP Deprecated', logging.INFO),
+    ('PHP Strict Standards', logging.INFO),
+)
+
+# Attributes of every LogRecord, which are not extra fields.
+_RECORD_ATTRIBUTES = frozenset(logging.makeLogRecord({}).__dict__) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object, with its extra fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues records with their message formatted, but with the traceback apart in ``exc_text``.
+
+    The stdlib handler folds the traceback into the message, so JsonFormatter could not put it in a field.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Arguments may change once the record is queued, so the message is
+        # formatted on the request thread.
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_FORMATTER = logging.Formatter()
+
+
+class RequestIdFilter(logging.Filter):
+    """Tags records with the id of the request being handled, unless they have one."""
+
+    def __init__(self):
+        super().__init__()
+        self.request_id = None  # type: Optional[str]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.request_id is not None and not hasattr(record, 'request_id'):
+            record.request_id = self.request_id
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most ``burst`` records with the same logger, level and message every ``interval`` seconds.
+
+    The message is the unformatted one, so records that only differ in their arguments count as the same. The first
+    record let through after some were dropped has a ``suppressed`` field with their number. Records may be filtered
+    on any thread.
+
+    :param max_keys: how many different messages are tracked; the least recent are forgotten
+    :param exempt: the names of loggers whose records are all let through, such as metrics
+    """
+
+    def __init__(self, burst: int = 10, interval: float = 60.0, max_keys: int = 1000, exempt: Iterable[str] = ()):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.max_keys = max_keys
+        self.exempt = frozenset(exempt)
+        self._windows = OrderedDict()  # type: OrderedDict
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.name in self.exempt:
+            return True
+        with self._lock:
+            return self._filter(record)
+
+    def _filter(self, record: logging.LogRecord) -> bool:
+        key = (record.name, record.levelno, record.msg)
+        now = record.created
+        window = self._windows.pop(key, None)
+        if window is None or now - window[0] >= self.interval:
+            suppressed = window[2] if window is not None else 0
+            window = [now, 0, 0]
+            if suppressed:
+                record.suppressed = suppressed
+        self._windows[key] = window
+        if len(self._windows) > self.max_keys:
+            self._windows.popitem(last=False)
+
+        if window[1] >= self.burst:
+            window[2] += 1
+            return False
+        window[1] += 1
+        return True
+
+
+class LogPipeline(object):
+    """
+    Routes the root logger through a queue to a JSON handler on ``stream``.
+
+    :param stream: where the JSON lines are written
+    :param level: the root logger's level
+    :param rate_limit: the filter for repeated records, or None. It runs before records are queued.
+    """
+
+    def __init__(self, stream: TextIO = sys.stdout, level: int = logging.INFO,
+                 rate_limit: Optional[RateLimitFilter] = None):
+        self.queue = queue.Queue()  # type: queue.Queue
+        self.request_ids = RequestIdFilter()
+        self.handler = logging.StreamHandler(stream)
+        self.handler.setFormatter(JsonFormatter())
+        self.queue_handler = _QueueHandler(self.queue)
+        if rate_limit is not None:
+            self.queue_handler.addFilter(rate_limit)
+        self.queue_handler.addFilter(self.request_ids)
+        self.listener = logging.handlers.QueueListener(self.queue, self.handler, respect_handler_level=True)
+        self.level = level
+
+    def start(self, logger: Optional[logging.Logger] = None):
+        """Replace the handlers of ``logger``, by default the root logger, and start writing."""
+        logger = logger or logging.getLogger()
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.addHandler(self.queue_handler)
+        logger.setLevel(self.level)
+        self.listener.start()
+
+    def set_request_id(self, request_id: Optional[str]):
+        self.request_ids.request_id = request_id
+
+    def flush(self):
+        """Wait until every queued record has been written."""
+        self.queue.join()
+        self.handler.flush()
+
+    def stop(self):
+        self.listener.stop()
+
+
+def log_php_stderr(logger: logging.Logger, err: bytes, **extra):
+    """
+    Log FCGI_STDERR output, one record per line.
+
+    The output is decoded as UTF-8 with invalid bytes replaced, and the level is taken from PHP's prefix, such as
+    ``PHP Warning:``. Lines without a known prefix are errors.
+    """
+    for line in str(err, 'utf-8', 'replace').splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        level = logging.ERROR
+        for prefix, prefix_level in PHP_LEVELS:
+            if line.startswith(prefix):
+                level = prefix_level
+                break
+        logger.log(level, line, extra=dict(extra, source='php'))
@@ -0,0 +1,29 @@
+#!/bin/sh
+# This script compiles the PHP scripts in the php directory into an OPcache
+# file cache in php-fpm/opcache, which is deployed together with php-fpm.
+# At start-up PHP-FPM loads compiled scripts from there instead of compiling
+# them again in every new container.
+#
+# The file cache only works with the PHP build that wrote it and for the same
+# script paths, so the scripts are compiled in the php-fpm-build image made by
+# build.sh, with the repository mounted where Lambda puts the package.
+
+set -e
+
+# Set the current directory as this file's directory
+cd "$(dirname "$0")"
+
+rm -rf opcache
+mkdir opcache
+
+docker run --rm \
+    -v "$(cd .. && pwd)":/var/task \
+    php-fpm-build \
+    php -n \
+    -d extension_dir=/usr/local/lib/php/extensions/no-debug-non-zts-20170718 \
+    -d zend_extension=opcache.so \
+    -d opcache.enable_cli=1 \
+    -d opcache.file_cache=/var/task/php-fpm/opcache \
+    -d opcache.file_cache_only=1 \
+    -d opcache.validate_timestamps=0 \
+    /var/task/php-fpm/opcache-warmup.php /var/task/php
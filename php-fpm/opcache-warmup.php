@@ -0,0 +1,21 @@
+<?php
+// Compiles every PHP script below the directory given as the first argument
+// into the OPcache file cache. See build-opcache.sh.
+
+$compiled = 0;
+$failed = 0;
+$files = new RecursiveIteratorIterator(new RecursiveDirectoryIterator($argv[1], FilesystemIterator::SKIP_DOTS));
+foreach ($files as $file) {
+    if ($file->getExtension() !== 'php') {
+        continue;
+    }
+    if (@opcache_compile_file($file->getPathname())) {
+        $compiled++;
+    } else {
+        fwrite(STDERR, 'Could not compile ' . $file->getPathname() . "\n");
+        $failed++;
+    }
+}
+
+echo "Compiled $compiled scripts into " . ini_get('opcache.file_cache') . "\n";
+exit($failed > 0 ? 1 : 0);
@@ -0,0 +1,382 @@
+"""
+Starting PHP-FPM, waiting until it answers requests and restarting it when it exits.
+"""
+import logging
+import os
+import socket
+import subprocess
+import threading
+import time
+from collections import deque
+
+from typing import List, Optional
+
+from fcgi_client import FCGIRecordReader, FCGIEndRequest, FCGIStdout, FCGIStdin, encode_request, sendmsg_all
+
+__all__ = ['PhpFpm', 'PhpFpmError', 'PhpFpmSupervisor', 'make_fpm_config', 'pool_size', 'available_memory',
+           'available_cpus']
+
+logger = logging.getLogger(__name__)
+# PHP-FPM's own log, one record per line.
+fpm_logger = logging.getLogger('php-fpm')
+
+# PHP-FPM's log levels, as they appear in its lines.
+FPM_LEVELS = (
+    ('ALERT: ', logging.CRITICAL),
+    ('ERROR: ', logging.ERROR),
+    ('WARNING: ', logging.WARNING),
+    ('NOTICE: ', logging.INFO),
+    ('DEBUG: ', logging.DEBUG),
+)
+
+
+class PhpFpmError(Exception):
+    """Raised when PHP-FPM exits or does not become ready."""
+
+
+class PhpFpm(object):
+    """
+    A PHP-FPM master process.
+
+    The process's stderr is logged line by line to the ``php-fpm`` logger, and the last ``log_lines`` lines are kept
+    for error messages.
+
+    :param task_root: the directory that contains ``php-fpm`` and ``php``
+    :param socket_path: the Unix socket that ``php-fpm.conf`` listens on
+    :param command: the command line, by default the ``php-fpm`` binary in the task root
+    :param fpm_config: the configuration file for the default command line, by default ``php-fpm/etc/php-fpm.conf``
+    :param file_cache: where to put the OPcache file cache built by ``php-fpm/build-opcache.sh``, if the task root
+        contains one and the default command line is used
+    :param revalidate: have OPcache check scripts for changes on every request, for local development. ``php.ini``
+        turns that off, since the deployment package never changes. Only applies to the default command line.
+    """
+
+    def __init__(self, task_root: str, socket_path: str = '/tmp/fpm.sock', command: Optional[List[str]] = None,
+                 log_lines: int = 50, file_cache: Optional[str] = '/tmp/opcache', fpm_config: Optional[str] = None,
+                 revalidate: bool = False):
+        self.task_root = task_root
+        self.socket_path = socket_path
+        self.file_cache = file_cache if command is None else None
+        self.revalidate = revalidate and command is None
+        self.command = command or [
+            task_root + '/php-fpm/sbin/php-fpm',
+            '--force-stderr',
+            '-c', task_root + '/php-fpm/etc/php.ini',
+            '-d', 'extension_dir=' + task_root + '/php-fpm/ext',
+            '--prefix', task_root + '/php-fpm',
+            '--fpm-config', fpm_config or task_root + '/php-fpm/etc/php-fpm.conf',
+        ]
+        self.process = None  # type: Optional[subprocess.Popen]
+        self._log = deque(maxlen=log_lines)  # type: deque
+        self._log_thread = None  # type: Optional[threading.Thread]
+
+    def start(self):
+        # A socket left behind by an earlier process would accept nothing
+        # but look ready.
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+        command = self.command
+        if self.file_cache is not None and os.path.isdir(self.task_root + '/php-fpm/opcache'):
+            link_tree(self.task_root + '/php-fpm/opcache', self.file_cache)
+            command = command + ['-d', 'opcache.file_cache=' + self.file_cache]
+        if self.revalidate:
+            command = command + ['-d', 'opcache.validate_timestamps=1', '-d', 'opcache.revalidate_freq=0']
+
+        self.process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        self._log_thread = threading.Thread(target=self._forward_log, args=(self.process.stderr,), daemon=True)
+        self._log_thread.start()
+
+    def terminate(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+
+    def stop(self, timeout: float = 5.0):
+        """Terminate the process and wait until it exits, killing it if it is still running after ``timeout``."""
+        if self.process is None:
+            return
+        self.terminate()
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+    def wait_until_ready(self, timeout: float = 10.0, ping: bool = True):
+        """
+        Wait until the socket accepts connections and, if ``ping`` is set, until ``/ping`` answers.
+
+        The socket is polled every few milliseconds, so that no more time than necessary is spent waiting.
+
+        :raise PhpFpmError: if the process exited or was not ready after ``timeout`` seconds
+        """
+        deadline = time.monotonic() + timeout
+        delay = 0.0005
+        while not self._accepts_connections():
+            self._check_running()
+            if time.monotonic() > deadline:
+                raise PhpFpmError(self._describe('PHP-FPM did not listen on %s within %.1f seconds' %
+                                                 (self.socket_path, timeout)))
+            time.sleep(delay)
+            delay = min(delay * 2, 0.01)
+
+        if ping:
+            try:
+                out = self.ping(max(deadline - time.monotonic(), 0.001))
+            except (OSError, ValueError) as e:
+                self._check_running()
+                raise PhpFpmError(self._describe('PHP-FPM did not answer /ping: %s' % e)) from e
+            if not out.endswith(b'pong'):
+                raise PhpFpmError(self._describe('PHP-FPM answered /ping with %r' % out[-100:]))
+
+    def ping(self, timeout: float) -> bytes:
+        """Request ``/ping`` over a new connection and return the output."""
+        params = {'SCRIPT_NAME': '/ping', 'SCRIPT_FILENAME': '/ping', 'REQUEST_METHOD': 'GET'}
+        out = []
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(self.socket_path)
+            sendmsg_all(sock, encode_request(1, 0, params) + [FCGIStdin(1, b'').encode()])
+            reader = FCGIRecordReader(sock, 65536 + 264)
+            while True:
+                record = reader.read_record()
+                if isinstance(record, FCGIStdout):
+                    out.append(record.content)
+                elif isinstance(record, FCGIEndRequest):
+                    return b''.join(out)
+
+    def log_tail(self) -> str:
+        """The last lines PHP-FPM wrote to stderr."""
+        return '\n'.join(self._log)
+
+    def _accepts_connections(self) -> bool:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(self.socket_path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                return False
+        return True
+
+    def _check_running(self):
+        status = self.process.poll()
+        if status is not None:
+            if self._log_thread is not None:
+                self._log_thread.join(1)
+            raise PhpFpmError(self._describe('PHP-FPM exited with status %d' % status))
+
+    def _describe(self, message: str) -> str:
+        tail = self.log_tail()
+        if tail:
+            message += '\n' + tail
+        return message
+
+    def _forward_log(self, stream):
+        for line in stream:
+            line = line.decode('utf-8', 'replace').rstrip('\n')
+            self._log.append(line)
+            level = logging.ERROR
+            for marker, marker_level in FPM_LEVELS:
+                if marker in line:
+                    level = marker_level
+                    break
+            fpm_logger.log(level, line, extra={'source': 'php-fpm'})
+        stream.close()
+
+
+class PhpFpmSupervisor(object):
+    """
+    Keeps PHP-FPM running.
+
+    A thread waits for the master process. When it exits, its status and the last lines of its log are logged and
+    it is started again, after a delay that doubles from ``min_delay`` up to ``max_delay`` while restarts keep
+    failing. Once PHP-FPM has run for ``stable_after`` seconds, the delay starts over.
+
+    :param php_fpm: the PHP-FPM to supervise
+    :param ready_timeout: how long each start may take, see :meth:`PhpFpm.wait_until_ready`
+    """
+
+    def __init__(self, php_fpm: PhpFpm, min_delay: float = 0.1, max_delay: float = 10.0, stable_after: float = 60.0,
+                 ready_timeout: float = 10.0):
+        self.php_fpm = php_fpm
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.stable_after = stable_after
+        self.ready_timeout = ready_timeout
+        self.restarts = 0
+        #: The exit status of the last process that exited.
+        self.last_status = None  # type: Optional[int]
+        self._error = None  # type: Optional[PhpFpmError]
+        self._ready = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+
+    def start(self):
+        """
+        Start PHP-FPM, wait until it is ready and start watching it.
+
+        :raise PhpFpmError: if the first start fails, which a restart would not fix
+        """
+        self.php_fpm.start()
+        self.php_fpm.wait_until_ready(self.ready_timeout)
+        self._ready.set()
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+        self._thread.start()
+
+    @property
+    def running(self) -> bool:
+        """Whether PHP-FPM is ready, rather than being restarted."""
+        return self._ready.is_set()
+
+    def ensure_running(self, timeout: float = 10.0):
+        """
+        Wait until PHP-FPM answers requests, if it is being restarted.
+
+        :raise PhpFpmError: if it was not running again after ``timeout`` seconds
+        """
+        if not self._ready.wait(timeout):
+            message = 'PHP-FPM is not running'
+            if self._error is not None:
+                message += ': %s' % self._error
+            raise PhpFpmError(message)
+
+    def stop(self):
+        self._stopping.set()
+        self.php_fpm.terminate()
+        if self._thread is not None:
+            self._thread.join(5)
+
+    def _watch(self):
+        delay = self.min_delay
+        while True:
+            started = time.monotonic()
+            status = self.php_fpm.process.wait()
+            if self._stopping.is_set():
+                return
+            self._ready.clear()
+            self.last_status = status
+            if time.monotonic() - started >= self.stable_after:
+                delay = self.min_delay
+            self._error = PhpFpmError(self.php_fpm._describe('PHP-FPM exited with status %d' % status))
+            logger.error('%s\nRestarting in %.1f seconds', self._error, delay)
+
+            while not self._stopping.wait(delay):
+                delay = min(delay * 2, self.max_delay)
+                self.restarts += 1
+                try:
+                    self.php_fpm.start()
+                    self.php_fpm.wait_until_ready(self.ready_timeout)
+                except (OSError, PhpFpmError) as e:
+                    # A process that is not reaped is a zombie, and one that
+                    # is still running may hold on to the socket.
+                    self.php_fpm.stop()
+                    self._error = e if isinstance(e, PhpFpmError) else PhpFpmError(str(e))
+                    logger.error('PHP-FPM did not restart: %s\nRetrying in %.1f seconds', e, delay)
+                    continue
+                logger.info('PHP-FPM restarted')
+                self._error = None
+                self._ready.set()
+                break
+            else:
+                return
+
+
+def pool_size(memory: Optional[int] = None, cpus: Optional[int] = None, child_memory: int = 64 * 1024 * 1024,
+              reserved_memory: int = 96 * 1024 * 1024, children_per_cpu: int = 2) -> int:
+    """
+    The number of PHP-FPM children that fit the memory and CPUs.
+
+    :param memory: the memory available, by default :func:`available_memory`
+    :param cpus: the CPUs available, by default :func:`available_cpus`
+    :param child_memory: the memory a child uses, typically far below ``memory_limit``
+    :param reserved_memory: the memory left for Python and the PHP-FPM master
+    :param children_per_cpu: how many children share a CPU, since PHP also waits for I/O
+    """
+    if memory is None:
+        memory = available_memory()
+    if cpus is None:
+        cpus = available_cpus()
+    by_memory = (memory - reserved_memory) // child_memory
+    return max(1, min(by_memory, cpus * children_per_cpu))
+
+
+def available_memory() -> int:
+    """
+    The memory this process may use, in bytes.
+
+    This is the function's memory size in Lambda, the cgroup limit in a container, or the available memory.
+    """
+    if 'AWS_LAMBDA_FUNCTION_MEMORY_SIZE' in os.environ:
+        return int(os.environ['AWS_LAMBDA_FUNCTION_MEMORY_SIZE']) * 1024 * 1024
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as f:
+                limit = f.read().strip()
+        except OSError:
+            continue
+        # cgroup v1 reports no limit as a huge number.
+        if limit.isdigit() and int(limit) < 1 << 60:
+            return int(limit)
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 512 * 1024 * 1024
+
+
+def available_cpus() -> int:
+    """The number of CPUs this process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def make_fpm_config(socket_path: str, max_children: int, request_terminate_timeout: Optional[int] = None) -> str:
+    """
+    A PHP-FPM configuration like ``php-fpm/etc/php-fpm.conf`` with its own socket and number of children.
+
+    The children are started up front, so none has to be forked while a request waits.
+
+    :param request_terminate_timeout: seconds after which PHP-FPM kills a child that is still running a request. PHP-FPM
+        ignores FCGI_ABORT_REQUEST, so this is what frees a child from a request that the client gave up on.
+    """
+    config = """[global]
+error_log = /proc/self/fd/2
+daemonize = no
+
+[www]
+user = nobody
+group = nobody
+listen = %s
+pm = static
+pm.max_children = %d
+pm.status_path = /status
+ping.path = /ping
+catch_workers_output = yes
+clear_env = no
+""" % (socket_path, max_children)
+    if request_terminate_timeout:
+        config += 'request_terminate_timeout = %d\n' % request_terminate_timeout
+    return config
+
+
+def link_tree(source: str, target: str):
+    """
+    Recreate the directories below ``source`` in ``target`` and symlink the files.
+
+    The deployment package is read-only, but OPcache writes scripts that are missing from its file cache, so the
+    cache is linked into a writable directory rather than used in place. Files that exist already are left alone.
+    """
+    for directory, _, files in os.walk(source):
+        destination = os.path.join(target, os.path.relpath(directory, source))
+        os.makedirs(destination, exist_ok=True)
+        for name in files:
+            try:
+                os.symlink(os.path.join(directory, name), os.path.join(destination, name))
+            except FileExistsError:
+                pass
@@ -0,0 +1,240 @@
+"""
+A shared HTTP cache for PHP responses, kept in memory between invocations of a warm container.
+
+Only responses that say how long they stay fresh, with ``Cache-Control: s-maxage`` or ``max-age`` or with ``Expires``,
+are stored. Nothing is cached heuristically, so an application that sends no caching headers is unaffected.
+"""
+import email.utils
+import threading
+import time
+from collections import OrderedDict
+
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+__all__ = ['ResponseCache', 'freshness_lifetime']
+
+Headers = List[Tuple[bytes, bytes]]
+CachedResponse = Tuple[bytes, Headers, bytes]
+
+# The status codes that are cacheable by default, see RFC 7231 section 6.1.
+CACHEABLE_STATUSES = frozenset([200, 203, 204, 300, 301, 404, 405, 410, 414, 501])
+CACHEABLE_METHODS = frozenset(['GET', 'HEAD'])
+
+# What an entry costs on top of its headers and body, roughly.
+ENTRY_OVERHEAD = 256
+
+
+class _Entry(object):
+    __slots__ = ('key', 'base', 'status', 'headers', 'body', 'stored', 'expires', 'age', 'size')
+
+    def __init__(self, key: tuple, base: tuple, status: bytes, headers: Headers, body: bytes, stored: float,
+                 lifetime: float, age: float):
+        self.key = key
+        self.base = base
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.stored = stored
+        self.expires = stored + lifetime - age
+        self.age = age
+        self.size = _entry_size(headers, body)
+
+
+class ResponseCache(object):
+    """
+    Responses by method, path, query string and the request headers that their ``Vary`` header names.
+
+    The least recently used responses are dropped when the cache holds more than ``max_bytes``. Responses marked
+    ``no-store``, ``private`` or ``no-cache``, responses that set cookies and responses with ``Vary: *`` are not
+    stored, nor are responses to requests with ``Authorization`` unless they are ``public`` or have ``s-maxage``.
+
+    :param max_bytes: the budget for headers and bodies, which has to fit in the function's memory next to PHP-FPM
+    :param clock: returns the current time in seconds since the epoch
+    """
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, clock: Callable[[], float] = time.time):
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        self._entries = OrderedDict()  # type: OrderedDict
+        # The Vary header names of the responses to each method, path and query string, with how many are stored.
+        self._vary = {}  # type: Dict[tuple, List]
+        self._lock = threading.Lock()
+
+    def lookup(self, method: str, path: str, query: str, headers: Dict[str, str]) -> Optional[CachedResponse]:
+        """
+        Find a fresh response to a request.
+
+        :return: the status, headers and body of the response with an ``Age`` header, or None
+        """
+        if method not in CACHEABLE_METHODS:
+            return None
+        base = (method, path, query)
+        now = self.clock()
+        with self._lock:
+            vary = self._vary.get(base)
+            entry = None
+            if vary is not None:
+                entry = self._entries.get(_variant_key(base, vary[0], _lower_keys(headers)))
+            if entry is None or entry.expires <= now:
+                if entry is not None:
+                    self._remove(entry)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(entry.key)
+            self.hits += 1
+
+        age = int(entry.age + max(now - entry.stored, 0))
+        return entry.status, entry.headers + [(b'age', b'%d' % age)], entry.body
+
+    def store(self, method: str, path: str, query: str, request_headers: Dict[str, str], status: bytes,
+              headers: Headers, body: Union[bytes, memoryview]) -> bool:
+        """
+        Store a response if it may be cached.
+
+        :param status: the status line, as returned by ``parse_out``
+        :param headers: the lowercased response headers, as returned by ``parse_out``
+        :return: whether the response was stored
+        """
+        if method not in CACHEABLE_METHODS:
+            return False
+        try:
+            if int(status.split(None, 1)[0]) not in CACHEABLE_STATUSES:
+                return False
+        except (IndexError, ValueError):
+            return False
+
+        request_headers = _lower_keys(request_headers)
+        now = self.clock()
+        lifetime = freshness_lifetime(headers, now, shared=True)
+        if lifetime is None:
+            return False
+        directives = _cache_control(headers)
+        if 'authorization' in request_headers and 'public' not in directives and 's-maxage' not in directives:
+            return False
+
+        vary = []
+        age = 0.0
+        stored_headers = []
+        for name, value in headers:
+            if name == b'set-cookie':
+                return False
+            elif name == b'vary':
+                vary.extend(str(v, 'latin-1').strip().lower() for v in value.split(b','))
+            elif name == b'age':
+                try:
+                    age = float(int(value))
+                except ValueError:
+                    pass
+                continue
+            stored_headers.append((name, value))
+        if '*' in vary:
+            return False
+        if lifetime <= age:
+            return False
+
+        base = (method, path, query)
+        vary_names = tuple(sorted(set(name for name in vary if name)))
+        if _entry_size(stored_headers, body) > self.max_bytes:
+            return False
+        # The body may be a view of a buffer that does not outlive the request.
+        entry = _Entry(_variant_key(base, vary_names, request_headers), base, status, stored_headers, bytes(body), now,
+                       lifetime, age)
+
+        with self._lock:
+            previous = self._entries.get(entry.key)
+            if previous is not None:
+                self._remove(previous)
+            known = self._vary.get(base)
+            if known is None or known[0] != vary_names:
+                # Responses stored with other Vary names cannot be found any more, they are evicted in time.
+                self._vary[base] = known = [vary_names, 0 if known is None else known[1]]
+            known[1] += 1
+            self._entries[entry.key] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries.values())))
+                self.evictions += 1
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._vary.clear()
+            self.size = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _remove(self, entry: _Entry):
+        del self._entries[entry.key]
+        self.size -= entry.size
+        known = self._vary.get(entry.base)
+        if known is not None:
+            known[1] -= 1
+            if known[1] <= 0:
+                del self._vary[entry.base]
+
+
+def freshness_lifetime(headers: Headers, now: float, shared: bool = True) -> Optional[float]:
+    """
+    How many seconds a response stays fresh, see RFC 7234 section 4.2.1.
+
+    :param headers: the lowercased response headers
+    :param now: the time the response was received, used when it has no ``Date`` header
+    :param shared: whether ``s-maxage`` applies and ``private`` responses are refused
+    :return: the lifetime, or None if the response must not be stored or has no explicit lifetime
+    """
+    directives = _cache_control(headers)
+    if 'no-store' in directives or 'no-cache' in directives or (shared and 'private' in directives):
+        return None
+    for name in ('s-maxage', 'max-age') if shared else ('max-age',):
+        if name in directives:
+            try:
+                return float(int(directives[name]))
+            except (TypeError, ValueError):
+                return None
+
+    headers_dict = dict(headers)
+    if b'expires' in headers_dict:
+        expires = _parse_date(headers_dict[b'expires'])
+        if expires is None:
+            # An invalid date means already expired.
+            return None
+        date = _parse_date(headers_dict[b'date']) if b'date' in headers_dict else None
+        return expires - (now if date is None else date)
+    return None
+
+
+def _cache_control(headers: Headers) -> Dict[str, Optional[str]]:
+    directives = {}  # type: Dict[str, Optional[str]]
+    for name, value in headers:
+        if name != b'cache-control':
+            continue
+        for directive in str(value, 'latin-1').split(','):
+            key, _, argument = directive.strip().partition('=')
+            if key:
+                directives[key.lower()] = argument.strip('"') if argument else None
+    return directives
+
+
+def _parse_date(value: bytes) -> Optional[float]:
+    try:
+        return email.utils.parsedate_to_datetime(str(value, 'latin-1')).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def _entry_size(headers: Headers, body: Union[bytes, memoryview]) -> int:
+    return ENTRY_OVERHEAD + len(body) + sum(len(k) + len(v) for k, v in headers)
+
+
+def _lower_keys(headers: Dict[str, str]) -> Dict[str, str]:
+    return {k.lower(): v for k, v in headers.items()}
+
+
+def _variant_key(base: tuple, vary: Tuple[str, ...], headers: Dict[str, str]) -> tuple:
+    return base + tuple(headers.get(name) for name in vary)
@@ -0,0 +1,74 @@
+"""
+Mapping request paths to PHP scripts without touching the filesystem.
+
+The deployment package is read-only, so the document root is indexed once and every request is resolved with a
+dictionary lookup.
+"""
+import os
+import posixpath
+
+from typing import Dict, NamedTuple
+
+__all__ = ['Route', 'RouteIndex']
+
+
+class Route(NamedTuple):
+    script_filename: str
+    script_name: str
+    path_info: str = ''
+
+
+class RouteIndex(object):
+    """
+    The files below a document root, by request path.
+
+    A path that names a file resolves to that file. Any other path goes to the front controller with the path as
+    ``PATH_INFO``. The PHP-FPM ``/ping`` and ``/status`` pages are passed through as they are.
+
+    Paths are only ever looked up, never joined to the document root, so a path with ``..`` cannot escape it.
+
+    :param document_root: the directory that holds the front controller
+    :param front_controller: the script that handles paths that are not files, relative to the document root
+    :param rebuild_on_miss: rescan the document root before falling back to the front controller, for local
+        development where files are added while the function runs
+    """
+
+    specials = ('/ping', '/status')
+
+    def __init__(self, document_root: str, front_controller: str = 'index.php', rebuild_on_miss: bool = False):
+        self.document_root = document_root.rstrip('/')
+        self.front_controller = '/' + front_controller.lstrip('/')
+        self.rebuild_on_miss = rebuild_on_miss
+        self._routes = {}  # type: Dict[str, Route]
+        self.rebuild()
+
+    def rebuild(self):
+        """Scan the document root again."""
+        routes = {path: Route(path, path) for path in self.specials}
+        for directory, _, files in os.walk(self.document_root):
+            prefix = directory[len(self.document_root):].replace(os.sep, '/')
+            for name in files:
+                path = prefix + '/' + name
+                routes[path] = Route(self.document_root + path, path)
+        self._routes = routes
+
+    def resolve(self, path: str) -> Route:
+        route = self._lookup(path)
+        if route is None and self.rebuild_on_miss:
+            self.rebuild()
+            route = self._lookup(path)
+        if route is None:
+            route = Route(self.document_root + self.front_controller, self.front_controller, path)
+        return route
+
+    def __contains__(self, path: str) -> bool:
+        return self._lookup(path) is not None
+
+    def __len__(self) -> int:
+        return len(self._routes)
+
+    def _lookup(self, path: str):
+        route = self._routes.get(path)
+        if route is None and ('//' in path or '/.' in path):
+            route = self._routes.get('/' + posixpath.normpath(path).lstrip('/'))
+        return route
@@ -0,0 +1,306 @@
+"""
+Serving the PHP application over HTTP, outside of Lambda.
+
+Requests go through the same route index, static files and event translation as in app.main, but to a PHP-FPM with
+several children through a FastCgiClient, so that requests are answered concurrently. This runs the application in a
+container on a multi-core host, or locally for load tests.
+
+Run with ``python server.py [--host HOST] [--port PORT] [--children N] [--revalidate] [TASK_ROOT]``.
+"""
+import argparse
+import asyncio
+import base64
+import logging
+import os
+import tempfile
+import urllib.parse
+from http import HTTPStatus
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from apigateway import ParamsBuilder, keep_body_for
+from fcgi_client import FastCgiClient, ProtocolError, RequestTimeout, parse_out
+from logs import log_php_stderr
+from php_fpm import PhpFpm, PhpFpmSupervisor, make_fpm_config, pool_size
+from routes import RouteIndex
+from static import StaticFiles
+
+__all__ = ['HttpServer', 'main']
+
+logger = logging.getLogger(__name__)
+
+Headers = List[Tuple[bytes, bytes]]
+
+MAX_HEADER_SIZE = 65536
+
+# Headers that belong to one connection, which are set by the server.
+HOP_BY_HOP_HEADERS = frozenset([b'connection', b'keep-alive', b'transfer-encoding', b'content-length'])
+
+
+class HttpError(Exception):
+    def __init__(self, status: HTTPStatus):
+        super().__init__(status.phrase)
+        self.status = status
+
+
+class HttpServer(object):
+    """
+    An HTTP/1.1 server in front of PHP-FPM.
+
+    Connections are kept alive, and request bodies may be sent with a Content-Length or chunked. Responses have a
+    Content-Length, except for HEAD requests, whose body PHP-FPM's output is not kept.
+
+    :param client: the client of PHP-FPM
+    :param routes: the routes of the document root
+    :param static_files: answers requests for static files, if set
+    :param supervisor: the supervisor of PHP-FPM, to answer 503 while PHP-FPM is restarted
+    :param max_body_size: the largest request body accepted
+    :param params_builder: builds the FastCGI params, as in app.main (default: one for the routes' document root)
+    """
+
+    def __init__(self, client: FastCgiClient, routes: RouteIndex, static_files: Optional[StaticFiles] = None,
+                 supervisor: Optional[PhpFpmSupervisor] = None, max_body_size: int = 64 * 1024 * 1024,
+                 params_builder: Optional[ParamsBuilder] = None):
+        self.client = client
+        self.routes = routes
+        self.params_builder = params_builder or ParamsBuilder(routes.document_root)
+        self.static_files = static_files
+        self.supervisor = supervisor
+        self.max_body_size = max_body_size
+
+    async def serve(self, host: str, port: int):
+        """Start listening and return the ``asyncio.AbstractServer``."""
+        return await asyncio.start_server(self.handle_connection, host, port, limit=MAX_HEADER_SIZE)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer = writer.get_extra_info('peername')
+        sock = writer.get_extra_info('sockname')
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except asyncio.IncompleteReadError:
+                    return
+                except asyncio.LimitOverrunError:
+                    await self._write_error(writer, HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+                    return
+
+                try:
+                    method, target, version, headers = _parse_request_head(head)
+                    if headers.get('expect', '').lower() == '100-continue':
+                        writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+                    body = await self._read_body(reader, headers)
+                except HttpError as e:
+                    await self._write_error(writer, e.status)
+                    return
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    return
+
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+                server = {
+                    'SERVER_PROTOCOL': version,
+                    'REQUEST_URI': target,
+                    'REMOTE_ADDR': str(peer[0]) if isinstance(peer, tuple) else '',
+                    'REMOTE_PORT': str(peer[1]) if isinstance(peer, tuple) else '',
+                    'SERVER_ADDR': str(sock[0]) if isinstance(sock, tuple) else '',
+                    'SERVER_PORT': str(sock[1]) if isinstance(sock, tuple) else '',
+                }
+                status, response_headers, response_body = await self.respond(method, target, headers, body, server)
+                await self._write_response(writer, method, status, response_headers, response_body, keep_alive)
+                if not keep_alive:
+                    return
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, method: str, target: str, headers: Dict[str, str], body: bytes,
+                      server: Dict[str, str]) -> Tuple[bytes, Headers, bytes]:
+        """
+        Answer a request.
+
+        :param headers: the request headers, by lowercased name
+        :param server: more FastCGI params, such as ``REMOTE_ADDR``
+        :return: the status line, headers and body of the response
+        """
+        path, _, query = target.partition('?')
+        path = urllib.parse.unquote(path)
+        route = self.routes.resolve(path)
+
+        if self.static_files is not None:
+            response = self.static_files.serve(route, method, headers)
+            if response is not None:
+                return _from_proxy_response(response)
+
+        # The body and query string are sent as they came, not as API
+        # Gateway would have decoded them.
+        event = {'httpMethod': method, 'path': path, 'headers': headers, 'queryStringParameters': None, 'body': None}
+        server = dict(server, QUERY_STRING=query)
+        if body or 'content-length' in headers or 'transfer-encoding' in headers:
+            server['CONTENT_LENGTH'] = str(len(body))
+        params, _ = self.params_builder.build(event, route, server)
+
+        if self.supervisor is not None and not self.supervisor.running:
+            return _error_response(HTTPStatus.SERVICE_UNAVAILABLE)
+        try:
+            out, err = await self.client.request(params, body, on_headers=keep_body_for(method))
+        except (asyncio.TimeoutError, RequestTimeout):
+            logger.error('PHP-FPM did not answer %s %s in time', method, path)
+            return _error_response(HTTPStatus.GATEWAY_TIMEOUT)
+        except (OSError, ProtocolError) as e:
+            # Such as a refused connection, or no socket while PHP-FPM is
+            # restarted.
+            logger.error('PHP-FPM failed on %s %s: %s', method, path, e)
+            return _error_response(HTTPStatus.BAD_GATEWAY)
+        if err:
+            log_php_stderr(logger, err, path=path)
+
+        status, response_headers, response_body = parse_out(out)
+        return status, response_headers, response_body
+
+    async def _read_body(self, reader: asyncio.StreamReader, headers: Dict[str, str]) -> bytes:
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            size = 0
+            while True:
+                line = await reader.readuntil(b'\r\n')
+                try:
+                    length = int(line.split(b';', 1)[0], 16)
+                except ValueError:
+                    raise HttpError(HTTPStatus.BAD_REQUEST)
+                if length == 0:
+                    # Trailers are read and dropped.
+                    while await reader.readuntil(b'\r\n') != b'\r\n':
+                        pass
+                    return b''.join(chunks)
+                size += length
+                if size > self.max_body_size:
+                    raise HttpError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+                chunks.append(await reader.readexactly(length))
+                await reader.readexactly(2)
+        elif 'transfer-encoding' in headers:
+            raise HttpError(HTTPStatus.NOT_IMPLEMENTED)
+
+        try:
+            length = int(headers.get('content-length', '0'))
+        except ValueError:
+            raise HttpError(HTTPStatus.BAD_REQUEST)
+        if length < 0:
+            raise HttpError(HTTPStatus.BAD_REQUEST)
+        if length > self.max_body_size:
+            raise HttpError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        return await reader.readexactly(length) if length else b''
+
+    async def _write_response(self, writer: asyncio.StreamWriter, method: str, status: bytes, headers: Headers,
+                              body: bytes, keep_alive: bool):
+        lines = [b'HTTP/1.1 ' + status]
+        lines.extend(name + b': ' + value for name, value in headers if name not in HOP_BY_HOP_HEADERS)
+        code = status[:3]
+        if method != 'HEAD' and not code.startswith(b'1') and code not in (b'204', b'304'):
+            lines.append(b'content-length: %d' % len(body))
+        if not keep_alive:
+            lines.append(b'connection: close')
+        lines.append(b'\r\n')
+        writer.write(b'\r\n'.join(lines))
+        if method != 'HEAD' and body:
+            writer.write(body)
+        await writer.drain()
+
+    async def _write_error(self, writer: asyncio.StreamWriter, status: HTTPStatus):
+        status_line, headers, body = _error_response(status)
+        await self._write_response(writer, 'GET', status_line, headers, body, keep_alive=False)
+
+
+def _parse_request_head(head: bytes) -> Tuple[str, str, str, Dict[str, str]]:
+    lines = str(head, 'latin-1').split('\r\n')
+    try:
+        method, target, version = lines[0].split(' ')
+    except ValueError:
+        raise HttpError(HTTPStatus.BAD_REQUEST)
+    if version not in ('HTTP/1.0', 'HTTP/1.1'):
+        raise HttpError(HTTPStatus.HTTP_VERSION_NOT_SUPPORTED)
+
+    headers = {}  # type: Dict[str, str]
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, colon, value = line.partition(':')
+        if not colon:
+            raise HttpError(HTTPStatus.BAD_REQUEST)
+        name = name.strip().lower()
+        value = value.strip()
+        if name in headers:
+            # Repeated headers are one comma separated list, except cookies.
+            value = headers[name] + ('; ' if name == 'cookie' else ', ') + value
+        headers[name] = value
+    return method, target, version, headers
+
+
+def _from_proxy_response(response: Dict[str, Any]) -> Tuple[bytes, Headers, bytes]:
+    status = HTTPStatus(response['statusCode'])
+    headers = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+               for name, value in response['headers'].items()]
+    if response.get('isBase64Encoded'):
+        body = base64.b64decode(response['body'])
+    else:
+        body = response['body'].encode('utf-8')
+    return b'%d %s' % (status.value, status.phrase.encode('ascii')), headers, body
+
+
+def _error_response(status: HTTPStatus) -> Tuple[bytes, Headers, bytes]:
+    return (b'%d %s' % (status.value, status.phrase.encode('ascii')), [(b'content-type', b'text/plain')],
+            status.phrase.encode('ascii') + b'\n')
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Serve the PHP application over HTTP with PHP-FPM.')
+    parser.add_argument('task_root', nargs='?', default=os.path.dirname(os.path.abspath(__file__)),
+                        help='the directory that contains php-fpm and php (default: this directory)')
+    parser.add_argument('--host', default='127.0.0.1', help='the address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8000, help='the port to listen on (default: 8000)')
+    parser.add_argument('--children', type=int, default=None,
+                        help='the number of PHP-FPM children (default: as many as the memory and CPUs allow)')
+    parser.add_argument('--timeout', type=float, default=None, help='seconds to wait for PHP-FPM per request')
+    parser.add_argument('--revalidate', action='store_true',
+                        help='pick up edited and added files on every request, for local development')
+    args = parser.parse_args(argv)
+    task_root = os.path.abspath(args.task_root)
+    children = args.children or pool_size()
+
+    logging.basicConfig(level=logging.INFO, format='%(name)s - %(levelname)s - %(message)s')
+
+    with tempfile.TemporaryDirectory() as directory:
+        socket_path = os.path.join(directory, 'fpm.sock')
+        fpm_config = os.path.join(directory, 'php-fpm.conf')
+        with open(fpm_config, 'w') as f:
+            f.write(make_fpm_config(socket_path, children))
+
+        php_fpm = PhpFpm(task_root, socket_path, fpm_config=fpm_config, file_cache=os.path.join(directory, 'opcache'),
+                         revalidate=args.revalidate)
+        supervisor = PhpFpmSupervisor(php_fpm)
+        supervisor.start()
+        try:
+            loop = asyncio.get_event_loop()
+            # Each child stays attached to a kept-alive connection, so there
+            # is one connection per child.
+            client = FastCgiClient(socket_path, max_connections=children, timeout=args.timeout, loop=loop)
+            document_root = task_root + '/php/public'
+            server = HttpServer(client, RouteIndex(document_root, rebuild_on_miss=args.revalidate),
+                                StaticFiles(document_root, revalidate=args.revalidate), supervisor)
+            http = loop.run_until_complete(server.serve(args.host, args.port))
+            logger.info('Listening on http://%s:%d/ with %d PHP-FPM children', args.host, args.port, children)
+            try:
+                loop.run_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                http.close()
+                loop.run_until_complete(http.wait_closed())
+                loop.run_until_complete(client.close())
+        finally:
+            supervisor.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""
+Serving the files under the document root that are not PHP scripts, without PHP-FPM.
+
+PHP-FPM has as many children as the function's memory and CPUs allow, which is few, so every stylesheet or image it
+reads takes a child that a PHP request could have had. The files are read once and kept in memory, up to a byte
+budget, with their ETag and Last-Modified values.
+"""
+import email.utils
+import mimetypes
+import os
+import threading
+from collections import OrderedDict
+
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from apigateway import response_body
+from routes import Route
+
+__all__ = ['StaticFiles']
+
+
+class _File(object):
+    __slots__ = ('filename', 'size', 'mtime', 'etag', 'headers')
+
+    def __init__(self, filename: str, size: int, mtime: float):
+        content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        self.filename = filename
+        self.size = size
+        self.mtime = mtime
+        self.etag = '"%x-%x"' % (int(mtime), size)
+        self.headers = {
+            'Content-Type': content_type,
+            'ETag': self.etag,
+            'Last-Modified': email.utils.formatdate(mtime, usegmt=True),
+        }
+
+
+class StaticFiles(object):
+    """
+    :param document_root: the directory that the routes point into
+    :param max_bytes: how many bytes of encoded file contents to keep in memory; the least recently used are dropped
+    :param max_file_size: files larger than this are read on every request instead of being kept
+    :param revalidate: check the modification time of the file on every request, for local development
+    :param script_extensions: the extensions of the files that PHP-FPM runs
+    """
+
+    def __init__(self, document_root: str, max_bytes: int = 16 * 1024 * 1024, max_file_size: int = 1024 * 1024,
+                 revalidate: bool = False, script_extensions: Iterable[str] = ('.php',)):
+        self.document_root = document_root.rstrip('/')
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.revalidate = revalidate
+        self.script_extensions = frozenset(script_extensions)
+        self.hits = 0
+        self.misses = 0
+        self._files = {}  # type: Dict[str, _File]
+        self._bodies = OrderedDict()  # type: OrderedDict
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def is_static(self, route: Route) -> bool:
+        """Whether the route is a file to send as it is. Dotfiles are left to PHP-FPM, which refuses them."""
+        return (not route.path_info and route.script_filename.startswith(self.document_root + '/') and
+                os.path.splitext(route.script_name)[1] not in self.script_extensions and
+                '/.' not in route.script_name)
+
+    def serve(self, route: Route, method: str, headers: Dict[str, str]) -> Optional[Dict[str, Any]]:
+        """
+        Answer a request for a static file.
+
+        :param route: the resolved route
+        :param method: the HTTP method
+        :param headers: the request headers
+        :return: the API Gateway proxy response, or None if PHP-FPM has to answer the request
+        """
+        if method not in ('GET', 'HEAD') or not self.is_static(route):
+            return None
+        file = self._stat(route.script_filename)
+        if file is None:
+            return None
+
+        if _not_modified(file, headers):
+            return {
+                'statusCode': 304,
+                'headers': {'ETag': file.etag, 'Last-Modified': file.headers['Last-Modified']},
+                'multiValueHeaders': {},
+                'body': '',
+                'isBase64Encoded': False,
+            }
+
+        body, is_base64 = ('', False) if method == 'HEAD' else self._body(file)
+        return {
+            'statusCode': 200,
+            'headers': dict(file.headers),
+            'multiValueHeaders': {},
+            'body': body,
+            'isBase64Encoded': is_base64,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._files.clear()
+            self._bodies.clear()
+            self._bytes = 0
+
+    def _stat(self, filename: str) -> Optional[_File]:
+        file = self._files.get(filename)
+        if file is not None and not self.revalidate:
+            return file
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        if file is None or (file.size, file.mtime) != (stat.st_size, stat.st_mtime):
+            file = _File(filename, stat.st_size, stat.st_mtime)
+            with self._lock:
+                self._files[filename] = file
+                self._forget(filename)
+        return file
+
+    def _body(self, file: _File) -> Tuple[str, bool]:
+        with self._lock:
+            cached = self._bodies.get(file.filename)
+            if cached is not None:
+                self._bodies.move_to_end(file.filename)
+                self.hits += 1
+                return cached
+            self.misses += 1
+
+        with open(file.filename, 'rb') as f:
+            body = response_body(f.read(), file.headers['Content-Type'])
+
+        if file.size <= self.max_file_size:
+            with self._lock:
+                self._forget(file.filename)
+                self._bodies[file.filename] = body
+                self._bytes += len(body[0])
+                while self._bytes > self.max_bytes:
+                    _, (evicted, _) = self._bodies.popitem(last=False)
+                    self._bytes -= len(evicted)
+        return body
+
+    def _forget(self, filename: str):
+        body = self._bodies.pop(filename, None)
+        if body is not None:
+            self._bytes -= len(body[0])
+
+
+def _not_modified(file: _File, headers: Dict[str, str]) -> bool:
+    if_none_match = if_modified_since = None
+    for name, value in headers.items():
+        name = name.lower()
+        if name == 'if-none-match':
+            if_none_match = value
+        elif name == 'if-modified-since':
+            if_modified_since = value
+
+    # If-None-Match takes precedence, see RFC 7232 section 6.
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or any((tag[2:] if tag.startswith('W/') else tag) == file.etag for tag in tags)
+    if if_modified_since is not None:
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(file.mtime) <= since
+    return False
@@ -1,6 +1,9 @@
 resource "aws_api_gateway_rest_api" "always_already" {
   name        = "PHP-Was-Always-Already-Serverless"
   description = "You'll never win if you spawn a process on each invocation"
+
+  # Pass every body through as base64, app.py decides which responses are text.
+  binary_media_types = ["*/*"]
 }
 
 resource "aws_api_gateway_resource" "proxy" {
@@ -1,3 +1,9 @@
+# Seconds an invocation may run. PHP-FPM kills a request that runs longer,
+# which frees a child from a request that timed out.
+variable "function_timeout" {
+  default = 10
+}
+
 resource "aws_lambda_function" "always_already" {
   function_name = "php-was-always-already-serverless"
 
@@ -13,12 +19,13 @@ resource "aws_lambda_function" "always_already" {
   runtime = "python3.6"
 
   role        = "${aws_iam_role.lambda_exec.arn}"
-  timeout     = 10
+  timeout     = "${var.function_timeout}"
   memory_size = 128
 
   environment {
     variables {
-      SHELL_VERBOSITY = "3"
+      SHELL_VERBOSITY     = "3"
+      PHP_REQUEST_TIMEOUT = "${var.function_timeout}"
     }
   }
 }
@@ -0,0 +1,155 @@
+import base64
+import unittest
+
+from apigateway import (ParamsBuilder, find_header, is_text, make_fcgi_params_and_input_from_event, proxy_response,
+                        request_body, response_body, response_headers)
+from fcgi_client import decode_name_value_pairs
+from routes import Route
+
+
+class RequestBodyTestCase(unittest.TestCase):
+    def test_none(self):
+        self.assertEqual(b'', request_body({'body': None, 'headers': {}}))
+
+    def test_base64(self):
+        body = b'\x1f\x8b\x08\x00binary\xff'
+        self.assertEqual(body, request_body({'body': str(base64.b64encode(body), 'ascii'), 'isBase64Encoded': True,
+                                             'headers': {'Content-Type': 'application/octet-stream'}}))
+
+    def test_text(self):
+        self.assertEqual('été'.encode('utf-8'), request_body({'body': 'été', 'headers': {
+            'Content-Type': 'application/x-www-form-urlencoded'}}))
+        self.assertEqual('été'.encode('iso-8859-1'), request_body({'body': 'été', 'headers': {
+            'content-type': 'text/plain; charset=ISO-8859-1'}}))
+        self.assertEqual(b'{}', request_body({'body': '{}', 'headers': None}))
+        self.assertEqual(b'x', request_body({'body': 'x', 'headers': {'Content-Type': 'text/plain; charset=nope'}}))
+
+
+class ResponseBodyTestCase(unittest.TestCase):
+    def test_text(self):
+        self.assertEqual(('été', False), response_body('été'.encode('utf-8'), 'text/html'))
+        self.assertEqual(('été', False), response_body('été'.encode('iso-8859-1'), 'text/html; charset=iso-8859-1'))
+        self.assertEqual(('{}', False), response_body(memoryview(b'{}'), 'application/json'))
+        self.assertEqual(('{}', False), response_body(b'{}', 'application/problem+json'))
+
+    def test_binary(self):
+        body = b'\x89PNG\r\n\x1a\n'
+        self.assertEqual((str(base64.b64encode(body), 'ascii'), True), response_body(body, 'image/png'))
+        self.assertEqual((str(base64.b64encode(body), 'ascii'), True), response_body(memoryview(body), None))
+
+    def test_undecodable_text(self):
+        self.assertEqual(('/w==', True), response_body(b'\xff', 'text/plain'))
+
+    def test_compressed_text(self):
+        self.assertEqual(('aGk=', True), response_body(b'hi', 'text/html', 'gzip'))
+        self.assertEqual(('hi', False), response_body(b'hi', 'text/html', 'identity'))
+
+
+class EventTestCase(unittest.TestCase):
+    def test_make_fcgi_params_and_input_from_event(self):
+        event = {
+            'httpMethod': 'POST',
+            'path': '/blog/hello',
+            'headers': {'Content-Type': 'application/json', 'X-Forwarded-For': '10.0.0.1'},
+            'queryStringParameters': {'page': '2'},
+            'body': '{}',
+        }
+        params, input = make_fcgi_params_and_input_from_event(event, Route('/var/task/php/public/index.php',
+                                                                           '/index.php', '/blog/hello'))
+        self.assertEqual({
+            'CONTENT_TYPE': 'application/json',
+            'HTTP_X_FORWARDED_FOR': '10.0.0.1',
+            'SCRIPT_NAME': '/index.php',
+            'SCRIPT_FILENAME': '/var/task/php/public/index.php',
+            'PATH_INFO': '/blog/hello',
+            'REQUEST_METHOD': 'POST',
+            'QUERY_STRING': 'page=2',
+            'CONTENT_LENGTH': '2',
+        }, params)
+        self.assertEqual(b'{}', input)
+
+    def test_params_builder(self):
+        event = {
+            'httpMethod': 'POST',
+            'path': '/blog/hello',
+            'headers': {'Content-Type': 'application/json', 'Content-Length': '99', 'X-Forwarded-For': '10.0.0.1',
+                        'Cookie': 'session=' + 'x' * 300},
+            'queryStringParameters': {'page': '2'},
+            'body': '{}',
+        }
+        route = Route('/var/task/php/public/index.php', '/index.php', '/blog/hello')
+        params, input = ParamsBuilder('/var/task/php/public').build(event, route)
+
+        expected, _ = make_fcgi_params_and_input_from_event(event, route)
+        expected.update({
+            'GATEWAY_INTERFACE': 'CGI/1.1',
+            'SERVER_SOFTWARE': 'php-was-always-already-serverless',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'DOCUMENT_ROOT': '/var/task/php/public',
+        })
+        pairs = decode_name_value_pairs(params)
+        self.assertEqual(expected, dict(pairs))
+        self.assertEqual(len(expected), len(pairs))
+        self.assertEqual(b'{}', input)
+
+    def test_params_builder_colliding_headers(self):
+        event = {
+            'httpMethod': 'GET',
+            'path': '/',
+            'headers': {'X-Forwarded-For': '10.0.0.1', 'x-forwarded-for': '10.0.0.2', 'X_Forwarded_For': '10.0.0.3',
+                        'Accept': 'text/html'},
+            'queryStringParameters': None,
+            'body': None,
+        }
+        route = Route('/var/task/php/public/index.php', '/index.php')
+        params, _ = ParamsBuilder('/var/task/php/public').build(event, route)
+
+        expected, _ = make_fcgi_params_and_input_from_event(event, route)
+        pairs = [(name, value) for name, value in decode_name_value_pairs(params) if name.startswith('HTTP_')]
+        self.assertEqual([('HTTP_X_FORWARDED_FOR', '10.0.0.3'), ('HTTP_ACCEPT', 'text/html')], pairs)
+        self.assertEqual({name: value for name, value in expected.items() if name.startswith('HTTP_')}, dict(pairs))
+
+    def test_params_builder_keeps_short_headers(self):
+        builder = ParamsBuilder('/var/task/php/public')
+        route = Route('/var/task/php/public/index.php', '/index.php')
+        for user_agent in ('curl/7.61.0', 'curl/7.61.0', 'Wget/1.19'):
+            event = {'httpMethod': 'GET', 'path': '/', 'headers': {'User-Agent': user_agent},
+                     'queryStringParameters': None, 'body': None}
+            params, _ = builder.build(event, route)
+            self.assertEqual(user_agent, dict(decode_name_value_pairs(params))['HTTP_USER_AGENT'])
+
+        self.assertEqual(1, builder._cached_header.cache_info().hits)
+
+    def test_proxy_response(self):
+        headers = [(b'content-type', b'text/plain'), (b'set-cookie', b'a=1'), (b'set-cookie', b'b=2')]
+        self.assertEqual({
+            'statusCode': 404,
+            'headers': {'content-type': 'text/plain'},
+            'multiValueHeaders': {'set-cookie': ['a=1', 'b=2']},
+            'body': 'nope',
+            'isBase64Encoded': False,
+        }, proxy_response(b'404 Not Found', headers, memoryview(b'nope')))
+
+
+class HelpersTestCase(unittest.TestCase):
+    def test_is_text(self):
+        self.assertTrue(is_text('text/css'))
+        self.assertTrue(is_text('Application/JSON; charset=utf-8'))
+        self.assertTrue(is_text('image/svg+xml'))
+        self.assertFalse(is_text('image/png'))
+        self.assertFalse(is_text('application/pdf'))
+
+    def test_find_header(self):
+        headers = [(b'content-type', b'text/html'), (b'set-cookie', b'a=b')]
+        self.assertEqual('text/html', find_header(headers, b'content-type'))
+        self.assertIsNone(find_header(headers, b'content-encoding'))
+
+    def test_response_headers(self):
+        headers = [(b'set-cookie', b'a=1'), (b'content-type', b'text/html'), (b'set-cookie', b'b=2'),
+                   (b'set-cookie', b'c=3')]
+        self.assertEqual(({'content-type': 'text/html'}, {'set-cookie': ['a=1', 'b=2', 'c=3']}),
+                         response_headers(headers))
+
+
+if __name__ == '__main__':
+    unittest.main()
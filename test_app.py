@@ -0,0 +1,234 @@
+import base64
+import gzip
+import importlib
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+from fcgi_client import FCGIApp
+from php_fpm import PhpFpmError
+from fcgi_test_server import FCGITestServer
+from response_cache import ResponseCache
+
+MiB = 1024 * 1024
+
+# app.py sets up PHP-FPM and the log pipeline when it is imported, so it is
+# imported by setUpModule with a task root of its own and no PHP-FPM.
+app = None
+task_root = None
+log_stream = io.StringIO()
+root_handlers = []
+
+
+def setUpModule():
+    global app, task_root
+    task_root = tempfile.TemporaryDirectory()
+    public = os.path.join(task_root.name, 'php', 'public')
+    os.makedirs(public)
+    for name, content in (('index.php', b'<?php'), ('style.css', b'body {}'), ('large.bin', b'\0' * 5 * MiB)):
+        with open(os.path.join(public, name), 'wb') as f:
+            f.write(content)
+
+    root_handlers[:] = logging.getLogger().handlers
+    with unittest.mock.patch.dict(os.environ, {'LAMBDA_TASK_ROOT': task_root.name}), \
+            unittest.mock.patch('php_fpm.PhpFpmSupervisor'), unittest.mock.patch('sys.stdout', log_stream):
+        app = importlib.import_module('app')
+
+
+def tearDownModule():
+    root = logging.getLogger()
+    root.removeHandler(app.log_pipeline.queue_handler)
+    for handler in root_handlers:
+        root.addHandler(handler)
+    task_root.cleanup()
+
+
+class Context(object):
+    aws_request_id = 'test'
+
+    def __init__(self, remaining_ms=30000):
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms
+
+
+class MainTestCase(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        self.fpm = FCGITestServer(self.php)
+        self.fpm.start()
+        self.addCleanup(self.fpm.stop)
+
+        fcgi_app = FCGIApp(connect=self.fpm.address, keep_alive=True, pool_size=1)
+        self.addCleanup(fcgi_app.close)
+        for name, value in (('app', fcgi_app), ('compressor', None), ('response_cache', None),
+                            ('metrics_namespace', None), ('server_timing', False)):
+            patcher = unittest.mock.patch.object(app, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def php(self, params, stdin):
+        path = params.get('PATH_INFO', '/')
+        if path == '/stall':
+            self.release.wait(5)
+        if path == '/die':
+            raise ConnectionAbortedError
+        if path == '/accents':
+            return b'Content-type: text/plain; charset=UTF-8\r\n\r\n' + '\u00e9'.encode() * 2 * MiB, b''
+        if path == '/broken':
+            return b'X-Large: ' + b'x' * 70000, b''
+        if path == '/large':
+            return b'Content-type: text/html\r\n\r\n' + b'<p>Hello, world!</p>\n' * (7 * MiB // 21), b''
+        if path == '/image':
+            return b'Content-type: image/png\r\n\r\n' + b'\0' * 7 * MiB, b''
+        headers = b'Content-type: text/html\r\n'
+        if path == '/cached':
+            headers += b'Cache-Control: max-age=60\r\n'
+        return headers + b'\r\n<p>%s %s</p>' % (params['REQUEST_METHOD'].encode(), path.encode()), b''
+
+    def request(self, path, method='GET', headers=None, context=None):
+        event = {'httpMethod': method, 'path': path, 'headers': headers, 'queryStringParameters': None,
+                 'body': None}
+        return app.main(event, context or Context())
+
+    def test_php(self):
+        response = self.request('/hello')
+
+        self.assertEqual(200, response['statusCode'])
+        self.assertEqual('text/html', response['headers']['content-type'])
+        self.assertEqual('<p>GET /hello</p>', response['body'])
+
+    def test_head(self):
+        response = self.request('/hello', 'HEAD')
+
+        self.assertEqual(200, response['statusCode'])
+        self.assertEqual('text/html', response['headers']['content-type'])
+        self.assertEqual('', response['body'])
+
+    def test_static(self):
+        response = self.request('/style.css')
+
+        self.assertEqual(200, response['statusCode'])
+        self.assertEqual('body {}', response['body'])
+        self.assertEqual(0, self.fpm.requests)
+
+    def test_static_too_large(self):
+        # 5 MiB is more than 6 MiB once it is base64-encoded.
+        self.assertEqual(502, self.request('/large.bin')['statusCode'])
+
+    def test_response_too_large(self):
+        response = self.request('/large')
+
+        self.assertEqual(502, response['statusCode'])
+        self.assertEqual('Bad Gateway\n', response['body'])
+
+    def test_encoded_response_too_large(self):
+        # 4 MiB of UTF-8, but 12 MiB of JSON.
+        self.assertEqual(502, self.request('/accents')['statusCode'])
+
+    def test_timeout(self):
+        # The deadline is 100 ms away, after the 500 ms margin.
+        response = self.request('/stall', context=Context(remaining_ms=600))
+        self.assertEqual(504, response['statusCode'])
+        self.assertEqual([1], self.fpm.aborted)
+        self.release.set()
+
+        self.assertEqual(200, self.request('/hello')['statusCode'])
+
+    def test_php_fpm_down(self):
+        with unittest.mock.patch.object(app.supervisor, 'ensure_running',
+                                        side_effect=PhpFpmError('PHP-FPM is not running')):
+            response = self.request('/hello')
+
+        self.assertEqual(503, response['statusCode'])
+        self.assertEqual(0, self.fpm.requests)
+
+    def test_no_socket(self):
+        with tempfile.TemporaryDirectory() as directory:
+            fcgi_app = FCGIApp(connect=os.path.join(directory, 'fpm.sock'), keep_alive=True, pool_size=1)
+            with unittest.mock.patch.object(app, 'app', fcgi_app):
+                response = self.request('/hello', context=Context(remaining_ms=600))
+
+        self.assertEqual(502, response['statusCode'])
+
+    def test_php_fpm_failed(self):
+        self.assertEqual(502, self.request('/die')['statusCode'])
+        self.assertEqual(502, self.request('/broken')['statusCode'])
+        self.assertEqual(200, self.request('/hello')['statusCode'])
+
+    def test_cache(self):
+        with unittest.mock.patch.object(app, 'response_cache', ResponseCache(MiB)), \
+                self.assertLogs('app', logging.INFO) as logs:
+            first = self.request('/cached')
+            second = self.request('/cached')
+
+        self.assertNotIn('age', first['headers'])
+        self.assertEqual('0', second['headers']['age'])
+        self.assertEqual(first['body'], second['body'])
+        self.assertEqual(1, self.fpm.requests)
+        self.assertEqual(['INFO:app:response cache miss, 0 hits, 1 misses',
+                          'INFO:app:response cache hit, 1 hits, 1 misses'], logs.output)
+
+    def test_compression(self):
+        with unittest.mock.patch.object(app, 'compressor', app.Compressor(1, brotli_quality=0)):
+            app.compressor.encodings = ('gzip',)
+            response = self.request('/large', headers={'Accept-Encoding': 'gzip'})
+            # The larger limit only applies to a body that is compressed, so
+            # the others are refused while they are read.
+            with self.assertLogs('app', logging.ERROR) as logs:
+                not_accepted = self.request('/large')
+                not_compressible = self.request('/image', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(200, response['statusCode'])
+        self.assertEqual('gzip', response['headers']['content-encoding'])
+        self.assertEqual(7 * MiB // 21 * 21, len(gzip.decompress(base64.b64decode(response['body']))))
+        self.assertEqual(502, not_accepted['statusCode'])
+        self.assertEqual(502, not_compressible['statusCode'])
+        self.assertEqual(['ERROR:app:GET /large: response is larger than %d bytes' % app.MAX_PAYLOAD_SIZE,
+                          'ERROR:app:GET /image: response is larger than %d bytes' % app.MAX_PAYLOAD_SIZE],
+                         logs.output)
+
+    def test_head_compression(self):
+        with unittest.mock.patch.object(app, 'compressor', app.Compressor(min_size=1, brotli_quality=0)):
+            app.compressor.encodings = ('gzip',)
+            get = self.request('/hello', headers={'Accept-Encoding': 'gzip'})
+            head = self.request('/hello', 'HEAD', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(get['headers'], head['headers'])
+        self.assertEqual('gzip', head['headers']['content-encoding'])
+        self.assertEqual('', head['body'])
+
+    def test_timings(self):
+        with unittest.mock.patch.object(app, 'server_timing', True), \
+                unittest.mock.patch.object(app, 'metrics_namespace', 'Test'):
+            response = self.request('/hello')
+
+        phases = [entry.split(';')[0] for entry in response['headers']['Server-Timing'].split(', ')]
+        self.assertEqual(['route', 'translate', 'connect', 'send', 'php', 'encode', 'total'],
+                         [phase for phase in phases if phase != 'first-byte'])
+        metrics = [json.loads(line) for line in log_stream.getvalue().splitlines() if '"_aws"' in line]
+        self.assertEqual('Test', metrics[-1]['_aws']['CloudWatchMetrics'][0]['Namespace'])
+        self.assertEqual('test', metrics[-1]['request_id'])
+        self.assertIn('php', metrics[-1])
+
+    def test_metrics_with_log_level_error(self):
+        root = logging.getLogger()
+        self.addCleanup(root.setLevel, root.level)
+        root.setLevel(logging.ERROR)
+        log_stream.seek(0)
+        log_stream.truncate()
+        with unittest.mock.patch.object(app, 'metrics_namespace', 'Test'):
+            self.request('/hello')
+
+        self.assertIn('"_aws"', log_stream.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
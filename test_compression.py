@@ -0,0 +1,145 @@
+import base64
+import gzip
+import unittest
+import zlib
+
+from parameterized import parameterized
+
+from apigateway import proxy_response
+from compression import Compressor, brotli, is_compressible, negotiate
+
+HTML = [(b'content-type', b'text/html; charset=UTF-8')]
+BODY = b'<p>Hello, world!</p>\n' * 100
+
+
+class NegotiateTestCase(unittest.TestCase):
+    @parameterized.expand([
+        (None, None),
+        ('', None),
+        ('gzip', 'gzip'),
+        ('deflate, gzip', 'gzip'),
+        ('gzip;q=0.5, deflate', 'deflate'),
+        ('x-gzip', 'gzip'),
+        ('GZIP; Q=1.0', 'gzip'),
+        ('*', 'gzip'),
+        ('*;q=0.5, gzip;q=0', 'deflate'),
+        ('gzip;q=0, deflate;q=0', None),
+        ('identity', None),
+        ('compress, zstd', None),
+        ('gzip;q=abc, deflate', 'deflate'),
+    ])
+    def test_negotiate(self, accept_encoding, expected):
+        self.assertEqual(expected, negotiate(accept_encoding, ('gzip', 'deflate')))
+
+    def test_preference(self):
+        self.assertEqual('br', negotiate('gzip, deflate, br', ('br', 'gzip', 'deflate')))
+        self.assertEqual('gzip', negotiate('gzip, deflate, br;q=0.9', ('br', 'gzip', 'deflate')))
+
+
+class IsCompressibleTestCase(unittest.TestCase):
+    @parameterized.expand([
+        ('text/html; charset=UTF-8', True),
+        ('application/json', True),
+        ('image/svg+xml', True),
+        ('image/png', False),
+        ('video/mp4', False),
+        ('application/zip', False),
+        ('font/woff2', False),
+    ])
+    def test_content_type(self, content_type, expected):
+        self.assertEqual(expected, is_compressible([(b'content-type', content_type.encode())]))
+
+    def test_no_content_type(self):
+        self.assertFalse(is_compressible([]))
+
+    def test_encoded(self):
+        self.assertFalse(is_compressible(HTML + [(b'content-encoding', b'gzip')]))
+        self.assertTrue(is_compressible(HTML + [(b'content-encoding', b'identity')]))
+
+    def test_no_transform(self):
+        self.assertFalse(is_compressible(HTML + [(b'cache-control', b'public, no-transform')]))
+
+
+class CompressorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.compressor = Compressor(min_size=1024)
+        self.compressor.encodings = ('gzip', 'deflate')
+
+    def test_gzip(self):
+        headers = HTML + [(b'content-length', b'%d' % len(BODY)), (b'etag', b'"abc"')]
+        headers, body, encoding = self.compressor.compress(b'200 OK', headers, BODY, 'gzip, deflate')
+        self.assertEqual('gzip', encoding)
+        self.assertEqual(BODY, gzip.decompress(body))
+        self.assertEqual([(b'content-encoding', b'gzip'), (b'content-type', b'text/html; charset=UTF-8'),
+                          (b'etag', b'W/"abc"'), (b'vary', b'Accept-Encoding')], headers)
+        self.assertEqual(len(BODY), self.compressor.bytes_in)
+        self.assertEqual(len(body), self.compressor.bytes_out)
+
+    def test_deflate(self):
+        _, body, encoding = self.compressor.compress(b'200 OK', HTML, memoryview(BODY), 'deflate')
+        self.assertEqual('deflate', encoding)
+        self.assertEqual(BODY, zlib.decompress(body))
+
+    @unittest.skipIf(brotli is None, 'brotli is not installed')
+    def test_brotli(self):
+        compressor = Compressor()
+        _, body, encoding = compressor.compress(b'200 OK', HTML, BODY, 'gzip, br')
+        self.assertEqual('br', encoding)
+        self.assertEqual(BODY, brotli.decompress(body))
+
+    def test_not_accepted(self):
+        headers, body, encoding = self.compressor.compress(b'200 OK', HTML, BODY, 'identity')
+        self.assertIsNone(encoding)
+        self.assertIs(BODY, body)
+        self.assertEqual(HTML + [(b'vary', b'Accept-Encoding')], headers)
+
+    def test_vary(self):
+        headers, _, _ = self.compressor.compress(b'200 OK', HTML + [(b'vary', b'Cookie')], BODY, 'gzip')
+        self.assertEqual([(b'vary', b'Cookie'), (b'vary', b'Accept-Encoding')], headers[-2:])
+        headers, _, _ = self.compressor.compress(b'200 OK', HTML + [(b'vary', b'accept-encoding')], BODY, 'gzip')
+        self.assertEqual([(b'vary', b'accept-encoding')], [header for header in headers if header[0] == b'vary'])
+
+    @parameterized.expand([
+        ('small', b'200 OK', HTML, BODY[:1023]),
+        ('not modified', b'304 Not Modified', HTML, BODY),
+        ('partial', b'206 Partial Content', HTML, BODY),
+        ('image', b'200 OK', [(b'content-type', b'image/png')], BODY),
+    ])
+    def test_skipped(self, _, status, headers, body):
+        result = self.compressor.compress(status, headers, body, 'gzip')
+        self.assertEqual((headers, body, None), result)
+        self.assertEqual(0, self.compressor.bytes_in)
+
+    def test_head(self):
+        headers, body, encoding = self.compressor.compress(b'200 OK', HTML + [(b'etag', b'"abc"')], b'', 'gzip',
+                                                           head=True)
+        self.assertEqual('gzip', encoding)
+        self.assertEqual(b'', body)
+        self.assertEqual([(b'content-encoding', b'gzip'), (b'content-type', b'text/html; charset=UTF-8'),
+                          (b'etag', b'W/"abc"'), (b'vary', b'Accept-Encoding')], headers)
+        self.assertEqual(0, self.compressor.bytes_in)
+
+        headers, _, encoding = self.compressor.compress(b'200 OK', HTML, b'', 'identity', head=True)
+        self.assertIsNone(encoding)
+        self.assertEqual(HTML + [(b'vary', b'Accept-Encoding')], headers)
+
+    def test_head_small(self):
+        headers = HTML + [(b'content-length', b'1023')]
+        self.assertEqual((headers, b'', None), self.compressor.compress(b'200 OK', headers, b'', 'gzip', head=True))
+
+    def test_may_compress(self):
+        self.assertTrue(self.compressor.may_compress(b'200 OK', HTML))
+        self.assertFalse(self.compressor.may_compress(b'304 Not Modified', HTML))
+        self.assertFalse(self.compressor.may_compress(b'200 OK', [(b'content-type', b'image/png')]))
+        self.assertEqual('gzip', self.compressor.negotiate('br, gzip'))
+
+    def test_proxy_response(self):
+        headers, body, _ = self.compressor.compress(b'200 OK', HTML, BODY, 'gzip')
+        response = proxy_response(b'200 OK', headers, body)
+        self.assertTrue(response['isBase64Encoded'])
+        self.assertEqual('gzip', response['headers']['content-encoding'])
+        self.assertEqual(BODY, gzip.decompress(base64.b64decode(response['body'])))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,26 +1,62 @@
+import asyncio
+import io
+import os
+import resource
+import socket
+import tempfile
+import threading
+import time
 import unittest
 import unittest.mock
 from parameterized import parameterized
 
 from fcgi_client import *
+from fcgi_client import (FCGI_KEEP_CONN, FCGI_MAX_RECORD_SIZE, FCGI_REQUEST_COMPLETE, FCGI_RESPONDER, FCGI_STDOUT,
+                         decode_buffer_generator)
+from fcgi_test_server import FCGITestServer
+from timings import Timings
 
 
-class ClientTestCase(unittest.TestCase):
-    def test_call(self):
-        mock_socket = unittest.mock.Mock()
+def recv_into(chunks):
+    """Make a ``recv_into`` side effect that returns one chunk per call."""
+    chunks = list(chunks)
+
+    def side_effect(buffer):
+        chunk = chunks.pop(0)
+        if len(chunk) > len(buffer):
+            chunk, rest = chunk[:len(buffer)], chunk[len(buffer):]
+            chunks.insert(0, rest)
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    return side_effect
+
+
+def mock_socket_for(chunks):
+    """Make a socket mock that receives ``chunks`` and accepts everything sent with ``sendmsg``."""
+    mock_socket = unittest.mock.Mock()
+    mock_socket.recv_into.side_effect = recv_into(chunks)
+    mock_socket.sendmsg.side_effect = lambda buffers: sum(len(buffer) for buffer in buffers)
+    return mock_socket
 
-        sendall_calls = [
-            unittest.mock.call(b'\x01\x01\x00\x01\x00\x08\x00\x00\x00\x01\x00\x00\x00\x00\x00\x00'),
-            unittest.mock.call(b'\x01\x04\x00\x01\x00\x16\x02\x00\x0f\x05SCRIPT_FILENAME/ping\x00\x00'),
-            unittest.mock.call(b'\x01\x04\x00\x01\x00\x00\x00\x00'),
-            unittest.mock.call(b'\x01\x05\x00\x01\x00\x00\x00\x00'),
-        ]
 
-        mock_socket.recv.side_effect = [
-            b'\x01\x06\x00\x01\x00\xaf\x01\x00', b'pong',
-            b'\x01\x07\x00\x01\x00\xaf\x01\x00', b'err',
+def sent_by(mock_socket) -> bytes:
+    return b''.join(b''.join(bytes(buffer) for buffer in call[0][0]) for call in mock_socket.sendmsg.call_args_list)
+
+
+class ClientTestCase(unittest.TestCase):
+    def test_call(self):
+        mock_socket = mock_socket_for([
+            b'\x01\x06\x00\x01\x00\x04\x04\x00', b'pong\x00\x00\x00\x00',
+            b'\x01\x07\x00\x01\x00\x03\x05\x00', b'err\x00\x00\x00\x00\x00',
             b'\x01\x03\x00\x01\x00\x08\x00\x00', b'\x00\x00\x00\x00\x00\x00\x00\x00'
-        ]
+        ])
+
+        sent = (b'\x01\x01\x00\x01\x00\x08\x00\x00\x00\x01\x00\x00\x00\x00\x00\x00' +
+                b'\x01\x04\x00\x01\x00\x16\x02\x00\x0f\x05SCRIPT_FILENAME/ping\x00\x00' +
+                b'\x01\x04\x00\x01\x00\x00\x00\x00' +
+                b'\x01\x05\x00\x01\x00\x00\x00\x00' +
+                b'\x01\x08\x00\x01\x00\x00\x00\x00')
 
         with unittest.mock.patch.object(FCGIApp, '_get_connection', return_value=mock_socket) as mock_client:
             client = FCGIApp()
@@ -28,10 +64,1048 @@ class ClientTestCase(unittest.TestCase):
                 'SCRIPT_FILENAME': '/ping',
             })
 
-        mock_socket.sendall.assert_has_calls(sendall_calls)
+        self.assertEqual(1, mock_socket.sendmsg.call_count)
+        self.assertEqual(sent, sent_by(mock_socket))
         self.assertEqual(out, b'pong')
         self.assertEqual(err, b'err')
-        self.assertEqual(0, len(list(mock_socket.recv.side_effect)))
+        self.assertEqual(6, mock_socket.recv_into.call_count)
+
+
+class StreamRecordsTestCase(unittest.TestCase):
+    @parameterized.expand([
+        ('bytes', lambda content: content),
+        ('file', lambda content: io.BytesIO(content)),
+        ('raw_file', lambda content: io.BufferedReader(io.BytesIO(content))),
+        ('iterable', lambda content: iter([content[:100], b'', content[100:]])),
+    ])
+    def test_stream_records(self, name, make_body):
+        content = bytes(range(256)) * 1000
+        lengths = []
+        received = bytearray()
+        for record in stream_records(FCGIStdin, 3, make_body(content)):
+            self.assertIsInstance(record, FCGIStdin)
+            self.assertEqual(3, record.request_id)
+            lengths.append(len(record.content))
+            received.extend(record.encode()[8:8 + len(record.content)])
+        self.assertEqual(content, received)
+        self.assertEqual(0, lengths[-1])
+        self.assertTrue(all(0 < length <= 65535 for length in lengths[:-1]))
+
+    def test_buffer_is_not_copied(self):
+        content = b'x' * 200000
+        records = list(stream_records(FCGIStdin, 1, content))
+        self.assertEqual([65535, 65535, 65535, 3395, 0], [len(record.content) for record in records])
+        self.assertIs(content, records[1].content.obj)
+
+    def test_empty(self):
+        self.assertEqual([b'\x01\x05\x00\x01\x00\x00\x00\x00'],
+                         [record.encode() for record in stream_records(FCGIStdin, 1, b'')])
+
+    def test_long_request(self):
+        mock_socket = mock_socket_for([FCGIEndRequest(1, 0, FCGI_REQUEST_COMPLETE).encode()])
+        body = io.BytesIO(b'x' * 100000)
+        with unittest.mock.patch.object(FCGIApp, '_get_connection', return_value=mock_socket):
+            FCGIApp()({'HTTP_COOKIE': 'y' * 70000, 'CONTENT_LENGTH': '100000'}, body)
+
+        sent = bytearray(sent_by(mock_socket))
+        streams = {}
+        record = decode_record(sent)
+        while record is not None:
+            if not isinstance(record, FCGIBeginRequest):
+                streams.setdefault(type(record), []).append(record.content)
+            record = decode_record(sent)
+
+        params = b''.join(streams[FCGIParams])
+        self.assertEqual(3, len(streams[FCGIParams]))
+        self.assertEqual([('HTTP_COOKIE', 'y' * 70000), ('CONTENT_LENGTH', '100000')],
+                         decode_name_value_pairs(params))
+        self.assertEqual(b'x' * 100000, b''.join(streams[FCGIStdin]))
+        self.assertEqual([b''], streams[FCGIData])
+
+
+class ClientProtocolTestCase(unittest.TestCase):
+    def test_backpressure(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        transport = unittest.mock.Mock()
+        transport.is_closing.return_value = False
+        protocol = FastCgiClientProtocol(loop)
+        transport.write.side_effect = lambda data: protocol.pause_writing() if len(data) > 60000 else None
+        protocol.connection_made(transport)
+        protocol.send_request(1, {}, io.BytesIO(b'x' * 200000))
+
+        # Begin request and params, then the first stdin record.
+        self.assertEqual(1, transport.writelines.call_count)
+        self.assertEqual(1, transport.write.call_count)
+        protocol.resume_writing()
+        self.assertEqual(2, transport.write.call_count)
+        for _ in range(3):
+            protocol.resume_writing()
+
+        sent = bytearray(b''.join(transport.writelines.call_args[0][0]) +
+                         b''.join(call[0][0] for call in transport.write.call_args_list))
+        stdin = []
+        record = decode_record(sent)
+        while record is not None:
+            if isinstance(record, FCGIStdin):
+                stdin.append(record.content)
+            record = decode_record(sent)
+        self.assertEqual(b'x' * 200000, b''.join(stdin))
+        self.assertEqual(b'', stdin[-1])
+
+    def test_abort_ends_the_body(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        transport = unittest.mock.Mock()
+        transport.is_closing.return_value = False
+        protocol = FastCgiClientProtocol(loop)
+        transport.write.side_effect = lambda data: protocol.pause_writing()
+        protocol.connection_made(transport)
+        protocol.send_request(1, {}, io.BytesIO(b'x' * 200000))
+        protocol.abort_request(1)
+        protocol.resume_writing()
+        protocol.resume_writing()
+
+        sent = bytearray()
+        for name, args, _ in transport.method_calls:
+            if name == 'write':
+                sent += args[0]
+            elif name == 'writelines':
+                sent += b''.join(args[0])
+        records = []
+        record = decode_record(sent)
+        while record is not None:
+            records.append(record)
+            record = decode_record(sent)
+        self.assertEqual([FCGIBeginRequest, FCGIParams, FCGIStdin, FCGIStdin, FCGIAbortRequest],
+                         [type(record) for record in records])
+        self.assertEqual(b'', records[-2].content)
+        self.assertEqual(1, protocol.active_requests)
+
+    def test_connection_lost(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        transport = unittest.mock.Mock()
+        transport.is_closing.return_value = False
+        protocol = FastCgiClientProtocol(loop)
+        protocol.connection_made(transport)
+        first = protocol.send_request(1, {})
+        protocol.data_received(FCGIStdout(1, b'partial').encode())
+        protocol.connection_lost(None)
+
+        self.assertIsInstance(first.exception(), ConnectionResetError)
+        self.assertTrue(protocol.closed.done())
+        with self.assertRaises(ConnectionResetError):
+            protocol.send_request(2, {})
+
+
+def echo(params, stdin):
+    return ('Content-type: text/plain\r\n\r\n%s' % params['SCRIPT_NAME']).encode() + stdin, b''
+
+
+class AsyncClientTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def run_until_complete(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_request(self):
+        with FCGITestServer(echo) as server:
+            client = FastCgiClient(server.address, loop=self.loop)
+            out, err = self.run_until_complete(client.request({'SCRIPT_NAME': '/ping'}, b'body'))
+            self.run_until_complete(client.close())
+
+        self.assertEqual(b'Content-type: text/plain\r\n\r\n/pingbody', out)
+        self.assertEqual(b'', err)
+
+    def test_concurrent_requests_share_connections(self):
+        def slow_echo(params, stdin):
+            time.sleep(0.01)
+            return echo(params, stdin)
+
+        with FCGITestServer(slow_echo, unix=False) as server:
+            client = FastCgiClient(host=server.address[0], port=server.address[1], max_connections=2,
+                                   loop=self.loop)
+
+            async def gather():
+                return await asyncio.gather(*[client.request({'SCRIPT_NAME': '/%d' % i}) for i in range(6)])
+
+            results = self.run_until_complete(gather())
+            self.run_until_complete(client.close())
+
+        self.assertEqual([b'Content-type: text/plain\r\n\r\n/%d' % i for i in range(6)],
+                         [out for out, _ in results])
+        self.assertEqual(2, server.connections)
+        self.assertEqual(6, server.requests)
+
+    def test_timeout(self):
+        release = threading.Event()
+
+        def stall(params, stdin):
+            if params['SCRIPT_NAME'] == '/stall':
+                release.wait(5)
+            return echo(params, stdin)
+
+        with FCGITestServer(stall) as server:
+            client = FastCgiClient(server.address, max_connections=1, timeout=0.05, loop=self.loop)
+            with self.assertRaises(asyncio.TimeoutError):
+                self.run_until_complete(client.request({'SCRIPT_NAME': '/stall'}))
+            # The closed connection is not remembered.
+            self.assertEqual({}, client._released_at)
+            release.set()
+            out, _ = self.run_until_complete(client.request({'SCRIPT_NAME': '/ping'}))
+            self.run_until_complete(client.close())
+
+        self.assertTrue(out.endswith(b'/ping'))
+        self.assertEqual(2, server.connections)
+
+    def test_cancel(self):
+        release = threading.Event()
+
+        def stall(params, stdin):
+            release.wait(5)
+            return echo(params, stdin)
+
+        async def cancel_request(client):
+            task = self.loop.create_task(client.request({'SCRIPT_NAME': '/stall'}))
+            await asyncio.sleep(0.02)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            self.assertEqual([], [protocol for protocol in client._connections if not protocol.is_closing])
+
+        with FCGITestServer(stall) as server:
+            client = FastCgiClient(server.address, loop=self.loop)
+            self.run_until_complete(cancel_request(client))
+            release.set()
+
+    def test_closed_idle_connection_is_replaced(self):
+        with FCGITestServer(echo) as server:
+            client = FastCgiClient(server.address, max_connections=1, loop=self.loop)
+            self.run_until_complete(client.request({'SCRIPT_NAME': '/ping'}))
+            protocol = client._connections[0]
+            protocol.close()
+            self.run_until_complete(protocol.closed)
+            out, _ = self.run_until_complete(client.request({'SCRIPT_NAME': '/ping'}))
+            self.run_until_complete(client.close())
+
+        self.assertTrue(out.endswith(b'/ping'))
+        self.assertEqual(2, server.connections)
+
+
+class MultiplexingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.most_running = 0
+
+    def app(self, params, stdin):
+        with self.lock:
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        # Later requests finish first.
+        time.sleep(0.05 - int(params['SCRIPT_NAME'][1:]) * 0.005)
+        with self.lock:
+            self.running -= 1
+        return echo(params, stdin)
+
+    def run_requests(self, client, count):
+        async def gather():
+            results = await asyncio.gather(*[client.request({'SCRIPT_NAME': '/%d' % i}) for i in range(count)])
+            await client.close()
+            return results
+
+        results = self.loop.run_until_complete(gather())
+        self.assertEqual([b'Content-type: text/plain\r\n\r\n/%d' % i for i in range(count)],
+                         [out for out, _ in results])
+
+    def test_get_values(self):
+        with FCGITestServer(echo, max_conns=2, max_reqs=8, mpxs_conns=True) as server:
+            client = FastCgiClient(server.address, loop=self.loop)
+            values = self.loop.run_until_complete(client.get_values())
+
+        self.assertEqual({'FCGI_MAX_CONNS': '2', 'FCGI_MAX_REQS': '8', 'FCGI_MPXS_CONNS': '1'}, values)
+
+    def test_multiplexed_requests(self):
+        with FCGITestServer(self.app, max_conns=1, max_reqs=4, mpxs_conns=True) as server:
+            client = FastCgiClient(server.address, loop=self.loop)
+            self.run_requests(client, 8)
+
+        self.assertEqual((1, 4, True), (client.max_connections, client.max_requests, client.multiplex))
+        # One connection for the probe, one for the requests.
+        self.assertEqual(2, server.connections)
+        self.assertEqual(4, self.most_running)
+
+    def test_without_multiplexing(self):
+        with FCGITestServer(self.app, max_conns=3, max_reqs=3) as server:
+            client = FastCgiClient(server.address, loop=self.loop)
+            self.run_requests(client, 6)
+
+        self.assertEqual((3, 3, False), (client.max_connections, client.max_requests, client.multiplex))
+        self.assertEqual(4, server.connections)
+        self.assertEqual(3, self.most_running)
+
+    def test_abort_multiplexed_request(self):
+        release = threading.Event()
+
+        def stall(params, stdin):
+            if params['SCRIPT_NAME'] == '/stall':
+                release.wait(5)
+            return echo(params, stdin)
+
+        async def requests(client):
+            stalled = self.loop.create_task(client.request({'SCRIPT_NAME': '/stall'}, timeout=0.05))
+            out, _ = await client.request({'SCRIPT_NAME': '/ping'})
+            with self.assertRaises(asyncio.TimeoutError):
+                await stalled
+            protocol = client._connections[0]
+            self.assertFalse(protocol.is_closing)
+            release.set()
+            while protocol.active_requests:
+                await asyncio.sleep(0.01)
+            await client.close()
+            return out
+
+        with FCGITestServer(stall, max_conns=1, max_reqs=2, mpxs_conns=True) as server:
+            client = FastCgiClient(server.address, max_connections=1, max_requests=2, multiplex=True,
+                                   loop=self.loop)
+            out = self.loop.run_until_complete(requests(client))
+
+        self.assertTrue(out.endswith(b'/ping'))
+        self.assertEqual(1, server.connections)
+        self.assertEqual(1, len(server.aborted))
+
+    def test_busy_connection_is_waited_for(self):
+        release = threading.Event()
+
+        def stall(params, stdin):
+            if params['SCRIPT_NAME'] == '/stall':
+                release.wait(5)
+            return echo(params, stdin)
+
+        async def requests(client):
+            with self.assertRaises(asyncio.TimeoutError):
+                await client.request({'SCRIPT_NAME': '/stall'}, timeout=0.05)
+            stalled = self.loop.create_task(client.request({'SCRIPT_NAME': '/stall'}))
+            await asyncio.sleep(0.02)
+            # The connection carries an aborted and an awaited request, so
+            # the next request waits for one of them to end.
+            waiting = self.loop.create_task(client.request({'SCRIPT_NAME': '/ping'}))
+            await asyncio.sleep(0.05)
+            self.assertFalse(waiting.done())
+            self.assertFalse(stalled.done())
+            release.set()
+            results = await asyncio.gather(stalled, waiting)
+            await client.close()
+            return results
+
+        with FCGITestServer(stall, max_conns=1, max_reqs=2, mpxs_conns=True) as server:
+            client = FastCgiClient(server.address, max_connections=1, max_requests=2, multiplex=True,
+                                   loop=self.loop)
+            (stalled, _), (waiting, _) = self.loop.run_until_complete(requests(client))
+
+        self.assertTrue(stalled.endswith(b'/stall'))
+        self.assertTrue(waiting.endswith(b'/ping'))
+        self.assertEqual(1, server.connections)
+
+    def test_blocking_client_pool_size(self):
+        with FCGITestServer(echo, max_conns=3, max_reqs=3) as server:
+            app = FCGIApp(server.address, keep_alive=True, pool_size=None)
+            self.assertEqual({'FCGI_MAX_CONNS': '3', 'FCGI_MAX_REQS': '3', 'FCGI_MPXS_CONNS': '0'},
+                             app.get_values())
+            out, _ = app({'SCRIPT_NAME': '/ping'})
+            app.close()
+
+        self.assertTrue(out.endswith(b'/ping'))
+        self.assertEqual(3, app._pool.size)
+
+    def test_request_id_allocator(self):
+        allocator = RequestIdAllocator()
+        self.assertEqual([1, 2, 3], [allocator.allocate() for _ in range(3)])
+        allocator.release(2)
+        allocator.release(1)
+        self.assertEqual([1, 2, 4], [allocator.allocate() for _ in range(3)])
+
+    def test_capabilities(self):
+        from fcgi_client import _capabilities
+        self.assertEqual((1, 1, False), _capabilities({}))
+        self.assertEqual((5, 5, False), _capabilities({'FCGI_MAX_CONNS': '5', 'FCGI_MAX_REQS': '5',
+                                                       'FCGI_MPXS_CONNS': '0'}))
+        self.assertEqual((2, 2, False), _capabilities({'FCGI_MAX_CONNS': '2', 'FCGI_MAX_REQS': '50'}))
+        self.assertEqual((1, 50, True), _capabilities({'FCGI_MAX_CONNS': '1', 'FCGI_MAX_REQS': '50',
+                                                       'FCGI_MPXS_CONNS': '1'}))
+        self.assertEqual((1, 1, False), _capabilities({'FCGI_MAX_CONNS': 'x'}))
+
+
+class ParamsTemplateTestCase(unittest.TestCase):
+    def test_encode(self):
+        template = ParamsTemplate({'GATEWAY_INTERFACE': 'CGI/1.1'}, ['SCRIPT_FILENAME'], max_names=1)
+        pairs = [('SCRIPT_FILENAME', '/index.php'), ('HTTP_COOKIE', 'x' * 200), ('HTTP_X_NAME', '\xe9t\xe9'),
+                 ('HTTP_COOKIE', '')]
+
+        self.assertEqual([('GATEWAY_INTERFACE', 'CGI/1.1')] + pairs, decode_name_value_pairs(template.encode(pairs)))
+        self.assertEqual(encode_name_value_pairs([('GATEWAY_INTERFACE', 'CGI/1.1'), ('SCRIPT_FILENAME', '/ping')]),
+                         template.encode([('SCRIPT_FILENAME', '/ping')]))
+
+    def test_encoded_params_are_sent_as_they_are(self):
+        params = ParamsTemplate().encode([('SCRIPT_FILENAME', '/ping')])
+        self.assertEqual(encode_request(1, 0, {'SCRIPT_FILENAME': '/ping'}), encode_request(1, 0, params))
+
+
+class SendmsgAllTestCase(unittest.TestCase):
+    def test_partial_writes(self):
+        mock_socket = unittest.mock.Mock()
+        received = []
+
+        def sendmsg(buffers):
+            data = b''.join(bytes(buffer) for buffer in buffers)[:5]
+            received.append(data)
+            return len(data)
+
+        mock_socket.sendmsg.side_effect = sendmsg
+        buffers = [b'abc', memoryview(b'defghij'), b'', b'klmnopqrstuvwxyz']
+        sendmsg_all(mock_socket, buffers)
+        self.assertEqual(b'abcdefghijklmnopqrstuvwxyz', b''.join(received))
+
+    def test_socket(self):
+        client, server = socket.socketpair()
+        self.addCleanup(client.close)
+        self.addCleanup(server.close)
+        body = b'x' * 100000
+        buffers = encode_request(1, 0, {'SCRIPT_FILENAME': '/ping'})
+        for record in stream_records(FCGIStdin, 1, body):
+            buffers.extend(record.encode_buffers())
+
+        thread = threading.Thread(target=sendmsg_all, args=(client, buffers))
+        thread.start()
+        received = bytearray()
+        expected = b''.join(bytes(buffer) for buffer in buffers)
+        while len(received) < len(expected):
+            received.extend(server.recv(65536))
+        thread.join()
+        self.assertEqual(expected, received)
+
+    def test_padding_is_shared(self):
+        first = FCGIStdin(1, b'x').encode_buffers()
+        second = FCGIStdout(2, b'yyy').encode_buffers()
+        self.assertEqual(b'\x00' * 7, first[2])
+        self.assertIs(first[2].obj, second[2].obj)
+
+
+class StreamTestCase(unittest.TestCase):
+    def stream(self, records, **kwargs):
+        mock_socket = mock_socket_for([record.encode() for record in records])
+        with unittest.mock.patch.object(FCGIApp, '_get_connection', return_value=mock_socket):
+            return FCGIApp(**kwargs).stream({'SCRIPT_FILENAME': '/ping'}), mock_socket
+
+    def test_stream(self):
+        response, mock_socket = self.stream([
+            FCGIStdout(1, b'Status: 404 Not Found\r\nContent-type: text/plain\r'),
+            FCGIStderr(1, b'err'),
+            FCGIStdout(1, b'\n\r\nno'),
+            FCGIStdout(1, b'pe'),
+            FCGIStdout(1, b''),
+            FCGIEndRequest(1, 0, FCGI_REQUEST_COMPLETE),
+        ])
+        self.assertEqual(b'404 Not Found', response.status)
+        self.assertEqual([(b'content-type', b'text/plain')], response.headers)
+        self.assertEqual(b'err', response.stderr)
+        mock_socket.close.assert_not_called()
+        self.assertEqual([b'no', b'pe'], list(response))
+        mock_socket.close.assert_called_once_with()
+
+    def test_read(self):
+        response, _ = self.stream([
+            FCGIStdout(1, b'Content-type: text/plain\n\npong'),
+            FCGIStdout(1, b'pong'),
+            FCGIStderr(1, b'err'),
+            FCGIEndRequest(1, 0, FCGI_REQUEST_COMPLETE),
+        ])
+        self.assertEqual(b'pongpong', response.read())
+        self.assertEqual(b'err', response.stderr)
+
+    def test_close_discards_pooled_connection(self):
+        response, mock_socket = self.stream([
+            FCGIStdout(1, b'Content-type: text/plain\r\n\r\n'),
+            FCGIStdout(1, b'x' * 1000),
+            FCGIEndRequest(1, 0, FCGI_REQUEST_COMPLETE),
+        ], keep_alive=True)
+        response.close()
+        mock_socket.close.assert_called_once_with()
+
+    def test_invalid_headers_discard_pooled_connection(self):
+        mock_socket = mock_socket_for([FCGIStdout(1, b'X-Large: ' + b'x' * 40000).encode(),
+                                       FCGIStdout(1, b'x' * 40000).encode()])
+        with unittest.mock.patch.object(FCGIApp, '_get_connection', return_value=mock_socket):
+            try:
+                FCGIApp(keep_alive=True).stream({'SCRIPT_FILENAME': '/ping'})
+            except ProtocolError:
+                # While the traceback keeps the generator from being
+                # collected.
+                mock_socket.close.assert_called_once_with()
+            else:
+                self.fail('ProtocolError not raised')
+
+
+class SpoolTestCase(unittest.TestCase):
+    records = [
+        FCGIStdout(1, b'Status: 201 Created\r\nContent-type: text/plain\r\n\r\n' + b'x' * 3000),
+        FCGIStderr(1, b'err'),
+        FCGIStdout(1, b'y' * 3000),
+        FCGIStdout(1, b''),
+        FCGIEndRequest(1, 0, FCGI_REQUEST_COMPLETE),
+    ]
+
+    def spool(self, **kwargs):
+        mock_socket = mock_socket_for([record.encode() for record in self.records])
+        with unittest.mock.patch.object(FCGIApp, '_get_connection', return_value=mock_socket):
+            return FCGIApp(keep_alive=True, pool_size=1).spool({'SCRIPT_FILENAME': '/ping'}, **kwargs), mock_socket
+
+    def test_in_memory(self):
+        (status, headers, body, err), _ = self.spool()
+        with body:
+            self.assertEqual(b'201 Created', status)
+            self.assertEqual([(b'content-type', b'text/plain')], headers)
+            self.assertFalse(body.spooled)
+            self.assertEqual(b'x' * 3000 + b'y' * 3000, body.getbuffer())
+            self.assertEqual(b'err', err)
+
+    def test_spooled(self):
+        with tempfile.TemporaryDirectory() as directory:
+            (_, _, body, _), _ = self.spool(threshold=4096, dir=directory)
+            with body:
+                self.assertTrue(body.spooled)
+                self.assertEqual(6000, len(body))
+                view = body.getbuffer()
+                self.assertEqual(b'x' * 3000 + b'y' * 3000, view)
+                view.release()
+
+    def test_too_large_closes_the_connection(self):
+        mock_socket = mock_socket_for([record.encode() for record in self.records])
+        with unittest.mock.patch.object(FCGIApp, '_get_connection', return_value=mock_socket):
+            with self.assertRaises(ResponseTooLarge):
+                FCGIApp(keep_alive=True, pool_size=1).spool({'SCRIPT_FILENAME': '/ping'}, max_size=5000)
+
+        mock_socket.close.assert_called_once_with()
+
+    def test_max_size_from_headers(self):
+        seen = []
+
+        def limit(status, headers):
+            seen.append((status, headers))
+            return 5000 if (b'content-type', b'text/plain') in headers else None
+
+        with self.assertRaises(ResponseTooLarge):
+            self.spool(max_size=limit)
+        self.assertEqual([(b'201 Created', [(b'content-type', b'text/plain')])], seen)
+
+        (_, _, body, _), _ = self.spool(max_size=lambda status, headers: 6000)
+        with body:
+            self.assertEqual(6000, len(body))
+
+
+class OutputSpoolTestCase(unittest.TestCase):
+    def test_empty(self):
+        with OutputSpool(threshold=0) as spool:
+            spool.write(b'')
+            self.assertEqual(b'', spool.getbuffer())
+
+    def test_close_with_a_view_around(self):
+        spool = OutputSpool(threshold=1)
+        spool.write(b'abc')
+        body = spool.getbuffer()[1:]
+        spool.close()
+
+        self.assertEqual(b'bc', body)
+
+
+class DeadlineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def stall(self, params, stdin):
+        if params['SCRIPT_NAME'] == '/stall':
+            self.release.wait(5)
+        return echo(params, stdin)
+
+    def test_stalled_request_is_aborted(self):
+        with FCGITestServer(self.stall) as server:
+            app = FCGIApp(connect=server.address, keep_alive=True, pool_size=1)
+            start = time.monotonic()
+            with self.assertRaises(RequestTimeout) as raised:
+                app({'SCRIPT_NAME': '/stall'}, deadline=time.monotonic() + 0.05)
+            self.assertLess(time.monotonic() - start, 1)
+            # PHP-FPM does not end aborted requests, so the connection is
+            # closed and the pool connects again.
+            self.assertFalse(raised.exception.aborted)
+            out, _ = app({'SCRIPT_NAME': '/ping'}, deadline=time.monotonic() + 5)
+            app.close()
+            self.release.set()
+
+        self.assertTrue(out.endswith(b'/ping'))
+        self.assertEqual([1], server.aborted)
+        self.assertEqual(2, server.connections)
+
+    def test_ended_request_keeps_the_connection(self):
+        with FCGITestServer(self.stall, end_aborted=True) as server:
+            app = FCGIApp(connect=server.address, keep_alive=True, pool_size=1)
+            with self.assertRaises(RequestTimeout) as raised:
+                app.spool({'SCRIPT_NAME': '/stall'}, deadline=time.monotonic() + 0.05)
+            self.assertTrue(raised.exception.aborted)
+            out, _ = app({'SCRIPT_NAME': '/ping'})
+            app.close()
+            self.release.set()
+
+        self.assertTrue(out.endswith(b'/ping'))
+        self.assertEqual([1], server.aborted)
+        self.assertEqual(1, server.connections)
+
+    def test_connect_within_deadline(self):
+        with tempfile.TemporaryDirectory() as directory:
+            app = FCGIApp(connect=directory + '/missing.sock', keep_alive=True, pool_size=1)
+            start = time.monotonic()
+            with self.assertRaises(FileNotFoundError):
+                app({'SCRIPT_NAME': '/ping'}, deadline=time.monotonic() + 0.05)
+            # Without a deadline, connecting is retried for a second.
+            self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_passed_deadline(self):
+        with FCGITestServer(echo) as server:
+            app = FCGIApp(connect=server.address, keep_alive=True, pool_size=1)
+            with self.assertRaises(RequestTimeout):
+                app({'SCRIPT_NAME': '/ping'}, deadline=time.monotonic() - 1)
+            out, _ = app({'SCRIPT_NAME': '/ping'})
+            app.close()
+
+        self.assertTrue(out.endswith(b'/ping'))
+        self.assertEqual([], server.aborted)
+
+
+class ReplayTestCase(unittest.TestCase):
+    """A pooled connection that goes away after the whole request was sent, as when a PHP-FPM child dies."""
+
+    def setUp(self):
+        self.runs = []
+
+    def die_once(self, params, stdin):
+        if params['SCRIPT_NAME'] == '/die':
+            self.runs.append(params['REQUEST_METHOD'])
+            if len(self.runs) == 1:
+                raise ConnectionAbortedError
+        return echo(params, stdin)
+
+    def request(self, params):
+        with FCGITestServer(self.die_once) as server:
+            app = FCGIApp(connect=server.address, keep_alive=True, pool_size=1)
+            app({'SCRIPT_NAME': '/ping'})
+            try:
+                return app(params, b'body')
+            finally:
+                app.close()
+
+    def async_request(self, params):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        with FCGITestServer(self.die_once) as server:
+            client = FastCgiClient(server.address, max_connections=1, loop=loop)
+            loop.run_until_complete(client.request({'SCRIPT_NAME': '/ping'}))
+            try:
+                return loop.run_until_complete(client.request(params, b'body'))
+            finally:
+                loop.run_until_complete(client.close())
+
+    def test_post_is_not_repeated(self):
+        with self.assertRaises(ConnectionError):
+            self.request({'SCRIPT_NAME': '/die', 'REQUEST_METHOD': 'POST'})
+        self.assertEqual(['POST'], self.runs)
+
+    def test_get_is_repeated(self):
+        out, _ = self.request({'SCRIPT_NAME': '/die', 'REQUEST_METHOD': 'GET'})
+        self.assertTrue(out.endswith(b'/diebody'))
+        self.assertEqual(['GET', 'GET'], self.runs)
+
+    def test_encoded_params(self):
+        with self.assertRaises(ConnectionError):
+            self.request(encode_name_value_pairs([('SCRIPT_NAME', '/die'), ('REQUEST_METHOD', 'POST')]))
+        self.assertEqual(['POST'], self.runs)
+
+    def test_async_post_is_not_repeated(self):
+        with self.assertRaises(ConnectionError):
+            self.async_request({'SCRIPT_NAME': '/die', 'REQUEST_METHOD': 'POST'})
+        self.assertEqual(['POST'], self.runs)
+
+    def test_async_get_is_repeated(self):
+        out, _ = self.async_request({'SCRIPT_NAME': '/die', 'REQUEST_METHOD': 'GET'})
+        self.assertTrue(out.endswith(b'/diebody'))
+        self.assertEqual(['GET', 'GET'], self.runs)
+
+
+class HeadersCallbackTestCase(unittest.TestCase):
+    records = [
+        FCGIStdout(1, b'Status: 304 Not Modified\r\nETag: "x"\r\n'),
+        FCGIStdout(1, b'\r\nbo'),
+        FCGIStdout(1, b'dy'),
+        FCGIStdout(1, b''),
+        FCGIEndRequest(1, 0, FCGI_REQUEST_COMPLETE),
+    ]
+
+    def call(self, on_headers, **kwargs):
+        mock_socket = mock_socket_for([record.encode() for record in self.records])
+        with unittest.mock.patch.object(FCGIApp, '_get_connection', return_value=mock_socket):
+            return FCGIApp(**kwargs)({'SCRIPT_FILENAME': '/ping'}, on_headers=on_headers), mock_socket
+
+    def test_keep_body(self):
+        calls = []
+        (out, _), _ = self.call(lambda status, headers: calls.append((status, headers)))
+
+        self.assertEqual(b'Status: 304 Not Modified\r\nETag: "x"\r\n\r\nbody', out)
+        self.assertEqual([(b'304 Not Modified', [(b'etag', b'"x"')])], calls)
+
+    def test_drop_body(self):
+        (out, _), mock_socket = self.call(lambda status, headers: not status.startswith(b'304'), keep_alive=True)
+
+        self.assertEqual(b'Status: 304 Not Modified\r\nETag: "x"\r\n\r\n', out)
+        # The body was read to the end, so the connection can be reused.
+        mock_socket.close.assert_not_called()
+
+    def test_timings(self):
+        timings = Timings()
+        mock_socket = mock_socket_for([record.encode() for record in self.records])
+        with unittest.mock.patch.object(FCGIApp, '_get_connection', return_value=mock_socket):
+            FCGIApp()({'SCRIPT_FILENAME': '/ping'}, timings=timings)
+
+        self.assertEqual(['connect', 'send', 'first-byte', 'php'], list(timings.phases))
+        self.assertTrue(all(seconds >= 0 for seconds in timings.phases.values()))
+
+    def test_reject(self):
+        def reject(status, headers):
+            raise ValueError('too large')
+
+        with self.assertRaises(ValueError):
+            self.call(reject, keep_alive=True)
+
+    def test_async(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        with FCGITestServer(echo) as server:
+            client = FastCgiClient(server.address, max_connections=1, loop=loop)
+            out, _ = loop.run_until_complete(client.request({'SCRIPT_NAME': '/ping'}, b'body',
+                                                            on_headers=lambda status, headers: False))
+            with self.assertRaises(ProtocolError):
+                loop.run_until_complete(client.request({'SCRIPT_NAME': '/ping'}, on_headers=self.raise_protocol_error))
+            loop.run_until_complete(client.close())
+
+        self.assertEqual(b'Content-type: text/plain\r\n\r\n', out)
+
+    @staticmethod
+    def raise_protocol_error(status, headers):
+        raise ProtocolError('rejected')
+
+
+class CGIHeaderParserTestCase(unittest.TestCase):
+    def test_split_empty_line(self):
+        parser = CGIHeaderParser()
+        self.assertEqual(b'', parser.feed(b'Status: 201 Created\r\nLocation: /a\r\n\r'))
+        self.assertFalse(parser.complete)
+
+        body = parser.feed(b'\nbody')
+        self.assertTrue(parser.complete)
+        self.assertEqual(b'body', body)
+        self.assertEqual(b'201 Created', parser.status)
+        self.assertEqual([(b'location', b'/a')], parser.headers)
+        self.assertEqual(b'Status: 201 Created\r\nLocation: /a\r\n\r\n', parser.head)
+        self.assertEqual(b'more', parser.feed(b'more'))
+
+    def test_lf(self):
+        parser = CGIHeaderParser()
+        self.assertEqual(b'a\n\nb', parser.feed(b'Content-type: text/plain\n\na\n\nb'))
+        self.assertEqual([(b'content-type', b'text/plain')], parser.headers)
+
+    def test_no_headers(self):
+        parser = CGIHeaderParser()
+        self.assertEqual(b'body', parser.feed(b'\r\nbody'))
+        self.assertEqual((b'200 OK', []), (parser.status, parser.headers))
+
+    def test_close(self):
+        parser = CGIHeaderParser()
+        parser.feed(b'Content-type: text/plain')
+        parser.close()
+        self.assertTrue(parser.complete)
+        self.assertEqual([(b'content-type', b'text/plain')], parser.headers)
+
+    def test_body_is_a_view(self):
+        data = bytearray(b'Content-type: text/plain\r\n\r\n' + b'x' * 100)
+        body = CGIHeaderParser().feed(data)
+        self.assertIs(data, body.obj)
+
+    def test_drop_body(self):
+        parser = CGIHeaderParser(lambda status, headers: False)
+        self.assertEqual(b'', parser.feed(b'Content-type: text/plain\r\n\r\nbody'))
+        self.assertEqual(b'', parser.feed(b'more'))
+        self.assertFalse(parser.keep_body)
+
+    def test_max_size(self):
+        parser = CGIHeaderParser(max_size=16)
+        parser.feed(b'X-Long: ')
+        with self.assertRaises(ProtocolError):
+            parser.feed(b'x' * 16)
+
+
+class KeepAliveTestCase(unittest.TestCase):
+    response = (FCGIStdout(1, b'pong').encode() + FCGIStdout(1, b'').encode() +
+                FCGIEndRequest(1, 0, FCGI_REQUEST_COMPLETE).encode())
+
+    def setUp(self):
+        self.connections = []
+        patcher = unittest.mock.patch.object(FCGIApp, '_get_connection', side_effect=self.connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def connect(self, timeout=None):
+        client, server = socket.socketpair()
+        self.addCleanup(client.close)
+        self.addCleanup(server.close)
+        server.sendall(self.response)
+        self.connections.append((client, server))
+        return client
+
+    def test_connection_is_reused(self):
+        app = FCGIApp(keep_alive=True)
+        self.assertEqual((b'pong', b''), app({'SCRIPT_FILENAME': '/ping'}))
+        server = self.connections[0][1]
+        server.recv(65536)
+
+        def respond():
+            received = b''
+            while FCGIStdin(1, b'').encode() not in received:
+                received += server.recv(65536)
+            server.sendall(self.response)
+
+        thread = threading.Thread(target=respond)
+        thread.start()
+        self.assertEqual((b'pong', b''), app({'SCRIPT_FILENAME': '/ping'}))
+        thread.join()
+        self.assertEqual(1, len(self.connections))
+
+    def test_connection_state_is_reused(self):
+        app = FCGIApp(keep_alive=True)
+        self.assertEqual((b'pong', b''), app({'SCRIPT_FILENAME': '/ping'}))
+        connection, = app._connections
+        self.connections[0][1].sendall(self.response)
+
+        self.assertEqual((b'pong', b''), app({'SCRIPT_FILENAME': '/ping'}))
+        self.assertEqual([connection], list(app._connections))
+
+    def test_keep_conn_flag(self):
+        app = FCGIApp(keep_alive=True)
+        app({'SCRIPT_FILENAME': '/ping'})
+        begin = self.connections[0][1].recv(16)
+        self.assertEqual(FCGIBeginRequest(1, FCGI_RESPONDER, FCGI_KEEP_CONN).encode(), begin)
+
+    def test_closed_connection_is_replaced(self):
+        app = FCGIApp(keep_alive=True)
+        app._pool._idle.append((self.connect(), time.monotonic()))
+        self.connections[0][1].close()
+
+        self.assertEqual((b'pong', b''), app({'SCRIPT_FILENAME': '/ping'}))
+        self.assertEqual(2, len(self.connections))
+        self.assertEqual(-1, self.connections[0][0].fileno())
+
+    def test_connection_closed_before_response_is_retried(self):
+        app = FCGIApp(keep_alive=True)
+        client, server = socket.socketpair()
+        self.addCleanup(client.close)
+        app._pool._idle.append((client, time.monotonic()))
+        # The application goes away after the staleness check.
+        server.close()
+
+        with unittest.mock.patch.object(FCGIConnectionPool, '_is_stale', return_value=False):
+            self.assertEqual((b'pong', b''), app({'SCRIPT_FILENAME': '/ping'}))
+        self.assertEqual(1, len(self.connections))
+        self.assertEqual(-1, client.fileno())
+
+    def test_stale_with_large_fd(self):
+        if resource.getrlimit(resource.RLIMIT_NOFILE)[0] <= 2048:
+            self.skipTest('too few file descriptors')
+        client, server = socket.socketpair()
+        self.addCleanup(server.close)
+        with client:
+            os.dup2(client.fileno(), 2048)
+        sock = socket.socket(fileno=2048)
+        self.addCleanup(sock.close)
+
+        self.assertFalse(FCGIConnectionPool._is_stale(sock))
+        server.close()
+        self.assertTrue(FCGIConnectionPool._is_stale(sock))
+
+    def test_idle_timeout(self):
+        app = FCGIApp(keep_alive=True, idle_timeout=10)
+        app._pool._idle.append((self.connect(), time.monotonic()))
+        with unittest.mock.patch('time.monotonic', return_value=time.monotonic() + 11):
+            sock, reused = app._pool.acquire()
+        self.assertFalse(reused)
+        self.assertEqual(-1, self.connections[0][0].fileno())
+        self.assertIs(self.connections[1][0], sock)
+
+    def test_pool_size(self):
+        pool = FCGIConnectionPool(self.connect, size=1)
+        sock, _ = pool.acquire()
+        self.assertFalse(pool._slots.acquire(blocking=False))
+        pool.discard(sock)
+        self.assertTrue(pool._slots.acquire(blocking=False))
+
+
+class RecordReaderTestCase(unittest.TestCase):
+    records = [FCGIStdout(1, b'x' * 65535), FCGIStderr(1, b'err'), FCGIStdout(1, b'y' * 1000),
+               FCGIEndRequest(1, 0, FCGI_REQUEST_COMPLETE)]
+
+    def read_all(self, chunks, buffer_size=262144):
+        sock = unittest.mock.Mock()
+        sock.recv_into.side_effect = recv_into(chunks)
+        reader = FCGIRecordReader(sock, buffer_size)
+        return [reader.read_record() for _ in self.records], sock.recv_into.call_count
+
+    def assertRecords(self, records):
+        for expected, record in zip(self.records, records):
+            self.assertIs(type(expected), type(record))
+            self.assertEqual(expected.encode(), record.encode())
+
+    def test_many_records_per_read(self):
+        stream = b''.join(record.encode() for record in self.records)
+        records, reads = self.read_all([stream])
+        self.assertRecords(records)
+        self.assertEqual(1, reads)
+
+    def test_short_reads(self):
+        stream = b''.join(record.encode() for record in self.records)
+        records, reads = self.read_all(stream[i:i + 1000] for i in range(0, len(stream), 1000))
+        self.assertRecords(records)
+
+    def test_compaction(self):
+        stream = b''.join(record.encode() for record in self.records)
+        chunks = [stream[:65000], stream[65000:]]
+        records, reads = self.read_all(chunks, buffer_size=65800)
+        self.assertRecords(records)
+
+    def test_raw_content_is_a_view(self):
+        sock = unittest.mock.Mock()
+        sock.recv_into.side_effect = recv_into([FCGIStdout(3, b'data').encode()])
+        record_type, request_id, content = FCGIRecordReader(sock).read_raw()
+        self.assertEqual((FCGI_STDOUT, 3), (record_type, request_id))
+        self.assertIsInstance(content, memoryview)
+        self.assertEqual(b'data', content)
+
+    def test_connection_closed(self):
+        sock = unittest.mock.Mock()
+        sock.recv_into.side_effect = recv_into([b'\x01\x06', b''])
+        with self.assertRaises(ConnectionAbortedError):
+            FCGIRecordReader(sock).read_record()
+
+    def test_wrong_version(self):
+        sock = unittest.mock.Mock()
+        sock.recv_into.side_effect = recv_into([b'\x02\x01\x00\x01\x00\x00\x00\x00'])
+        with self.assertRaises(ProtocolError) as cm:
+            FCGIRecordReader(sock).read_record()
+
+        self.assertIn('unexpected protocol version: 2', cm.exception.args[0])
+
+
+class RecordBufferTestCase(unittest.TestCase):
+    def test_receive_data_in_pieces(self):
+        records = FCGIRecordBuffer(FCGI_MAX_RECORD_SIZE)
+        stream = FCGIStdout(1, b'x' * 40000).encode() * 3
+        read = []
+        for i in range(0, len(stream), 30000):
+            records.receive_data(stream[i:i + 30000])
+            record = records.next_record()
+            while record is not None:
+                read.append(bytes(record[2]))
+                record = records.next_record()
+
+        self.assertEqual([b'x' * 40000] * 3, read)
+        self.assertEqual(0, len(records))
+
+    def test_receive_data_grows_the_buffer(self):
+        records = FCGIRecordBuffer(FCGI_MAX_RECORD_SIZE)
+        records.receive_data(FCGIStdout(1, b'y' * 65535).encode() * 4)
+        first = records.next_record()[2]
+
+        self.assertEqual(b'y' * 65535, first)
+        self.assertEqual(3, sum(1 for _ in iter(records.next_record, None)))
+
+    def test_get_buffer_makes_room_for_the_record(self):
+        records = FCGIRecordBuffer(FCGI_MAX_RECORD_SIZE)
+        stream = FCGIStdout(1, b'a' * 1000).encode() + FCGIStdout(1, b'b' * 65535).encode()
+        records.get_buffer()[:60000] = stream[:60000]
+        records.buffer_updated(60000)
+        self.assertEqual(b'a' * 1000, records.next_record()[2])
+        self.assertIsNone(records.next_record())
+
+        # The unread part is moved to the front for the rest of the record.
+        buffer = records.get_buffer()
+        self.assertGreaterEqual(len(buffer), len(stream) - 60000)
+        buffer[:len(stream) - 60000] = stream[60000:]
+        records.buffer_updated(len(stream) - 60000)
+        self.assertEqual(b'b' * 65535, records.next_record()[2])
+
+
+class ClientConnectionTestCase(unittest.TestCase):
+    def test_request(self):
+        connection = FCGIClientConnection()
+        sent = b''.join(bytes(buffer) for buffer in connection.send_request(1, {'SCRIPT_FILENAME': '/ping'}))
+        sent += b''.join(record.encode() for record in connection.send_body(1, b'body'))
+        self.assertEqual([FCGIBeginRequest, FCGIParams, FCGIParams, FCGIStdin, FCGIStdin, FCGIData],
+                         [type(record) for record in decode_buffer_generator(bytearray(sent))])
+
+        received = [FCGIStdout(2, b'other'), FCGIStdout(1, b'out'), FCGIStderr(1, b'err'),
+                    FCGIEndRequest(1, 3, FCGI_REQUEST_COMPLETE), FCGIStdout(1, b'late'),
+                    FCGIGetValuesResult([('FCGI_MAX_CONNS', '4')])]
+        connection.receive_data(b''.join(record.encode() for record in received))
+        events = list(iter(connection.next_event, None))
+
+        self.assertEqual([FCGIStdoutEvent(1, b'out'), FCGIStderrEvent(1, b'err'),
+                          FCGIEndRequestEvent(1, 3, FCGI_REQUEST_COMPLETE), FCGIValuesEvent({'FCGI_MAX_CONNS': '4'})],
+                         events)
+        self.assertEqual(set(), connection.requests)
+
+    def test_reset(self):
+        connection = FCGIClientConnection()
+        connection.send_request(1, {})
+        connection.receive_data(FCGIStdout(1, b'out').encode()[:10])
+        connection.reset()
+
+        self.assertEqual(set(), connection.requests)
+        self.assertEqual(0, len(connection.records))
+        connection.send_request(1, {})
+        connection.receive_data(FCGIStdout(1, b'new').encode())
+        self.assertEqual(FCGIStdoutEvent(1, b'new'), connection.next_event())
+
+    def test_request_id_in_use(self):
+        connection = FCGIClientConnection()
+        connection.send_request(1, {})
+        with self.assertRaises(ProtocolError):
+            connection.send_request(1, {})
+
+    def test_unknown_record_type(self):
+        connection = FCGIClientConnection()
+        connection.receive_data(FCGIUnknownType(12).encode() + b'\x01\x0c\x00\x01\x00\x00\x00\x00')
+        with self.assertRaises(ProtocolError):
+            connection.next_event()
+
+
+class DecodeBufferGeneratorTestCase(unittest.TestCase):
+    def test_complete_records_are_removed(self):
+        tail = FCGIStdout(1, b'tail').encode()
+        buffer = bytearray(FCGIStdout(1, b'a').encode() + FCGIStderr(1, b'b').encode() + tail[:5])
+        records = list(decode_buffer_generator(buffer))
+
+        self.assertEqual([b'a', b'b'], [record.content for record in records])
+        self.assertEqual(tail[:5], buffer)
 
 
 class FCGIStdoutTestCase(unittest.TestCase):
@@ -193,6 +1267,31 @@ class ParseOutputTestCase(unittest.TestCase):
         out = b'Status: 999\r\nContent-type: text/plain;charset=UTF-8\r\n\r\npong'
         self.assertEqual((b'999 FCGIApp', [(b'content-type', b'text/plain;charset=UTF-8')], b'pong'), parse_out(out))
 
+    def test_parse_out_lf(self):
+        out = b'Status: 404 Not Found\nContent-type: text/plain\n\nnot\r\n\r\nfound'
+        self.assertEqual((b'404 Not Found', [(b'content-type', b'text/plain')], b'not\r\n\r\nfound'), parse_out(out))
+
+    def test_parse_out_repeated_headers(self):
+        out = b'Set-Cookie: a=1\r\nContent-type: text/plain\r\nSet-Cookie: b=2\r\n\r\n'
+        self.assertEqual((b'200 OK', [(b'set-cookie', b'a=1'), (b'content-type', b'text/plain'),
+                                      (b'set-cookie', b'b=2')], b''), parse_out(out))
+
+    def test_parse_out_body_is_not_copied(self):
+        out = bytearray(b'Content-type: text/plain\r\n\r\n' + b'x' * 1000)
+        status, headers, body = parse_out(memoryview(out))
+
+        self.assertIsInstance(body, memoryview)
+        self.assertIs(out, body.obj)
+        self.assertEqual(b'x' * 1000, body)
+
+    def test_parse_out_no_headers(self):
+        self.assertEqual((b'200 OK', [], b'body'), parse_out(b'\r\nbody'))
+        self.assertEqual((b'200 OK', [(b'content-type', b'text/plain')], b''), parse_out(b'Content-type: text/plain'))
+
+    def test_parse_out_bad_line(self):
+        out = b'HTTP/1.1 200 OK\r\nContent-type: text/plain\r\n\r\npong'
+        self.assertEqual((b'200 OK', [(b'content-type', b'text/plain')], b'pong'), parse_out(out))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,106 @@
+import io
+import json
+import logging
+import sys
+import time
+import unittest
+
+from logs import JsonFormatter, LogPipeline, RateLimitFilter, log_php_stderr
+
+
+class LogPipelineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.stream = io.StringIO()
+        self.pipeline = LogPipeline(self.stream, logging.DEBUG, RateLimitFilter(burst=2, interval=0.05))
+        self.logger = logging.getLogger('test_logs')
+        self.logger.propagate = False
+        self.pipeline.start(self.logger)
+        self.addCleanup(self.pipeline.stop)
+
+    def records(self):
+        self.pipeline.flush()
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_json(self):
+        self.logger.info('hello %s', 'world', extra={'path': '/'})
+
+        [record] = self.records()
+        self.assertEqual('INFO', record['level'])
+        self.assertEqual('test_logs', record['logger'])
+        self.assertEqual('hello world', record['message'])
+        self.assertEqual('/', record['path'])
+
+    def test_request_id(self):
+        self.pipeline.set_request_id('abc')
+        self.logger.info('in request')
+        self.pipeline.set_request_id(None)
+        self.logger.info('between requests')
+
+        first, second = self.records()
+        self.assertEqual('abc', first['request_id'])
+        self.assertNotIn('request_id', second)
+
+    def test_php_stderr(self):
+        err = ('PHP Warning:  Division by zero in /var/task/php/public/index.php on line 3\n'
+               'PHP Notice:  Undefined variable: \xe9t\xe9 in /var/task/php/public/index.php on line 4\n'
+               '\n').encode('utf-8') + b'PHP Fatal error:  bad byte \xff\n'
+        log_php_stderr(self.logger, err, path='/')
+
+        records = self.records()
+        self.assertEqual(['WARNING', 'INFO', 'CRITICAL'], [record['level'] for record in records])
+        self.assertIn('\xe9t\xe9', records[1]['message'])
+        self.assertIn('�', records[2]['message'])
+        self.assertEqual(['php'] * 3, [record['source'] for record in records])
+
+    def test_rate_limit(self):
+        for _ in range(5):
+            self.logger.warning('PHP Warning:  same again')
+        self.logger.warning('PHP Warning:  something else')
+        time.sleep(0.06)
+        self.logger.warning('PHP Warning:  same again')
+
+        records = self.records()
+        self.assertEqual(['PHP Warning:  same again'] * 2 + ['PHP Warning:  something else', 'PHP Warning:  same again'],
+                         [record['message'] for record in records])
+        self.assertEqual(3, records[-1]['suppressed'])
+
+    def test_rate_limit_ignores_arguments(self):
+        for line in range(5):
+            self.logger.warning('retrying %s in %d seconds', '/index.php', line)
+
+        records = self.records()
+        self.assertEqual(['retrying /index.php in 0 seconds', 'retrying /index.php in 1 seconds'],
+                         [record['message'] for record in records])
+
+    def test_exception(self):
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            self.logger.exception('failed on %s', '/index.php')
+
+        [record] = self.records()
+        self.assertEqual('failed on /index.php', record['message'])
+        self.assertIn('Traceback', record['exception'])
+        self.assertIn('ValueError: boom', record['exception'])
+
+    def test_rate_limit_exempt(self):
+        rate_limit = RateLimitFilter(burst=1, exempt=['test_logs'])
+        record = logging.makeLogRecord({'name': 'test_logs', 'msg': 'timings'})
+
+        self.assertTrue(all(rate_limit.filter(record) for _ in range(3)))
+
+
+class JsonFormatterTestCase(unittest.TestCase):
+    def test_exception(self):
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            record = logging.LogRecord('test', logging.ERROR, __file__, 1, 'failed', None, sys.exc_info())
+
+        entry = json.loads(JsonFormatter().format(record))
+        self.assertEqual('failed', entry['message'])
+        self.assertIn('ValueError: boom', entry['exception'])
+
+
+if __name__ == '__main__':
+    unittest.main()
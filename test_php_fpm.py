@@ -0,0 +1,209 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+import unittest.mock
+
+from php_fpm import PhpFpm, PhpFpmError, PhpFpmSupervisor, link_tree, make_fpm_config, pool_size
+
+FAKE_PHP_FPM = '''
+import os
+import sys
+import time
+sys.path.insert(0, %r)
+from fcgi_test_server import FCGITestServer
+
+socket_path, delay, answer = sys.argv[1], float(sys.argv[2]), sys.argv[3].encode()
+# Fail while the file given as the fourth argument exists.
+if len(sys.argv) > 4 and os.path.exists(sys.argv[4]):
+    answer = b''
+sys.stderr.write('NOTICE: fpm is running\\n')
+sys.stderr.flush()
+time.sleep(delay)
+if not answer:
+    sys.stderr.write('ERROR: failed to load configuration file\\n')
+    sys.exit(78)
+FCGITestServer(lambda params, stdin: (b'Content-type: text/plain\\r\\n\\r\\n' + answer, b''), path=socket_path).start()
+time.sleep(60)
+''' % os.path.dirname(os.path.abspath(__file__))
+
+
+class PhpFpmTestCase(unittest.TestCase):
+    def start(self, delay=0.0, answer='pong'):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        socket_path = os.path.join(directory.name, 'fpm.sock')
+        fpm = PhpFpm(directory.name, socket_path, command=[sys.executable, '-c', FAKE_PHP_FPM, socket_path,
+                                                           str(delay), answer])
+        fpm.start()
+        self.addCleanup(fpm.process.wait)
+        self.addCleanup(fpm.terminate)
+        return fpm
+
+    def test_ready(self):
+        fpm = self.start(delay=0.2)
+        started = time.monotonic()
+        fpm.wait_until_ready()
+        # Polling must not add whole seconds on top of the start-up time.
+        self.assertLess(time.monotonic() - started, 1.0)
+        self.assertTrue(fpm.ping(1.0).endswith(b'pong'))
+
+    def test_stale_socket_is_removed(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        socket_path = os.path.join(directory.name, 'fpm.sock')
+        open(socket_path, 'w').close()
+        fpm = PhpFpm(directory.name, socket_path, command=[sys.executable, '-c', 'pass'])
+        fpm.start()
+        fpm.process.wait()
+        self.assertFalse(os.path.exists(socket_path))
+
+    def test_exited(self):
+        fpm = self.start(answer='')
+        with self.assertRaises(PhpFpmError) as cm:
+            fpm.wait_until_ready()
+
+        message = str(cm.exception)
+        self.assertIn('PHP-FPM exited with status 78', message)
+        self.assertIn('NOTICE: fpm is running', message)
+        self.assertIn('ERROR: failed to load configuration file', message)
+
+    def test_timeout(self):
+        fpm = self.start(delay=30)
+        with self.assertRaises(PhpFpmError) as cm:
+            fpm.wait_until_ready(timeout=0.2)
+
+        self.assertIn('did not listen on', str(cm.exception))
+
+    def test_bad_ping_answer(self):
+        fpm = self.start(answer='nope')
+        with self.assertRaises(PhpFpmError) as cm:
+            fpm.wait_until_ready()
+
+        self.assertIn("answered /ping with b'", str(cm.exception))
+
+    def test_without_ping(self):
+        fpm = self.start(answer='nope')
+        fpm.wait_until_ready(ping=False)
+
+    def test_revalidate(self):
+        with unittest.mock.patch('subprocess.Popen') as popen:
+            PhpFpm('/var/task', '/tmp/test.sock', revalidate=True).start()
+        command = popen.call_args[0][0]
+        self.assertEqual(['-d', 'opcache.validate_timestamps=1', '-d', 'opcache.revalidate_freq=0'], command[-4:])
+
+    def test_stop_kills(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        fpm = PhpFpm(directory.name, os.path.join(directory.name, 'fpm.sock'), command=[
+            sys.executable, '-c', 'import signal, sys, time\n'
+            'signal.signal(signal.SIGTERM, signal.SIG_IGN)\n'
+            'sys.stderr.write("NOTICE: ignoring SIGTERM\\n")\n'
+            'sys.stderr.flush()\n'
+            'time.sleep(60)\n'])
+        fpm.start()
+        self.addCleanup(fpm.stop, 0)
+        deadline = time.monotonic() + 5
+        while 'ignoring SIGTERM' not in fpm.log_tail() and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+        fpm.stop(timeout=0.1)
+        self.assertEqual(-9, fpm.process.returncode)
+
+
+class PhpFpmSupervisorTestCase(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        socket_path = os.path.join(directory.name, 'fpm.sock')
+        self.fail_flag = os.path.join(directory.name, 'fail')
+        fpm = PhpFpm(directory.name, socket_path, command=[sys.executable, '-c', FAKE_PHP_FPM, socket_path, '0',
+                                                           'pong', self.fail_flag])
+        self.supervisor = PhpFpmSupervisor(fpm, min_delay=0.01, max_delay=0.05)
+        self.supervisor.start()
+        self.addCleanup(self.supervisor.stop)
+
+    def kill(self):
+        self.supervisor.php_fpm.process.kill()
+        deadline = time.monotonic() + 5
+        while self.supervisor.last_status is None and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+    def test_restart(self):
+        self.kill()
+
+        self.supervisor.ensure_running(timeout=5)
+        self.assertTrue(self.supervisor.running)
+        self.assertEqual(1, self.supervisor.restarts)
+        self.assertEqual(-9, self.supervisor.last_status)
+        self.assertTrue(self.supervisor.php_fpm.ping(1.0).endswith(b'pong'))
+
+    def test_failing_restarts(self):
+        open(self.fail_flag, 'w').close()
+        self.kill()
+
+        with self.assertRaises(PhpFpmError) as cm:
+            self.supervisor.ensure_running(timeout=0.5)
+        self.assertIn('PHP-FPM exited with status 78', str(cm.exception))
+        self.assertIn('ERROR: failed to load configuration file', str(cm.exception))
+        self.assertFalse(self.supervisor.running)
+        # The delay doubles up to 50 ms, so there were a handful of attempts.
+        self.assertGreater(self.supervisor.restarts, 2)
+        self.assertLess(self.supervisor.restarts, 20)
+
+        os.unlink(self.fail_flag)
+        self.supervisor.ensure_running(timeout=5)
+
+    def test_stop(self):
+        self.supervisor.stop()
+        self.supervisor.php_fpm.process.wait()
+
+        self.assertEqual(0, self.supervisor.restarts)
+
+
+class PoolSizeTestCase(unittest.TestCase):
+    def test_memory_bound(self):
+        mb = 1024 * 1024
+        self.assertEqual(1, pool_size(memory=128 * mb, cpus=2))
+        self.assertEqual(6, pool_size(memory=512 * mb, cpus=4))
+
+    def test_cpu_bound(self):
+        self.assertEqual(4, pool_size(memory=3008 * 1024 * 1024, cpus=2))
+
+    def test_make_fpm_config(self):
+        config = make_fpm_config('/tmp/test.sock', 6)
+        self.assertIn('listen = /tmp/test.sock\n', config)
+        self.assertIn('pm = static\npm.max_children = 6\n', config)
+        self.assertIn('ping.path = /ping\n', config)
+        self.assertNotIn('request_terminate_timeout', config)
+
+    def test_make_fpm_config_request_terminate_timeout(self):
+        config = make_fpm_config('/tmp/test.sock', 6, request_terminate_timeout=30)
+        self.assertIn('request_terminate_timeout = 30\n', config)
+
+
+class LinkTreeTestCase(unittest.TestCase):
+    def test_link_tree(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        source = os.path.join(directory.name, 'package', 'opcache')
+        target = os.path.join(directory.name, 'tmp', 'opcache')
+        os.makedirs(os.path.join(source, 'system-id', 'var', 'task'))
+        with open(os.path.join(source, 'system-id', 'var', 'task', 'index.php.bin'), 'wb') as f:
+            f.write(b'compiled')
+
+        link_tree(source, target)
+        # Linking again, as a restarted PHP-FPM does, keeps what is there.
+        link_tree(source, target)
+
+        linked = os.path.join(target, 'system-id', 'var', 'task', 'index.php.bin')
+        self.assertTrue(os.path.islink(linked))
+        with open(linked, 'rb') as f:
+            self.assertEqual(b'compiled', f.read())
+        # OPcache adds the scripts that are missing to the cache.
+        open(os.path.join(target, 'system-id', 'var', 'task', 'other.php.bin'), 'w').close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import unittest
+
+from response_cache import ResponseCache, freshness_lifetime
+
+NOW = 1500000000.0
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = NOW
+
+    def __call__(self):
+        return self.now
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = ResponseCache(clock=self.clock)
+
+    def store(self, headers, path='/', status=b'200 OK', body=b'hello', request_headers=None, method='GET'):
+        return self.cache.store(method, path, '', request_headers or {}, status, headers, body)
+
+    def lookup(self, path='/', request_headers=None, method='GET'):
+        return self.cache.lookup(method, path, '', request_headers or {})
+
+    def test_hit(self):
+        self.assertTrue(self.store([(b'cache-control', b'max-age=60'), (b'content-type', b'text/plain')]))
+        self.clock.now += 10
+
+        status, headers, body = self.lookup()
+        self.assertEqual(b'200 OK', status)
+        self.assertEqual([(b'cache-control', b'max-age=60'), (b'content-type', b'text/plain'), (b'age', b'10')],
+                         headers)
+        self.assertEqual(b'hello', body)
+        self.assertEqual((1, 0), (self.cache.hits, self.cache.misses))
+
+    def test_expired(self):
+        self.store([(b'cache-control', b'max-age=60')])
+        self.clock.now += 60
+
+        self.assertIsNone(self.lookup())
+        self.assertEqual((0, 1), (self.cache.hits, self.cache.misses))
+        self.assertEqual(0, len(self.cache))
+
+    def test_age_from_response(self):
+        self.store([(b'cache-control', b'max-age=60'), (b'age', b'50')])
+        self.clock.now += 5
+        self.assertEqual((b'age', b'55'), self.lookup()[1][-1])
+
+        self.clock.now += 5
+        self.assertIsNone(self.lookup())
+
+    def test_not_stored(self):
+        self.assertFalse(self.store([]))
+        self.assertFalse(self.store([(b'cache-control', b'no-store, max-age=60')]))
+        self.assertFalse(self.store([(b'cache-control', b'private, max-age=60')]))
+        self.assertFalse(self.store([(b'cache-control', b'no-cache, max-age=60')]))
+        self.assertFalse(self.store([(b'cache-control', b'max-age=0')]))
+        self.assertFalse(self.store([(b'cache-control', b'max-age=60'), (b'set-cookie', b'a=b')]))
+        self.assertFalse(self.store([(b'cache-control', b'max-age=60'), (b'vary', b'*')]))
+        self.assertFalse(self.store([(b'cache-control', b'max-age=60')], status=b'500 Internal Server Error'))
+        self.assertFalse(self.store([(b'cache-control', b'max-age=60')], method='POST'))
+        self.assertFalse(self.store([(b'cache-control', b'max-age=60')], request_headers={'Authorization': 'x'}))
+        self.assertTrue(self.store([(b'cache-control', b'public, max-age=60')], request_headers={'Authorization': 'x'}))
+
+    def test_vary(self):
+        self.store([(b'cache-control', b'max-age=60'), (b'vary', b'Accept-Language')], body=b'hello',
+                   request_headers={'Accept-Language': 'en'})
+        self.store([(b'cache-control', b'max-age=60'), (b'vary', b'Accept-Language')], body=b'bonjour',
+                   request_headers={'Accept-Language': 'fr'})
+
+        self.assertEqual(b'hello', self.lookup(request_headers={'accept-language': 'en'})[2])
+        self.assertEqual(b'bonjour', self.lookup(request_headers={'Accept-Language': 'fr'})[2])
+        self.assertIsNone(self.lookup(request_headers={'Accept-Language': 'de'}))
+        self.assertIsNone(self.lookup())
+
+    def test_key(self):
+        self.store([(b'cache-control', b'max-age=60')], path='/a')
+
+        self.assertIsNone(self.lookup('/b'))
+        self.assertIsNone(self.lookup('/a', method='HEAD'))
+        self.assertIsNone(self.cache.lookup('GET', '/a', 'page=2', {}))
+        self.assertIsNotNone(self.lookup('/a'))
+
+    def test_lru(self):
+        cache = ResponseCache(max_bytes=1500, clock=self.clock)
+        headers = [(b'cache-control', b'max-age=60')]
+        for path in ('/a', '/b'):
+            cache.store('GET', path, '', {}, b'200 OK', headers, b'x' * 300)
+        cache.lookup('GET', '/a', '', {})
+        cache.store('GET', '/c', '', {}, b'200 OK', headers, b'x' * 300)
+
+        self.assertIsNotNone(cache.lookup('GET', '/a', '', {}))
+        self.assertIsNone(cache.lookup('GET', '/b', '', {}))
+        self.assertIsNotNone(cache.lookup('GET', '/c', '', {}))
+        self.assertEqual(1, cache.evictions)
+        self.assertLessEqual(cache.size, 1500)
+        self.assertFalse(cache.store('GET', '/d', '', {}, b'200 OK', headers, b'x' * 1500))
+
+    def test_too_large(self):
+        class Body(bytes):
+            def __bytes__(self):
+                raise AssertionError('the body was copied')
+
+        cache = ResponseCache(max_bytes=1500, clock=self.clock)
+        self.assertFalse(cache.store('GET', '/', '', {}, b'200 OK', [(b'cache-control', b'max-age=60')],
+                                     Body(b'x' * 1500)))
+
+    def test_replace(self):
+        self.store([(b'cache-control', b'max-age=60')], body=b'old')
+        self.store([(b'cache-control', b'max-age=60')], body=b'new')
+
+        self.assertEqual(b'new', self.lookup()[2])
+        self.assertEqual(1, len(self.cache))
+
+
+class FreshnessLifetimeTestCase(unittest.TestCase):
+    def test_s_maxage(self):
+        headers = [(b'cache-control', b'max-age=60, s-maxage=600')]
+        self.assertEqual(600, freshness_lifetime(headers, NOW))
+        self.assertEqual(60, freshness_lifetime(headers, NOW, shared=False))
+
+    def test_expires(self):
+        self.assertEqual(3600, freshness_lifetime([(b'date', b'Fri, 14 Jul 2017 02:40:00 GMT'),
+                                                   (b'expires', b'Fri, 14 Jul 2017 03:40:00 GMT')], NOW))
+        self.assertEqual(60, freshness_lifetime([(b'expires', b'Fri, 14 Jul 2017 02:41:00 GMT')], NOW))
+        self.assertIsNone(freshness_lifetime([(b'expires', b'0')], NOW))
+
+    def test_max_age_over_expires(self):
+        self.assertEqual(60, freshness_lifetime([(b'cache-control', b'max-age=60'), (b'expires', b'0')], NOW))
+
+    def test_invalid_max_age(self):
+        self.assertIsNone(freshness_lifetime([(b'cache-control', b'max-age=soon')], NOW))
+
+
+if __name__ == '__main__':
+    unittest.main()
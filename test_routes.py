@@ -0,0 +1,65 @@
+import os
+import tempfile
+import unittest
+
+from routes import Route, RouteIndex
+
+
+class RouteIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        os.makedirs(os.path.join(self.root, 'admin'))
+        for name in ('index.php', 'phpinfo.php', 'admin/users.php', 'style.css'):
+            open(os.path.join(self.root, name), 'w').close()
+        self.routes = RouteIndex(self.root)
+
+    def test_file(self):
+        self.assertEqual(Route(self.root + '/phpinfo.php', '/phpinfo.php'), self.routes.resolve('/phpinfo.php'))
+        self.assertEqual(Route(self.root + '/admin/users.php', '/admin/users.php'),
+                         self.routes.resolve('/admin/users.php'))
+
+    def test_front_controller(self):
+        self.assertEqual(Route(self.root + '/index.php', '/index.php', '/blog/hello'),
+                         self.routes.resolve('/blog/hello'))
+        self.assertEqual(Route(self.root + '/index.php', '/index.php', '/'), self.routes.resolve('/'))
+        self.assertEqual(Route(self.root + '/index.php', '/index.php', '/admin'), self.routes.resolve('/admin'))
+
+    def test_specials(self):
+        self.assertEqual(Route('/ping', '/ping'), self.routes.resolve('/ping'))
+        self.assertEqual(Route('/status', '/status'), self.routes.resolve('/status'))
+
+    def test_normalization(self):
+        self.assertEqual('/phpinfo.php', self.routes.resolve('/admin/../phpinfo.php').script_name)
+        self.assertEqual('/admin/users.php', self.routes.resolve('//admin/./users.php').script_name)
+
+    def test_no_escape(self):
+        outside = os.path.basename(self.root) + '-secret.php'
+        with open(os.path.join(os.path.dirname(self.root), outside), 'w'):
+            pass
+        self.addCleanup(os.unlink, os.path.join(os.path.dirname(self.root), outside))
+
+        route = self.routes.resolve('/../' + outside)
+        self.assertEqual(self.root + '/index.php', route.script_filename)
+
+    def test_no_filesystem_access(self):
+        os.unlink(os.path.join(self.root, 'phpinfo.php'))
+        open(os.path.join(self.root, 'new.php'), 'w').close()
+
+        self.assertEqual('/phpinfo.php', self.routes.resolve('/phpinfo.php').script_name)
+        self.assertEqual('/new.php', self.routes.resolve('/new.php').path_info)
+
+        self.routes.rebuild()
+        self.assertEqual('/phpinfo.php', self.routes.resolve('/phpinfo.php').path_info)
+        self.assertEqual('/new.php', self.routes.resolve('/new.php').script_name)
+
+    def test_rebuild_on_miss(self):
+        routes = RouteIndex(self.root, rebuild_on_miss=True)
+        open(os.path.join(self.root, 'new.php'), 'w').close()
+
+        self.assertEqual(Route(self.root + '/new.php', '/new.php'), routes.resolve('/new.php'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import asyncio
+import http.client
+import os
+import tempfile
+import threading
+import unittest
+
+from fcgi_client import FastCgiClient
+from fcgi_test_server import FCGITestServer
+from routes import RouteIndex
+from server import HttpServer
+from static import StaticFiles
+
+
+def app(params, stdin):
+    if params['SCRIPT_NAME'] == '/cookies.php':
+        return b'Set-Cookie: a=1\r\nSet-Cookie: b=2\r\n\r\n', b''
+    if params['SCRIPT_NAME'] == '/server.php':
+        names = ('DOCUMENT_ROOT', 'SERVER_SOFTWARE', 'SERVER_PROTOCOL', 'REQUEST_URI', 'CONTENT_LENGTH')
+        return b'\r\n' + '\n'.join('%s=%s' % (name, params.get(name)) for name in names).encode(), b''
+    body = ('%s %s %s %s %s' % (params['REQUEST_METHOD'], params['SCRIPT_NAME'], params.get('PATH_INFO', ''),
+                                 params['QUERY_STRING'], params.get('HTTP_X_TEST', ''))).encode() + stdin
+    return b'Status: 201 Created\r\nContent-type: text/plain\r\n\r\n' + body, b''
+
+
+class HttpServerTestCase(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.document_root = directory.name
+        for name, content in (('index.php', b'<?php'), ('cookies.php', b'<?php'), ('server.php', b'<?php'),
+                              ('style.css', b'body {}')):
+            with open(os.path.join(directory.name, name), 'wb') as f:
+                f.write(content)
+
+        self.fpm = FCGITestServer(app, max_conns=2)
+        self.fpm.start()
+        self.addCleanup(self.fpm.stop)
+
+        self.loop = asyncio.new_event_loop()
+        client = FastCgiClient(self.fpm.address, max_connections=2, loop=self.loop)
+        server = HttpServer(client, RouteIndex(directory.name), StaticFiles(directory.name), max_body_size=1024)
+        asyncio.set_event_loop(self.loop)
+        self.http = self.loop.run_until_complete(server.serve('127.0.0.1', 0))
+        self.port = self.http.sockets[0].getsockname()[1]
+        thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        thread.start()
+
+        def stop():
+            async def close():
+                self.http.close()
+                await self.http.wait_closed()
+                await client.close()
+
+            asyncio.run_coroutine_threadsafe(close(), self.loop).result(5)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            thread.join(5)
+            self.loop.close()
+            asyncio.set_event_loop(None)
+
+        self.addCleanup(stop)
+
+    def request(self, method, url, body=None, headers=None, connection=None):
+        if connection is None:
+            connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5)
+            self.addCleanup(connection.close)
+        connection.request(method, url, body, headers or {})
+        response = connection.getresponse()
+        return response, response.read()
+
+    def test_php(self):
+        response, body = self.request('POST', '/blog/hello%20world?page=2', b'body', {'X-Test': 'yes'})
+
+        self.assertEqual(201, response.status)
+        self.assertEqual('text/plain', response.getheader('Content-Type'))
+        self.assertEqual(b'POST /index.php /blog/hello world page=2 yesbody', body)
+
+    def test_keep_alive(self):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        for i in range(3):
+            response, body = self.request('GET', '/?i=%d' % i, connection=connection)
+            self.assertEqual(b'GET /index.php / i=%d ' % i, body)
+        connection.close()
+
+    def test_chunked_body(self):
+        response, body = self.request('PUT', '/upload', iter([b'a' * 10, b'b' * 5]))
+
+        self.assertEqual(b'PUT /index.php /upload  ' + b'a' * 10 + b'b' * 5, body)
+
+    def test_body_too_large(self):
+        response, _ = self.request('POST', '/', b'x' * 2048)
+
+        self.assertEqual(413, response.status)
+
+    def test_head(self):
+        response, body = self.request('HEAD', '/')
+
+        self.assertEqual(201, response.status)
+        self.assertEqual(b'', body)
+
+    def test_repeated_headers(self):
+        response, _ = self.request('GET', '/cookies.php')
+
+        self.assertEqual(['a=1', 'b=2'], response.msg.get_all('Set-Cookie'))
+
+    def test_server_params(self):
+        response, body = self.request('POST', '/server.php?a=b', b'body')
+
+        self.assertEqual(('DOCUMENT_ROOT=%s\nSERVER_SOFTWARE=php-was-always-already-serverless\n'
+                          'SERVER_PROTOCOL=HTTP/1.1\nREQUEST_URI=/server.php?a=b\nCONTENT_LENGTH=4'
+                          % self.document_root).encode(), body)
+
+    def test_no_php_fpm(self):
+        client = FastCgiClient(os.path.join(self.document_root, 'missing.sock'), loop=self.loop)
+        server = HttpServer(client, RouteIndex(self.document_root))
+        future = asyncio.run_coroutine_threadsafe(server.respond('GET', '/', {}, b'', {}), self.loop)
+
+        self.assertEqual(b'502 Bad Gateway', future.result(5)[0])
+
+    def test_static(self):
+        response, body = self.request('GET', '/style.css')
+
+        self.assertEqual(200, response.status)
+        self.assertEqual('text/css', response.getheader('Content-Type'))
+        self.assertEqual(b'body {}', body)
+        self.assertEqual(0, self.fpm.requests)
+
+    def test_concurrent_requests(self):
+        results = []
+
+        def get(i):
+            results.append(self.request('GET', '/?%d' % i)[1])
+
+        threads = [threading.Thread(target=get, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(b'GET /index.php / %d ' % i for i in range(8)), sorted(results))
+        self.assertLessEqual(self.fpm.connections, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
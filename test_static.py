@@ -0,0 +1,118 @@
+import base64
+import email.utils
+import os
+import tempfile
+import unittest
+
+from routes import RouteIndex
+from static import StaticFiles
+
+
+class StaticFilesTestCase(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        self.write('index.php', b'<?php')
+        self.write('style.css', b'body { color: red }')
+        self.write('logo.png', b'\x89PNG\r\n\x1a\n')
+        self.write('.user.ini', b'display_errors=1')
+        self.routes = RouteIndex(self.root)
+        self.static = StaticFiles(self.root)
+
+    def write(self, name, content):
+        with open(os.path.join(self.root, name), 'wb') as f:
+            f.write(content)
+        os.utime(os.path.join(self.root, name), (1500000000, 1500000000))
+
+    def serve(self, path, method='GET', headers=None):
+        return self.static.serve(self.routes.resolve(path), method, headers or {})
+
+    def test_text(self):
+        response = self.serve('/style.css')
+
+        self.assertEqual(200, response['statusCode'])
+        self.assertEqual('body { color: red }', response['body'])
+        self.assertFalse(response['isBase64Encoded'])
+        self.assertEqual('text/css', response['headers']['Content-Type'])
+        self.assertEqual('"59682f00-13"', response['headers']['ETag'])
+        self.assertEqual('Fri, 14 Jul 2017 02:40:00 GMT', response['headers']['Last-Modified'])
+
+    def test_binary(self):
+        response = self.serve('/logo.png')
+
+        self.assertEqual('image/png', response['headers']['Content-Type'])
+        self.assertTrue(response['isBase64Encoded'])
+        self.assertEqual(b'\x89PNG\r\n\x1a\n', base64.b64decode(response['body']))
+
+    def test_head(self):
+        response = self.serve('/style.css', 'HEAD')
+
+        self.assertEqual(200, response['statusCode'])
+        self.assertEqual('', response['body'])
+        self.assertEqual('text/css', response['headers']['Content-Type'])
+
+    def test_left_to_php(self):
+        self.assertIsNone(self.serve('/index.php'))
+        self.assertIsNone(self.serve('/blog/hello'))
+        self.assertIsNone(self.serve('/ping'))
+        self.assertIsNone(self.serve('/.user.ini'))
+        self.assertIsNone(self.serve('/style.css', 'POST'))
+
+    def test_if_none_match(self):
+        self.assertEqual(304, self.serve('/style.css', headers={'If-None-Match': '"59682f00-13"'})['statusCode'])
+        self.assertEqual(304, self.serve('/style.css', headers={'if-none-match': '"x", W/"59682f00-13"'})['statusCode'])
+        self.assertEqual(304, self.serve('/style.css', headers={'If-None-Match': '*'})['statusCode'])
+        self.assertEqual(200, self.serve('/style.css', headers={'If-None-Match': '"x"'})['statusCode'])
+
+        response = self.serve('/style.css', headers={'If-None-Match': '"59682f00-13"'})
+        self.assertEqual('', response['body'])
+        self.assertFalse(response['isBase64Encoded'])
+        self.assertEqual('"59682f00-13"', response['headers']['ETag'])
+
+    def test_if_modified_since(self):
+        self.assertEqual(304, self.serve('/style.css', headers={
+            'If-Modified-Since': 'Fri, 14 Jul 2017 02:40:00 GMT'})['statusCode'])
+        self.assertEqual(200, self.serve('/style.css', headers={
+            'If-Modified-Since': 'Thu, 13 Jul 2017 02:40:00 GMT'})['statusCode'])
+        self.assertEqual(200, self.serve('/style.css', headers={'If-Modified-Since': 'yesterday'})['statusCode'])
+        # If-None-Match wins when both are sent.
+        self.assertEqual(200, self.serve('/style.css', headers={
+            'If-None-Match': '"x"', 'If-Modified-Since': 'Fri, 14 Jul 2017 02:40:00 GMT'})['statusCode'])
+
+    def test_cached(self):
+        self.serve('/style.css')
+        self.write('style.css', b'body { color: blue }')
+
+        self.assertEqual('body { color: red }', self.serve('/style.css')['body'])
+        self.assertEqual((1, 1), (self.static.hits, self.static.misses))
+
+    def test_revalidate(self):
+        static = StaticFiles(self.root, revalidate=True)
+        static.serve(self.routes.resolve('/style.css'), 'GET', {})
+        self.write('style.css', b'body { color: blue }')
+        os.utime(os.path.join(self.root, 'style.css'), (1600000000, 1600000000))
+
+        response = static.serve(self.routes.resolve('/style.css'), 'GET', {})
+        self.assertEqual('body { color: blue }', response['body'])
+        self.assertEqual(email.utils.formatdate(1600000000, usegmt=True), response['headers']['Last-Modified'])
+
+    def test_byte_budget(self):
+        static = StaticFiles(self.root, max_bytes=20)
+        static.serve(self.routes.resolve('/style.css'), 'GET', {})
+        static.serve(self.routes.resolve('/logo.png'), 'GET', {})
+        static.serve(self.routes.resolve('/style.css'), 'GET', {})
+
+        self.assertEqual((0, 3), (static.hits, static.misses))
+        self.assertLessEqual(static._bytes, 20)
+
+    def test_large_files_are_not_kept(self):
+        static = StaticFiles(self.root, max_file_size=4)
+        static.serve(self.routes.resolve('/style.css'), 'GET', {})
+        static.serve(self.routes.resolve('/style.css'), 'GET', {})
+
+        self.assertEqual((0, 2), (static.hits, static.misses))
+
+
+if __name__ == '__main__':
+    unittest.main()
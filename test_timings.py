@@ -0,0 +1,63 @@
+import unittest
+
+from timings import Timings
+
+
+class TimingsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 10.0
+        self.timings = Timings(clock=lambda: self.now)
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+    def test_mark(self):
+        self.advance(0.001)
+        self.timings.mark('connect')
+        self.advance(0.002)
+        self.timings.lap('first-byte')
+        self.advance(0.003)
+        self.timings.mark('php')
+        self.advance(0.004)
+        self.timings.mark('connect')
+
+        self.assertEqual(['connect', 'first-byte', 'php'], list(self.timings.phases))
+        self.assertAlmostEqual(0.005, self.timings.phases['connect'])
+        self.assertAlmostEqual(0.002, self.timings.phases['first-byte'])
+        self.assertAlmostEqual(0.005, self.timings.phases['php'])
+        self.assertAlmostEqual(0.010, self.timings.total())
+
+    def test_server_timing(self):
+        self.advance(0.0015)
+        self.timings.mark('php')
+        self.advance(0.0005)
+
+        self.assertEqual('php;dur=1.500, total;dur=2.000', self.timings.server_timing())
+
+    def test_metrics(self):
+        self.advance(0.0015)
+        self.timings.mark('php')
+
+        record = self.timings.metrics('PHP', {'FunctionName': 'app'})
+        [directive] = record['_aws']['CloudWatchMetrics']
+        self.assertEqual('PHP', directive['Namespace'])
+        self.assertEqual([['FunctionName']], directive['Dimensions'])
+        self.assertEqual([{'Name': 'php', 'Unit': 'Milliseconds'}, {'Name': 'total', 'Unit': 'Milliseconds'}],
+                         directive['Metrics'])
+        self.assertIsInstance(record['_aws']['Timestamp'], int)
+        self.assertEqual('app', record['FunctionName'])
+        self.assertAlmostEqual(1.5, record['php'])
+        self.assertAlmostEqual(1.5, record['total'])
+
+    def test_sizes(self):
+        self.timings.sizes['compressed-body'] = 512
+
+        record = self.timings.metrics('PHP', {'FunctionName': 'app'})
+        [directive] = record['_aws']['CloudWatchMetrics']
+        self.assertEqual({'Name': 'compressed-body', 'Unit': 'Bytes'}, directive['Metrics'][-1])
+        self.assertEqual(512, record['compressed-body'])
+        self.assertNotIn('compressed-body', self.timings.server_timing())
+
+
+if __name__ == '__main__':
+    unittest.main()
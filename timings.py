@@ -0,0 +1,73 @@
+"""
+Where the time of a request goes.
+
+A :class:`Timings` is passed along with a request, and each step marks the end of its phase. The phases are written as
+a CloudWatch Embedded Metric Format record, which CloudWatch turns into metrics as it reads the function's log, and can
+be sent back in a ``Server-Timing`` header. Steps only mark phases when they are given a Timings, so measuring costs
+nothing when it is off. Sizes, such as that of a compressed body, can be recorded alongside.
+"""
+import time
+from collections import OrderedDict
+
+from typing import Any, Callable, Dict
+
+__all__ = ['Timings']
+
+
+class Timings(object):
+    """
+    The durations of the phases of one request, in seconds, in the order they ended, and sizes in bytes by name.
+
+    :param clock: a monotonic clock, in seconds
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.perf_counter):
+        self.clock = clock
+        self.start = self._last = clock()
+        self.phases = OrderedDict()  # type: OrderedDict
+        self.sizes = OrderedDict()  # type: OrderedDict
+
+    def mark(self, phase: str):
+        """End ``phase``, which started when the previous phase ended. The durations of a phase marked twice add up."""
+        now = self.clock()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self._last
+        self._last = now
+
+    def lap(self, phase: str):
+        """Record ``phase`` like :meth:`mark`, but leave the next phase to start when the previous one ended."""
+        self.phases[phase] = self.phases.get(phase, 0.0) + self.clock() - self._last
+
+    def total(self) -> float:
+        """The time since the Timings was created."""
+        return self.clock() - self.start
+
+    def server_timing(self) -> str:
+        """The phases and the total, in milliseconds, as the value of a ``Server-Timing`` header."""
+        entries = ['%s;dur=%.3f' % (phase, seconds * 1000) for phase, seconds in self.phases.items()]
+        entries.append('total;dur=%.3f' % (self.total() * 1000))
+        return ', '.join(entries)
+
+    def metrics(self, namespace: str, dimensions: Dict[str, str]) -> Dict[str, Any]:
+        """
+        The phases and the total, in milliseconds, and the sizes as a CloudWatch Embedded Metric Format record.
+
+        :param namespace: the CloudWatch namespace of the metrics
+        :param dimensions: the dimensions of the metrics by name, such as the function name
+        """
+        values = OrderedDict((phase, seconds * 1000) for phase, seconds in self.phases.items())
+        values['total'] = self.total() * 1000
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': namespace,
+                    'Dimensions': [list(dimensions)],
+                    'Metrics': [{'Name': name, 'Unit': 'Milliseconds'} for name in values] +
+                               [{'Name': name, 'Unit': 'Bytes'} for name in self.sizes],
+                }],
+            },
+        }
+        record.update(dimensions)
+        record.update(values)
+        record.update(self.sizes)
+        return record